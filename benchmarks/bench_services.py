@@ -0,0 +1,124 @@
+"""Benchmark for the album art and genre pipelines against the local stub server. Run it from the repository root with:
+
+    python -m benchmarks.bench_services --albums 20
+"""
+import argparse
+import logging
+import pathlib
+import sys
+import tempfile
+import time
+
+import mutagen.id3
+import mutagen.mp3
+
+from benchmarks import stubserver
+from collectionmanager import albumart, genre, services
+
+logger = logging.getLogger(__name__)
+
+# A silent MPEG-1 layer III frame, at 128 kbps and 44.1 kHz
+MP3_FRAME = b'\xff\xfb\x90\x64' + b'\x00' * 413
+
+
+def create_library(library_dir: pathlib.Path, albums: int, tracks: int):
+    """Create a library of silent MP3 files.
+
+    :param library_dir: The library directory.
+    :param albums: The number of albums.
+    :param tracks: The number of tracks per album.
+    """
+    for album_number in range(albums):
+        artist = f"Artist {album_number % 10}"
+        album = f"Album {album_number}"
+        album_dir = library_dir / artist / f"[2000] {album}"
+        album_dir.mkdir(parents=True)
+        for track_number in range(1, tracks + 1):
+            file_path = album_dir / f"{track_number:02d}. Track {track_number}.mp3"
+            file_path.write_bytes(MP3_FRAME * 10)
+            file_info = mutagen.mp3.MP3(file_path)
+            file_info.add_tags()
+            file_info.tags.add(mutagen.id3.TPE1(encoding=mutagen.id3.Encoding.UTF8, text=artist))
+            file_info.tags.add(mutagen.id3.TPE2(encoding=mutagen.id3.Encoding.UTF8, text=artist))
+            file_info.tags.add(mutagen.id3.TALB(encoding=mutagen.id3.Encoding.UTF8, text=album))
+            file_info.tags.add(mutagen.id3.TRCK(encoding=mutagen.id3.Encoding.UTF8, text=str(track_number)))
+            file_info.save()
+
+
+def create_service(name: str, server: stubserver.StubServer, rate_limit_scale: float) -> services.BaseService:
+    """Create a service that points to the stub server.
+
+    :param name: The service name.
+    :param server: The stub server.
+    :param rate_limit_scale: The factor with which the service rate limit is multiplied.
+    :return: The service.
+    """
+    if name == 'lastfm':
+        service = services.LastFmService('key', api_root=server.api_root('lastfm'))
+    elif name == 'musicbrainz':
+        service = services.MusicbrainzService(
+            api_root=server.api_root('musicbrainz'), cover_art_root=server.api_root('coverartarchive'))
+    else:
+        service = services.DiscogsService('token', api_root=server.api_root('discogs'))
+    service.MIN_SECS_BETWEEN_REQUESTS = service.MIN_SECS_BETWEEN_REQUESTS * rate_limit_scale
+
+    return service
+
+
+def run_pipeline(pipeline: str, service: services.BaseService, input_dir: pathlib.Path, albums: int) -> float:
+    """Run a pipeline, and return its throughput.
+
+    :param pipeline: The pipeline, one of art, genre or both.
+    :param service: The service to use.
+    :param input_dir: The library directory.
+    :param albums: The number of albums in the library.
+    :return: The number of albums processed per second.
+    """
+    start = time.perf_counter()
+    if pipeline == 'art':
+        albumart.fetch_album_art(str(input_dir), service, force=True)
+    elif pipeline == 'genre':
+        genre.fetch_album_genre(str(input_dir), service, force=True)
+    else:
+        albumart.fetch_album_art(str(input_dir), service, force=True, fetch_genre=True)
+
+    return albums / (time.perf_counter() - start)
+
+
+def main():
+    """Main entry point of the script.
+    """
+    # Configure logging
+    logging.basicConfig(stream=sys.stdout, level=logging.WARNING)
+
+    # Parse arguments
+    parser = argparse.ArgumentParser(description="Benchmark the album art and genre pipelines")
+    parser.add_argument("--albums", type=int, default=20, help="The number of albums in the library")
+    parser.add_argument("--tracks", type=int, default=10, help="The number of tracks per album")
+    parser.add_argument("--latency", type=float, default=0.15, help="The latency of every response in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="The fraction of requests that fail with 503")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="The fraction of requests that fail with 429")
+    parser.add_argument("--rate-limit-scale", type=float, default=1.0,
+                        help="The factor with which the service rate limits are multiplied")
+    parser.add_argument("--seed", type=int, default=0, help="The seed for the simulated failures")
+    args = parser.parse_args()
+
+    config = stubserver.StubConfig(latency=args.latency, error_rate=args.error_rate,
+                                   throttle_rate=args.throttle_rate, seed=args.seed)
+    with tempfile.TemporaryDirectory() as library_dir, stubserver.StubServer(config) as server:
+        library_dir = pathlib.Path(library_dir)
+        create_library(library_dir, args.albums, args.tracks)
+        print(f"{'pipeline':<10} {'service':<12} {'albums/sec':>10}")
+        for pipeline, service_name in [('art', 'lastfm'), ('art', 'musicbrainz'), ('art', 'discogs'),
+                                       ('genre', 'discogs'), ('both', 'discogs')]:
+            service = create_service(service_name, server, args.rate_limit_scale)
+            try:
+                albums_per_sec = run_pipeline(pipeline, service, library_dir, args.albums)
+                print(f"{pipeline:<10} {service_name:<12} {albums_per_sec:>10.2f}")
+            except Exception as e:
+                print(f"{pipeline:<10} {service_name:<12} {'failed':>10}  {e!r}")
+        print(f"Requests served: {server.counters}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+"""A local HTTP server that stands in for the Last.fm, MusicBrainz, Cover Art Archive and Discogs APIs, replaying the
+recorded responses in the responses directory.
+
+The services can be pointed to the server by overriding their API roots:
+
+    with StubServer(StubConfig(latency=0.1, throttle_rate=0.05)) as server:
+        service = services.DiscogsService('token', api_root=server.api_root('discogs'))
+"""
+import argparse
+import dataclasses
+import http.server
+import io
+import json
+import logging
+import pathlib
+import random
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# The directory with the recorded responses
+RESPONSES_DIR = pathlib.Path(__file__).parent / 'responses'
+
+# The recorded response for each API path
+ROUTES = {
+    '/lastfm/2.0/': 'lastfm_album_getinfo.json',
+    '/musicbrainz/ws/2/release-group/': 'musicbrainz_release_group.json',
+    '/coverartarchive/release-group/': 'coverartarchive_release_group.json',
+    '/discogs/database/search': 'discogs_database_search.json',
+}
+
+# The API root of each service, relative to the server address
+API_ROOTS = {
+    'lastfm': '/lastfm/2.0/',
+    'musicbrainz': '/musicbrainz/ws/2/release-group/',
+    'coverartarchive': '/coverartarchive/release-group/',
+    'discogs': '/discogs',
+}
+
+
+@dataclasses.dataclass
+class StubConfig:
+    """Class holding the behaviour of the stub server
+    """
+    latency: float = 0.0
+    latency_jitter: float = 0.0
+    error_rate: float = 0.0
+    throttle_rate: float = 0.0
+    retry_after: int = 1
+    image_size: int = 600
+    seed: int = None
+
+
+class StubRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Handles the requests to the stub server
+    """
+    server: 'StubServer'
+
+    def do_GET(self):
+        """Handle a GET request.
+        """
+        config = self.server.config
+        url = urllib.parse.urlsplit(self.path)
+        params = {key: values[0] for key, values in urllib.parse.parse_qs(url.query).items()}
+        time.sleep(max(0.0, config.latency + self.server.random.uniform(-1, 1) * config.latency_jitter))
+        roll = self.server.random.random()
+        if roll < config.throttle_rate:
+            self.server.count('throttled')
+            self.send_response(429)
+            self.send_header('Retry-After', str(config.retry_after))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif roll < config.throttle_rate + config.error_rate:
+            self.server.count('errors')
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif url.path.startswith('/images/'):
+            self.server.count('images')
+            content_type = 'image/png' if url.path.endswith('.png') else 'image/jpeg'
+            self.send_content(self.server.image(content_type), content_type)
+        else:
+            for route, file_name in ROUTES.items():
+                if url.path.startswith(route):
+                    self.server.count('requests')
+                    release_group_id = url.path[len(route):] or str(uuid.uuid5(uuid.NAMESPACE_URL, url.query))
+                    self.send_content(self.server.response(file_name, {
+                        'artist': params.get('artist', ''),
+                        'album': params.get('album', params.get('release_title', '')),
+                        'release_group_id': release_group_id,
+                        'image_root': f"http://{self.headers['Host']}/images",
+                    }), 'application/json')
+                    break
+            else:
+                self.server.count('not_found')
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+    def send_content(self, content: bytes, content_type: str):
+        """Send a successful response.
+
+        :param content: The response content.
+        :param content_type: The response content type.
+        """
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format: str, *args):
+        """Log requests at debug level, instead of writing them to standard error.
+        """
+        logger.debug(format, *args)
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+    """The stub server. It is started in a background thread when used as a context manager.
+    """
+    daemon_threads = True
+
+    def __init__(self, config: StubConfig = None, port: int = 0):
+        """Create the stub server.
+
+        :param config: The server behaviour.
+        :param port: The port to listen to. If zero, a free port is selected.
+        """
+        super().__init__(('127.0.0.1', port), StubRequestHandler)
+        self.config = config or StubConfig()
+        self.random = random.Random(self.config.seed)
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._images = {}
+        self._thread = None
+
+    def __enter__(self) -> 'StubServer':
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+    @property
+    def url(self) -> str:
+        """The root URL of the server.
+        """
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def api_root(self, service: str) -> str:
+        """Return the API root URL that a service should use in order to point to the server.
+
+        :param service: The service, one of lastfm, musicbrainz, coverartarchive or discogs.
+        :return: The API root URL.
+        """
+        return self.url + API_ROOTS[service]
+
+    def count(self, counter: str):
+        """Increment a counter of the served requests.
+
+        :param counter: The counter name.
+        """
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + 1
+
+    def response(self, file_name: str, values: dict) -> bytes:
+        """Return a recorded response, with its placeholders replaced.
+
+        :param file_name: The file name of the recorded response.
+        :param values: The placeholder values.
+        :return: The response content.
+        """
+        content = (RESPONSES_DIR / file_name).read_text()
+        for key, value in values.items():
+            content = content.replace('{' + key + '}', json.dumps(value)[1:-1])
+
+        return content.encode()
+
+    def image(self, content_type: str) -> bytes:
+        """Return a generated image.
+
+        :param content_type: The image content type.
+        :return: The image content.
+        """
+        with self._lock:
+            if content_type not in self._images:
+                image = Image.linear_gradient('L').resize((self.config.image_size, self.config.image_size))
+                output = io.BytesIO()
+                image.convert('RGB').save(output, format='PNG' if content_type == 'image/png' else 'JPEG')
+                self._images[content_type] = output.getvalue()
+
+            return self._images[content_type]
+
+
+def main():
+    """Main entry point of the script.
+    """
+    # Configure logging
+    logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+
+    # Parse arguments
+    parser = argparse.ArgumentParser(description="Run a local stand-in for the service APIs")
+    parser.add_argument("--port", type=int, default=8000, help="The port to listen to")
+    parser.add_argument("--latency", type=float, default=0.0, help="The latency of every response in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="The fraction of requests that fail with 503")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="The fraction of requests that fail with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="The Retry-After value of throttled requests")
+    args = parser.parse_args()
+
+    server = StubServer(StubConfig(latency=args.latency, error_rate=args.error_rate,
+                                   throttle_rate=args.throttle_rate, retry_after=args.retry_after), args.port)
+    for service in API_ROOTS:
+        logger.info("%s API root: %s", service, server.api_root(service))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
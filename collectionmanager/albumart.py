@@ -1,33 +1,49 @@
 """Module to manage album art.
 """
 import argparse
-import itertools
+import contextlib
 import logging
 import os
 import pathlib
 import sys
 
-import mutagen.id3
-import mutagen.flac
-
-from collectionmanager import services
+from collectionmanager import artstore, db, profiling, services, tagwriter, walk
+from collectionmanager.services import metrics
 from collectionmanager.services import FileType
 
 logger = logging.getLogger(__name__)
 
 
-def clear_album_art(input_dir: str, force: bool = False):
+def create_service(name: str, api_key: str = None) -> services.BaseService:
+    """Create the service to fetch album art from.
+
+    :param name: The service name, one of lastfm, musicbrainz or discogs.
+    :param api_key: The API key for the service.
+    :return: The service.
+    """
+    if name == 'discogs':
+        return services.DiscogsService(api_key)
+    elif name == 'musicbrainz':
+        return services.MusicbrainzService()
+    else:
+        return services.LastFmService(api_key)
+
+
+def clear_album_art(input_dir: str, force: bool = False, writer: tagwriter.TagWriter = None, walk_jobs: int = None):
     """Clears album art for all files in a directory.
 
     :param input_dir: The file path.
     :param force: Set to true in order not to ask for user confirmation.
+    :param writer: The tag writer used to save the files. By default, a new tag writer.
+    :param walk_jobs: The number of directories listed in parallel. By default, walk.DEFAULT_JOBS.
     """
-    if not force:
-        response = input("Are you sure you want to clear all album art (y/n)? ")
-        if response == 'y':
-            logging.info("Clearing album art for all files in %s", input_dir)
-            scan_dir = pathlib.Path(input_dir)
-            for file_path in itertools.chain(scan_dir.rglob('*.flac'), scan_dir.rglob('*.mp3')):
+    if force or input("Are you sure you want to clear all album art (y/n)? ") == 'y':
+        logging.info("Clearing album art for all files in %s", input_dir)
+        scan_dir = pathlib.Path(input_dir)
+        with contextlib.nullcontext(writer) if writer else tagwriter.TagWriter() as writer:
+            for file_path in walk.audio_files(scan_dir, jobs=walk_jobs):
+                if writer.is_done(file_path):
+                    continue
                 track_info = services.TrackInfo.from_file(file_path)
                 if track_info.album_art:
                     logger.info("Clearing album art from file %s", file_path)
@@ -35,62 +51,89 @@ def clear_album_art(input_dir: str, force: bool = False):
                         track_info.file_info.pop('APIC:')
                     elif track_info.type == FileType.FLAC:
                         track_info.file_info.clear_pictures()
-                    track_info.file_info.save()
+                    writer.save(track_info.file_info)
 
 
-def fetch_album_art(input_dir: str, service, force: bool = False):
+def fetch_album_art(input_dir: str, service, force: bool = False, fetch_genre: bool = False,
+                    writer: tagwriter.TagWriter = None, walk_jobs: int = None):
     """Fetch album art for files in a directory.
 
     :param input_dir: The input directory.
     :param service: The service to use in order to fetch album art.
     :param force: Set to true in order to save the album art even if it exists.
+    :param fetch_genre: Set to true in order to also fetch the genre in the same pass, if it does not exist.
+    :param writer: The tag writer used to save the files. By default, a new tag writer.
+    :param walk_jobs: The number of directories listed in parallel. By default, walk.DEFAULT_JOBS.
     """
     logging.info("Fetching album art for all files in %s", input_dir)
     input_dir_path = pathlib.Path(input_dir)
-    for file_path in itertools.chain(input_dir_path.rglob('*.flac'), input_dir_path.rglob('*.mp3')):
-        track_info = services.TrackInfo.from_file(file_path)
-        if not track_info.album_art or force:
-            logging.info("Fetching album art for file %s", file_path)
+
+    def pending_album_art(writer: tagwriter.TagWriter):
+        for file_path in walk.audio_files(input_dir_path, jobs=walk_jobs):
+            if writer.is_done(file_path):
+                continue
+            track_info = services.TrackInfo.from_file(file_path)
+            future = None
+            if not track_info.album_art or force:
+                logging.info("Fetching album art for file %s", file_path)
+                artist = track_info.album_artist if track_info.album_artist else track_info.artist
+                future = service.album_art_async(artist, track_info.album)
+            yield (file_path, track_info), future
+
+    with contextlib.nullcontext(writer) if writer else tagwriter.TagWriter() as writer:
+        # The images are converted while the next files are read and their album art is fetched
+        for (file_path, track_info), album_art in services.base.resolve_in_order(pending_album_art(writer)):
             artist = track_info.album_artist if track_info.album_artist else track_info.artist
-            album_art = service.album_art(artist, track_info.album)
+            save = False
             if album_art:
-                if track_info.type == FileType.MP3:
-                    track_info.file_info.tags.add(mutagen.id3.APIC(
-                        encoding=mutagen.id3.Encoding.LATIN1, data=album_art, mime='image/jpeg',
-                        type=mutagen.id3.PictureType.COVER_FRONT)
-                    )
-                elif track_info.type == FileType.FLAC:
-                    image = mutagen.flac.Picture()
-                    image.mime = 'image/jpeg'
-                    image.data = album_art
-                    image.type = mutagen.id3.PictureType.COVER_FRONT
-                    track_info.file_info.clear_pictures()
-                    track_info.file_info.add_picture(image)
-                track_info.file_info.save()
-            else:
+                track_info.set_album_art(album_art)
+                save = True
+            elif not track_info.album_art or force:
                 logger.warning("Album art not found")
-
-
-def export_album_art(input_dir: str, service, output_dir: str, force: bool = False):
-    """Export album art to a directory.
+            if fetch_genre and (not track_info.genre or force):
+                logging.info("Fetching genre for file %s", file_path)
+                genre = service.genre(artist, track_info.album)
+                if genre:
+                    track_info.set_genre(genre)
+                    save = True
+            if save:
+                writer.save(track_info.file_info)
+
+
+def export_album_art(input_dir: str, service, output_dir: str, force: bool = False, store: artstore.ArtStore = None,
+                     walk_jobs: int = None):
+    """Export album art to a directory. The album art embedded in the tracks is used if it exists, otherwise it is
+    fetched from the service. Every image is added to the art store, and the album folders in the output directory get
+    a link to the stored image, so that identical images are stored once.
 
     :param input_dir: The input directory.
     :param service: The service to use in order to fetch album art.
-    :param output_dir:
+    :param output_dir: The output directory.
     :param force: Set to true in order to save the album art even if it exists.
-    :return:
+    :param store: The art store. By default, the art store next to the database.
+    :param walk_jobs: The number of directories listed in parallel. By default, walk.DEFAULT_JOBS.
     """
     logging.info("Exporting album art for all files in %s to directory %s", input_dir, output_dir)
-    for file_path in pathlib.Path(input_dir).glob('**/*.mp3'):
-        track_info = services.TrackInfo(str(file_path))
-        art_output_dir = pathlib.Path(output_dir) / track_info.album_artist / track_info.album
-        album_art_file = art_output_dir / "AlbumArt.jpg"
-        if not album_art_file.exists() or force:
-            album_art = service.album_art(track_info.album_artist, track_info.album)
-            if album_art:
-                art_output_dir.mkdir(parents=True, exist_ok=True)
-                with open(art_output_dir / "AlbumArt.jpg", "wb") as f:
-                    f.write(album_art)
+    store = store if store else artstore.ArtStore(artstore.default_store_path())
+    exported = set()
+    for file_path in walk.audio_files(input_dir, jobs=walk_jobs):
+        track_info = services.TrackInfo.from_file(file_path)
+        artist = track_info.album_artist if track_info.album_artist else track_info.artist
+        if not artist or not track_info.album or (artist, track_info.album) in exported:
+            continue
+        exported.add((artist, track_info.album))
+        art_output_dir = pathlib.Path(output_dir) / artist / track_info.album
+        if any(art_output_dir.glob('AlbumArt.*')) and not force:
+            continue
+        album_art = track_info.album_art
+        if not album_art:
+            data = service.album_art(artist, track_info.album)
+            album_art = services.AlbumArt('image/jpeg', data) if data else None
+        if album_art:
+            store.add(album_art)
+            store.link(album_art.digest, art_output_dir / "AlbumArt", force)
+        else:
+            logger.warning("Album art not found for artist %s and album %s", artist, track_info.album)
 
 
 def main():
@@ -104,25 +147,49 @@ def main():
     parser.add_argument("action", choices=["fetch", "export", "clear"], help="The action to perform")
     parser.add_argument("directory", help="The directory to scan for files")
     parser.add_argument("--force", action='store_true', help="Force the action")
+    parser.add_argument("--service", choices=["lastfm", "musicbrainz", "discogs"], default="lastfm",
+                        help="The service to fetch album art from")
     parser.add_argument("--api-key", help="The API key for the service")
+    parser.add_argument("--metrics", help="Write service metrics to this file, in the Prometheus text format if it has "
+                                          "a .prom extension, otherwise as JSON. Also written on SIGUSR1")
+    parser.add_argument("--genre", action='store_true', help="Also fetch the genre while fetching album art")
+    parser.add_argument("--max-size", type=int, help="Downscale album art so that no side exceeds this many pixels")
     parser.add_argument("--output", help="The output directory")
+    parser.add_argument("--store", help="The art store directory used when exporting. By default, next to the database")
+    tagwriter.add_arguments(parser)
+    profiling.add_arguments(parser)
+    walk.add_arguments(parser)
     args = parser.parse_args()
 
-    service = services.LastFmService(args.api_key)
+    service = create_service(args.service, args.api_key)
+    service.image_options.max_dimension = args.max_size
+    if args.genre and not hasattr(service, 'fetch_genre'):
+        logging.error("The %s service cannot fetch genres", args.service)
+        return
 
     if not os.path.isdir(args.directory):
         logging.error("%s is not a directory", args.directory)
         return
 
-    if args.action == 'fetch':
-        fetch_album_art(args.directory, service, args.force)
-    elif args.action == 'clear':
-        clear_album_art(args.directory, args.force)
-    elif args.action == 'export':
-        if args.output:
-            export_album_art(args.directory, service, args.output, args.force)
-        else:
-            print("You must specify an output directory")
+    with profiling.from_arguments(args):
+        if args.metrics:
+            metrics.REGISTRY.dump_on_signal(args.metrics)
+        try:
+            if args.action == 'fetch':
+                with tagwriter.from_arguments(args, db.saved_file_recorder()) as writer:
+                    fetch_album_art(args.directory, service, args.force, args.genre, writer, args.walk_jobs)
+            elif args.action == 'clear':
+                with tagwriter.from_arguments(args, db.saved_file_recorder()) as writer:
+                    clear_album_art(args.directory, args.force, writer, args.walk_jobs)
+            elif args.action == 'export':
+                if args.output:
+                    store = artstore.ArtStore(args.store) if args.store else None
+                    export_album_art(args.directory, service, args.output, args.force, store, args.walk_jobs)
+                else:
+                    print("You must specify an output directory")
+        finally:
+            if args.metrics:
+                metrics.REGISTRY.dump(args.metrics)
 
 
 if __name__ == '__main__':
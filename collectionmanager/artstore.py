@@ -0,0 +1,204 @@
+"""Content addressed store for album art. Every image is stored once, under its SHA-256 hash, no matter how many tracks
+embed it or how many album folders use it. Album folders get a hard link to the stored image, or a copy if the store is
+on another file system.
+"""
+import argparse
+import dataclasses
+import itertools
+import logging
+import os
+import pathlib
+import shutil
+import sys
+import uuid
+
+from PyQt5 import QtCore
+
+from collectionmanager import walk
+from collectionmanager.services import trackinfo
+
+logger = logging.getLogger(__name__)
+
+# The file extensions of the stored images, by MIME type
+EXTENSIONS = {
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+    'image/gif': '.gif',
+    'image/webp': '.webp',
+}
+
+# The extension of images with an unknown MIME type
+DEFAULT_EXTENSION = '.jpg'
+
+
+def default_store_path() -> pathlib.Path:
+    """Return the default location of the art store, next to the database.
+
+    :return: The art store directory path.
+    """
+    return pathlib.Path(QtCore.QStandardPaths.writableLocation(QtCore.QStandardPaths.AppDataLocation)) / 'art'
+
+
+@dataclasses.dataclass
+class ArtUsage:
+    """Class holding the usage of an image across the library
+    """
+    digest: str
+    size: int
+    tracks: int
+    albums: int
+
+    @property
+    def duplicate_bytes(self) -> int:
+        """The number of bytes taken by the copies of the image beyond the first.
+        """
+        return self.size * (self.tracks - 1)
+
+
+class ArtStore:
+    """A content addressed store of album art images. Images are stored in a directory per the first two characters of
+    their hash, in order to keep the directories small.
+    """
+    def __init__(self, root: str | pathlib.Path):
+        """Create the store.
+
+        :param root: The store directory. It is created if it does not exist.
+        """
+        self.root = pathlib.Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def find(self, digest: str) -> pathlib.Path | None:
+        """Return the path of a stored image.
+
+        :param digest: The image hash.
+        :return: The image path, or None if the image is not stored.
+        """
+        for extension in itertools.chain(EXTENSIONS.values(), [DEFAULT_EXTENSION]):
+            image_path = self.root / digest[:2] / f"{digest}{extension}"
+            if image_path.exists():
+                return image_path
+
+        return None
+
+    def add(self, album_art: trackinfo.AlbumArt) -> pathlib.Path:
+        """Add an image to the store, if it is not already stored.
+
+        :param album_art: The album art.
+        :return: The path of the stored image.
+        """
+        digest = album_art.digest
+        image_path = self.find(digest)
+        if image_path is not None:
+            return image_path
+        image_path = self.root / digest[:2] / f"{digest}{EXTENSIONS.get(album_art.mime, DEFAULT_EXTENSION)}"
+        image_path.parent.mkdir(exist_ok=True)
+        # Write to a temporary file first, so that a partially written image is never found in the store
+        temp_path = image_path.with_name(f".{image_path.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            temp_path.write_bytes(album_art.data)
+            os.replace(temp_path, image_path)
+        finally:
+            temp_path.unlink(missing_ok=True)
+        logger.debug("Stored image %s", image_path)
+
+        return image_path
+
+    def link(self, digest: str, target_path: pathlib.Path, force: bool = False) -> pathlib.Path:
+        """Make a stored image available at another path, with a hard link if possible and otherwise with a copy. The
+        extension of the stored image is added to the target path.
+
+        :param digest: The image hash.
+        :param target_path: The target path, without an extension.
+        :param force: Set to true in order to replace an existing file.
+        :return: The path of the linked image.
+        """
+        image_path = self.find(digest)
+        if image_path is None:
+            raise ValueError(f"Image {digest} is not stored")
+        target_path = target_path.with_suffix(image_path.suffix)
+        if target_path.exists():
+            if not force or target_path.samefile(image_path):
+                return target_path
+            target_path.unlink()
+        target_path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(image_path, target_path)
+        except OSError:
+            shutil.copyfile(image_path, target_path)
+
+        return target_path
+
+
+def import_album_art(input_dir: str, store: ArtStore) -> int:
+    """Add the album art embedded in the files of a directory to the art store.
+
+    :param input_dir: The input directory.
+    :param store: The art store.
+    :return: The number of distinct images found.
+    """
+    logging.info("Importing album art for all files in %s", input_dir)
+    input_dir_path = pathlib.Path(input_dir)
+    digests = set()
+    for file_path in walk.audio_files(input_dir_path):
+        track_info = trackinfo.TrackInfo.from_file(file_path)
+        if track_info.album_art and track_info.album_art.digest not in digests:
+            store.add(track_info.album_art)
+            digests.add(track_info.album_art.digest)
+
+    return len(digests)
+
+
+def print_report(usage: list[ArtUsage], top: int = 10):
+    """Print a report of the album art duplicated across the library.
+
+    :param usage: The usage of every image.
+    :param top: The number of images with the most duplicate bytes to list.
+    """
+    total_bytes = sum(image.size * image.tracks for image in usage)
+    unique_bytes = sum(image.size for image in usage)
+    print(f"Distinct images: {len(usage)}")
+    print(f"Tracks with album art: {sum(image.tracks for image in usage)}")
+    print(f"Embedded art bytes: {total_bytes}")
+    print(f"Unique art bytes: {unique_bytes}")
+    print(f"Duplicate art bytes: {total_bytes - unique_bytes}")
+    shared = [image for image in usage if image.albums > 1]
+    if shared:
+        print(f"Images shared by more than one album: {len(shared)}")
+    print()
+    print(f"{'hash':<16} {'size':>10} {'tracks':>7} {'albums':>7} {'duplicate bytes':>16}")
+    for image in sorted(usage, key=lambda image: image.duplicate_bytes, reverse=True)[:top]:
+        print(f"{image.digest[:16]:<16} {image.size:>10} {image.tracks:>7} {image.albums:>7} "
+              f"{image.duplicate_bytes:>16}")
+
+
+def main():
+    """Main entry point of the script.
+    """
+    # Configure logging
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    # Parse arguments
+    parser = argparse.ArgumentParser(description="Manage the album art store")
+    parser.add_argument("action", choices=["import", "report"], help="The action to perform")
+    parser.add_argument("directory", help="The directory to import album art from, or to report on. The report uses "
+                                          "the database, so the directory must have been scanned")
+    parser.add_argument("--store", help="The art store directory. By default, next to the database")
+    parser.add_argument("--top", type=int, default=10, help="The number of images to list in the report")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.directory):
+        logging.error("%s is not a directory", args.directory)
+        return
+
+    if args.action == 'import':
+        store = ArtStore(args.store if args.store else default_store_path())
+        images = import_album_art(args.directory, store)
+        logger.info("Imported %d distinct images to %s", images, store.root)
+    elif args.action == 'report':
+        # Imported here, as the database module depends on this one
+        from collectionmanager.db import database
+        print_report(database.Database().art_usage(args.directory), args.top)
+
+
+if __name__ == '__main__':
+    main()
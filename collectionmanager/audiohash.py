@@ -0,0 +1,91 @@
+"""Hashing of the audio payload of MP3 and FLAC files, without the ID3, APE and FLAC metadata, so that the same rip is
+recognised under different tags and paths.
+"""
+import hashlib
+import logging
+import os
+import pathlib
+import struct
+
+from collectionmanager import profiling, tagwriter
+
+logger = logging.getLogger(__name__)
+
+# The size of the chunks in which files are read
+CHUNK_SIZE = 1024 * 1024
+
+# The size of an APE tag header or footer
+APE_FOOTER_SIZE = 32
+
+# Set in the flags of an APE tag that has a header as well as a footer
+APE_HAS_HEADER = 0x80000000
+
+# The hash of a file whose audio could not be hashed. It is stored like a hash, so that the file is not hashed again
+# until it changes
+FAILED_HASH = ''
+
+
+def audio_region(file_path: str | pathlib.Path) -> tuple[int, int]:
+    """Return the start and the end of the audio payload of a file, skipping the ID3v2 tag and the FLAC metadata
+    blocks at the start of the file, and the APE and ID3v1 tags at the end of the file.
+
+    :param file_path: The file path.
+    :return: The offset of the first byte and of the byte after the last byte of the audio payload.
+    """
+    head_size, tail_size = tagwriter.tag_regions(file_path)
+    with open(file_path, 'rb') as f:
+        end = f.seek(0, os.SEEK_END) - tail_size
+        # The APE and ID3v1 tags can be found in either order, so strip them until neither is found
+        while True:
+            if end - head_size >= APE_FOOTER_SIZE:
+                f.seek(end - APE_FOOTER_SIZE)
+                footer = f.read(APE_FOOTER_SIZE)
+                if footer[:8] == b'APETAGEX':
+                    size, _, flags = struct.unpack('<III', footer[12:24])
+                    # The tag size includes the footer, so a smaller size means a corrupt tag
+                    if size < APE_FOOTER_SIZE:
+                        break
+                    end -= size + (APE_FOOTER_SIZE if flags & APE_HAS_HEADER else 0)
+                    continue
+            if end - head_size >= tagwriter.ID3V1_SIZE:
+                f.seek(end - tagwriter.ID3V1_SIZE)
+                if f.read(3) == b'TAG':
+                    end -= tagwriter.ID3V1_SIZE
+                    continue
+            break
+
+    return head_size, max(end, head_size)
+
+
+def audio_hash(file_path: str | pathlib.Path) -> str:
+    """Return the SHA-256 hash of the audio payload of a file, reading it in fixed size chunks.
+
+    :param file_path: The file path.
+    :return: The hash, as a hexadecimal string.
+    """
+    start, end = audio_region(file_path)
+    digest = hashlib.sha256()
+    with profiling.phase(profiling.AUDIO_HASH), open(file_path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = f.read(min(remaining, CHUNK_SIZE))
+            if not chunk:
+                break
+            digest.update(chunk)
+            remaining -= len(chunk)
+
+    return digest.hexdigest()
+
+
+def try_audio_hash(file_path: str | pathlib.Path) -> str:
+    """Return the hash of the audio payload of a file, logging any error.
+
+    :param file_path: The file path.
+    :return: The hash, or FAILED_HASH if the file could not be read.
+    """
+    try:
+        return audio_hash(file_path)
+    except OSError as e:
+        logger.warning("Could not hash the audio of %s: %s", file_path, e)
+        return FAILED_HASH
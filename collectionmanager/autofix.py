@@ -1,67 +1,271 @@
 import argparse
+import concurrent.futures
+import dataclasses
+import fnmatch
+import itertools
+import json
 import logging
 import os
+import pathlib
+import re
 import sys
+import typing
 
+import mutagen
 import mutagen.id3
 
-from collectionmanager import services
+from collectionmanager import db, profiling, services, tagwriter, walk
+from collectionmanager.services import FileType
 
 logger = logging.getLogger(__name__)
 
+# The number of files sent to a worker process at once
+CHUNK_SIZE = 64
+
+# The disk and track number at the start of a file name, such as 01 or 1-01
+FILE_NUMBER_PATTERN = re.compile(r'^\s*(?:(?P<disk_number>[0-9]+)-)?(?P<track_number>[0-9]+)')
+
+# The frame class and the text encoding of every fixed frame
+FRAMES = {
+    'TRCK': (mutagen.id3.TRCK, mutagen.id3.Encoding.LATIN1),
+    'TPOS': (mutagen.id3.TPOS, mutagen.id3.Encoding.LATIN1),
+    'TPE2': (mutagen.id3.TPE2, mutagen.id3.Encoding.UTF8),
+}
+
+# The fix rules
+RULES = ['track_number_missing', 'track_number_leading_zero', 'disk_number_missing', 'album_artist_missing']
+
+
+@dataclasses.dataclass
+class Fix:
+    """Class holding a proposed change to a frame of a file
+    """
+    file: str
+    rule: str
+    frame: str
+    old: str | None
+    new: str
+
+
+def frame_text(file_info, frame: str) -> str | None:
+    """Return the text of a frame of a file.
+
+    :param file_info: The mutagen file information.
+    :param frame: The frame name.
+    :return: The frame text, or None if the file does not have the frame.
+    """
+    return str(file_info[frame][0]) if frame in file_info else None
+
+
+def plan_file(file_path: pathlib.Path) -> list[Fix]:
+    """Compute the fixes of the track number, disk number and album artist of an MP3 file, without changing it.
+
+    :param file_path: The file path.
+    :return: The proposed fixes.
+    """
+    try:
+        track_info = services.TrackInfo.from_file(file_path)
+    except Exception as e:
+        logger.warning("Could not read %s: %s", file_path, e)
+        return []
+
+    return plan_track_info(file_path, track_info)
+
+
+def plan_track_info(file_path: pathlib.Path, track_info: services.TrackInfo) -> list[Fix]:
+    """Compute the fixes of the track number, disk number and album artist of an already read MP3 file.
+
+    :param file_path: The file path.
+    :param track_info: The track information of the file.
+    :return: The proposed fixes.
+    """
+    if track_info.type != FileType.MP3:
+        return []
+    fixes = []
+    file_numbers = FILE_NUMBER_PATTERN.match(file_path.name)
+    track_number_text = frame_text(track_info.file_info, 'TRCK')
+
+    # Check track number. A frame that has text is never replaced, even if its number cannot be parsed
+    if track_number_text and not track_info.number:
+        logger.warning("Track number %r of %s is not a number", track_number_text, file_path)
+    elif not track_info.number:
+        if file_numbers:
+            fixes.append(Fix(str(file_path), 'track_number_missing', 'TRCK', track_number_text,
+                             str(int(file_numbers.group('track_number')))))
+        else:
+            logger.warning("Track number missing from %s, and not found in the file name", file_path)
+    elif track_number_text.startswith('0'):
+        # Keep the total of the tracks, as in 03/12
+        _, separator, total = track_number_text.partition('/')
+        fixes.append(Fix(str(file_path), 'track_number_leading_zero', 'TRCK', track_number_text,
+                         str(track_info.number) + separator + total))
+
+    # Check for disk number
+    disk_number_text = frame_text(track_info.file_info, 'TPOS')
+    if disk_number_text and not track_info.disk_number:
+        logger.warning("Disk number %r of %s is not a number", disk_number_text, file_path)
+    elif not track_info.disk_number:
+        disk_number = file_numbers.group('disk_number') if file_numbers else None
+        fixes.append(Fix(str(file_path), 'disk_number_missing', 'TPOS', disk_number_text,
+                         str(int(disk_number)) if disk_number else '1'))
+
+    # Set the album artist
+    if not track_info.album_artist and track_info.artist:
+        fixes.append(Fix(str(file_path), 'album_artist_missing', 'TPE2', None, track_info.artist))
+
+    return fixes
+
+
+def plan_directory(scan_dir: str | pathlib.Path, jobs: int = None, walk_jobs: int = None) -> typing.Iterator[Fix]:
+    """Compute the fixes of the MP3 files in a directory in a process pool.
+
+    :param scan_dir: The directory.
+    :param jobs: The number of worker processes. If one, the files are read in the current process. By default, the
+        number of CPUs.
+    :param walk_jobs: The number of directories listed in parallel. By default, walk.DEFAULT_JOBS.
+    :return: An iterator over the proposed fixes, in the order of the file paths.
+    """
+    files = sorted(walk.audio_files(scan_dir, ('.mp3', ), walk_jobs))
+    if jobs == 1:
+        yield from itertools.chain.from_iterable(map(plan_file, files))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            yield from itertools.chain.from_iterable(executor.map(plan_file, files, chunksize=CHUNK_SIZE))
+
+
+def write_plan(fixes: typing.Iterable[Fix], output: typing.TextIO) -> int:
+    """Write a plan as JSON Lines, one fix per line.
+
+    :param fixes: The fixes.
+    :param output: The output stream.
+    :return: The number of fixes written.
+    """
+    count = 0
+    for fix in fixes:
+        output.write(json.dumps(dataclasses.asdict(fix), ensure_ascii=False) + '\n')
+        count += 1
+
+    return count
+
+
+def read_plan(plan_path: str | pathlib.Path) -> typing.Iterator[Fix]:
+    """Read a plan written by write_plan.
+
+    :param plan_path: The plan file path.
+    :return: An iterator over the fixes.
+    """
+    with open(plan_path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield Fix(**json.loads(line))
+
+
+def filter_plan(fixes: typing.Iterable[Fix], rules: list[str] = None,
+                include: list[str] = None) -> typing.Iterator[Fix]:
+    """Filter the fixes of a plan.
+
+    :param fixes: The fixes.
+    :param rules: The rules of the fixes to keep. By default, all rules.
+    :param include: Glob patterns of the file paths to keep. By default, all files.
+    :return: An iterator over the kept fixes.
+    """
+    for fix in fixes:
+        if rules and fix.rule not in rules:
+            continue
+        if include and not any(fnmatch.fnmatch(fix.file, pattern) for pattern in include):
+            continue
+        yield fix
+
+
+def apply_fixes(file_info, fixes: list[Fix]):
+    """Apply fixes to the frames of a file. The file is not saved.
+
+    :param file_info: The mutagen file information.
+    :param fixes: The fixes of the file.
+    """
+    for fix in fixes:
+        frame_class, encoding = FRAMES[fix.frame]
+        file_info[fix.frame] = frame_class(encoding=encoding, text=fix.new)
+
+
+def apply_plan(fixes: typing.Iterable[Fix], writer: tagwriter.TagWriter, dry_run: bool = False) -> int:
+    """Apply the fixes of a plan. The fixes of a file are expected to be consecutive, as written by plan_directory. A
+    file is skipped if it was already saved according to the journal of the writer, so that an interrupted run can be
+    resumed, or if its frames changed since the plan was computed.
+
+    :param fixes: The fixes.
+    :param writer: The tag writer used to save the files.
+    :param dry_run: Set to true in order to only log the fixes, without changing the files.
+    :return: The number of files fixed.
+    """
+    fixed = 0
+    for file, file_fixes in itertools.groupby(fixes, key=lambda fix: fix.file):
+        file_fixes = list(file_fixes)
+        if writer.is_done(file):
+            continue
+        for fix in file_fixes:
+            logger.info("%s: setting %s from %r to %r (%s)", file, fix.frame, fix.old, fix.new, fix.rule)
+        if dry_run:
+            fixed += 1
+            continue
+        try:
+            file_info = mutagen.File(file)
+        except Exception as e:
+            logger.error("Could not read %s: %s", file, e)
+            continue
+        stale = [fix for fix in file_fixes if frame_text(file_info, fix.frame) != fix.old]
+        if stale:
+            logger.warning("Skipping %s, as %s changed since the plan was computed", file,
+                           ', '.join(fix.frame for fix in stale))
+            continue
+        apply_fixes(file_info, file_fixes)
+        writer.save(file_info)
+        fixed += 1
+
+    return fixed
+
 
 def main():
     """Main entry point of the script.
     """
-    # Configure logging
-    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    # Configure logging, to the standard error so that a plan can be written to the standard output
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
 
     # Parse arguments
-    parser = argparse.ArgumentParser()
-    parser.add_argument("scan_dir", help="The directory to scan for files")
+    parser = argparse.ArgumentParser(description="Fix the track number, disk number and album artist of MP3 files")
+    parser.add_argument("action", choices=["plan", "apply", "fix"],
+                        help="Compute the fixes of a directory into a plan, apply a plan, or do both at once")
+    parser.add_argument("path", help="The directory to scan for files, or the plan file to apply")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="The number of files to read in parallel")
+    parser.add_argument("--output", help="The file to write the plan to. By default, the standard output")
+    parser.add_argument("--dry-run", action='store_true', help="Log the fixes without changing the files")
+    parser.add_argument("--rule", action='append', choices=RULES, help="Only apply the fixes of this rule")
+    parser.add_argument("--include", action='append', help="Only apply the fixes of the files matching this pattern")
+    tagwriter.add_arguments(parser)
+    profiling.add_arguments(parser)
+    walk.add_arguments(parser)
     args = parser.parse_args()
 
-    for current_root_name, _, files in os.walk(args.scan_dir):
-        for file_name in files:
-            file_path = os.path.join(current_root_name, file_name)
-            track_info = services.TrackInfo(str(file_path))
-            save = False
-
-            # Check track number
-            if not track_info.number:
-                logger.info("Track number missing from %s, setting.", file_path)
-                file_track_info = file_name[:file_name.find('.')].strip()
-                track_number = int(file_track_info[file_track_info.find('-') - 1:])
-                logger.info("Track number will be set to %d.", track_number)
-                track_info.file_info['TRCK'] = mutagen.id3.TRCK(
-                    encoding=mutagen.id3.Encoding.LATIN1, text=str(track_number))
-                save = True
-            elif track_info.number.startswith('0'):
-                logger.info("Track number for %s contains a leading zero, stripping.", file_path)
-                track_number = int(track_info.file_info['TRCK'][0])
-                track_info.file_info['TRCK'] = mutagen.id3.TRCK(
-                    encoding=mutagen.id3.Encoding.LATIN1, text=str(track_number))
-                save = True
-
-            # Check for disk number
-            if not track_info.disk_number:
-                logger.info("Disc number missing from %s, setting.", file_path)
-                file_track_info = file_name[:file_name.find('.')].strip()
-                disc_number_str = file_track_info[:file_track_info.find('-') + 1].strip()
-                disc_number = int(disc_number_str) if disc_number_str else 1
-                track_info.file_info['TPOS'] = mutagen.id3.TPOS(
-                    encoding=mutagen.id3.Encoding.LATIN1, text=str(disc_number))
-                save = True
-
-            # Set the album artist
-            if not track_info.album_artist:
-                logger.info("Album artist missing from %s, setting.", file_path)
-                track_info.file_info['TPE2'] = mutagen.id3.TPE2(
-                    encoding=mutagen.id3.Encoding.UTF8, text=str(track_info.artist))
-                save = True
-
-            if save:
-                track_info.file_info.save()
+    with profiling.from_arguments(args):
+        if args.action == 'plan':
+            if not os.path.isdir(args.path):
+                logging.error("%s is not a directory", args.path)
+                return
+            fixes = plan_directory(args.path, args.jobs, args.walk_jobs)
+            if args.output:
+                with open(args.output, 'w', encoding='utf-8') as output:
+                    count = write_plan(fixes, output)
+                logger.info("Wrote %d fixes to %s", count, args.output)
+            else:
+                write_plan(fixes, sys.stdout)
+        else:
+            if args.action == 'apply':
+                fixes = read_plan(args.path)
+            else:
+                fixes = plan_directory(args.path, args.jobs, args.walk_jobs)
+            with tagwriter.from_arguments(args, db.saved_file_recorder()) as writer:
+                fixed = apply_plan(filter_plan(fixes, args.rule, args.include), writer, args.dry_run)
+            logger.info("%s %d files", "Would fix" if args.dry_run else "Fixed", fixed)
 
 
 if __name__ == '__main__':
@@ -1,10 +1,20 @@
 import argparse
+import collections
+import concurrent.futures
+import csv
+import dataclasses
+import datetime
+import functools
 import itertools
+import json
 import logging
+import os
 import pathlib
 import re
 import sys
+import typing
 
+from collectionmanager import db, profiling, walk
 from collectionmanager.services import trackinfo
 
 # Logger for this module
@@ -28,7 +38,17 @@ COMPILATION_FILE_NAME_PATTERN = re.compile(
     r'\[(?P<year>[0-9]{4})] (?P<album>[^/]+?)/'
     r'(?P<disk_number>[0-9]?)-?(?P<track_number>[0-9]{2})\. (?P<artist>.+?) - (?P<title>.+).(?P<type>mp3|flac)')
 
+# The number of files sent to a worker process at once
+CHUNK_SIZE = 64
 
+# The version of the check rules. Increment it when the rules change, in order to invalidate cached findings
+RULES_VERSION = 3
+
+# The number of cached findings saved to the database at once
+CACHE_BATCH_SIZE = 1000
+
+
+@functools.lru_cache(maxsize=65536)
 def check_capitalisation(name: str) -> bool:
     """Check if the first letter of every word is a capital letter.
 
@@ -52,49 +72,92 @@ def replace_unsafe_chars(string: str) -> str:
     return UNSAFE_CHARACTERS.sub(UNSAFE_CHARACTERS_REPLACE, string)
 
 
-def check_file(scan_dir: pathlib.Path, file: pathlib.Path, check_album_art: bool = True):
-    """Check if the file contains usafe characters.
+def album_order(file: pathlib.Path) -> tuple[pathlib.Path, str]:
+    """Sort key that orders files by directory, so that the files of an album directory are consecutive. Ordering by
+    path alone puts the files of a subdirectory between the files of its parent directory.
+
+    :param file: The file path.
+    :return: The sort key.
+    """
+    return file.parent, file.name
+
+
+@dataclasses.dataclass
+class Finding:
+    """Class holding a problem found while checking a file
+    """
+    file: str
+    rule: str
+    expected: typing.Any = None
+    actual: typing.Any = None
+    status: str = None
+
+
+def check_file(scan_dir: pathlib.Path, file: pathlib.Path, check_album_art: bool = True) -> list[Finding]:
+    """Check a file for problems with its tags and its naming.
 
     :param scan_dir: The scan directory.
     :param file: The file to check.
     :param check_album_art: Set to true to check for album art existence.
+    :return: The problems found.
+    """
+    return check_file_result(scan_dir, file, check_album_art).findings
+
+
+def check_path(scan_dir: pathlib.Path, file: pathlib.Path) -> list[Finding]:
+    """Check if the path of a file contains unsafe characters.
+
+    :param scan_dir: The scan directory.
+    :param file: The file to check.
+    :return: The problems found.
     """
-    logger.info("Checking file '%s", file)
-    for part in file.relative_to(scan_dir).parts:
-        if UNSAFE_CHARACTERS.findall(part):
-            logger.warning(f"'%s' contains unsafe file name characters", file)
-    # Parse track information
-    track_info = trackinfo.TrackInfo.from_file(pathlib.Path(file))
+    return [
+        Finding(str(file), 'unsafe_characters', replace_unsafe_chars(part), part)
+        for part in file.relative_to(scan_dir).parts if UNSAFE_CHARACTERS.findall(part)
+    ]
+
+
+def check_track_info(scan_dir: pathlib.Path, file: pathlib.Path, track_info: trackinfo.TrackInfo,
+                     check_album_art: bool = True) -> list[Finding]:
+    """Check the track information of a file, and the naming of the file against it.
+
+    :param scan_dir: The scan directory.
+    :param file: The file to check.
+    :param track_info: The track information of the file.
+    :param check_album_art: Set to true to check for album art existence.
+    :return: The problems found.
+    """
+    findings = check_path(scan_dir, file)
 
     # Check track artist
     if not track_info.artist:
-        logger.warning("Artist info is missing for file '%s", file)
+        findings.append(Finding(str(file), 'artist_missing'))
     elif not check_capitalisation(track_info.artist):
-        logger.warning("Artist info capitalization is wrong for file '%s': %s", file, track_info.artist)
+        findings.append(Finding(str(file), 'artist_capitalisation', actual=track_info.artist))
 
     # Check track album
     if not track_info.album:
-        logger.warning("Track album info is missing for file '%s", file)
+        findings.append(Finding(str(file), 'album_missing'))
     elif not check_capitalisation(track_info.album):
-        logger.warning("Track album info capitalization is wrong for file '%s': %s", file, track_info.album)
+        findings.append(Finding(str(file), 'album_capitalisation', actual=track_info.album))
 
     # Check track year
     if not track_info.year:
-        logger.warning("Track year info is missing for file '%s", file)
+        findings.append(Finding(str(file), 'year_missing'))
 
     # Check track number
     if not track_info.number:
-        logger.warning("Track number info is missing for file '%s", file)
+        findings.append(Finding(str(file), 'number_missing'))
 
     # Check track title
     if not track_info.title:
-        logger.warning("Track title info is missing for file '%s", file)
+        findings.append(Finding(str(file), 'title_missing'))
     elif not check_capitalisation(track_info.title):
-        logger.warning("Track title info capitalization is wrong for file '%s': %s", file, track_info.title)
+        findings.append(Finding(str(file), 'title_capitalisation', actual=track_info.title))
 
     # Check album art
     if check_album_art and not track_info.album_art:
-        logger.warning("Album art is missing for file '%s", file)
+        findings.append(Finding(str(file), 'album_art_missing'))
 
     # Check naming conventions
     relative_file_name = str(file.relative_to(file.parent.parent.parent))
@@ -103,54 +166,482 @@ def check_file(scan_dir: pathlib.Path, file: pathlib.Path, check_album_art: bool
     if match:
         # Check track year
         if track_info.year and int(match.group('year')) != track_info.year:
-            logger.warning("File name year does not match file info for file '%s', should be '%s', is '%s'",
-                           file, track_info.year, match.group('year'))
+            findings.append(Finding(str(file), 'file_name_year', track_info.year, int(match.group('year'))))
         # Check track album
         if track_info.album and match.group('album') != replace_unsafe_chars(track_info.album):
-            logger.warning("File name album does not match file info for file '%s', should be '%s', is '%s'",
-                           file, replace_unsafe_chars(track_info.album), match.group('album'))
+            findings.append(Finding(
+                str(file), 'file_name_album', replace_unsafe_chars(track_info.album), match.group('album')))
         # Check track artist
         if track_info.artist and match.group('artist') != replace_unsafe_chars(track_info.artist):
-            logger.warning("File name artist does not match file info for file '%s', should be '%s', is '%s'",
-                           file, replace_unsafe_chars(track_info.artist), match.group('artist'))
+            findings.append(Finding(
+                str(file), 'file_name_artist', replace_unsafe_chars(track_info.artist), match.group('artist')))
         # Check disk number
         if match.group('disk_number'):
             if not track_info.disk_number or int(match.group('disk_number')) != track_info.disk_number:
-                logger.warning("File name disk number does not match file info for file '%s', should be '%s', is '%s'",
-                               file, track_info.disk_number, match.group('disk_number'))
+                findings.append(Finding(
+                    str(file), 'file_name_disk_number', track_info.disk_number, int(match.group('disk_number'))))
         # Check track number
         if track_info.number and int(match.group('track_number')) != track_info.number:
-            logger.warning("File name track number does not match file info for file '%s', should be '%s', is '%s'",
-                           file, track_info.number, match.group('track_number'))
+            findings.append(Finding(
+                str(file), 'file_name_track_number', track_info.number, int(match.group('track_number'))))
         # Check track title
         if track_info.title and match.group('title') != replace_unsafe_chars(track_info.title):
-            logger.warning("File name title does not match file info for file '%s', should be '%s', is '%s'",
-                           file, replace_unsafe_chars(track_info.title), match.group('title'))
+            findings.append(Finding(
+                str(file), 'file_name_title', replace_unsafe_chars(track_info.title), match.group('title')))
 
         if track_info.compilation:
             # Check track album artist
             if track_info.album_artist and match.group('album_artist') != replace_unsafe_chars(track_info.album_artist):
-                logger.warning("File name artist does not match file info for file '%s', should be '%s', is '%s'",
-                               file, replace_unsafe_chars(track_info.album_artist), match.group('album_artist'))
+                findings.append(Finding(str(file), 'file_name_album_artist',
+                                        replace_unsafe_chars(track_info.album_artist), match.group('album_artist')))
+    else:
+        findings.append(Finding(str(file), 'file_name_pattern', actual=relative_file_name))
+
+    return findings
+
+
+@dataclasses.dataclass
+class FileResult:
+    """Class holding the result of checking a file. The track information is kept without the album art content and
+    the mutagen file information, so that it can be cheaply passed between processes and used by the album rules.
+    """
+    file: pathlib.Path
+    findings: list[Finding]
+    track_info: trackinfo.TrackInfo = None
+    changed: bool = True
+
+
+def summarize_track_info(track_info: trackinfo.TrackInfo) -> trackinfo.TrackInfo:
+    """Return a copy of the track information without the album art content and the mutagen file information.
+
+    :param track_info: The track information.
+    :return: The track information summary.
+    """
+    album_art = trackinfo.AlbumArt(track_info.album_art.mime, b'') if track_info.album_art else None
+
+    return dataclasses.replace(track_info, file_info=None, album_art=album_art)
+
+
+def track_info_to_json(track_info: trackinfo.TrackInfo) -> typing.Optional[dict]:
+    """Convert a track information summary to a JSON serializable dictionary.
+
+    :param track_info: The track information summary.
+    :return: The dictionary.
+    """
+    if track_info is None:
+        return None
+
+    return {
+        field.name: getattr(track_info, field.name) for field in dataclasses.fields(track_info)
+        if field.name not in ('file_info', 'album_art')
+    } | {'album_art': track_info.album_art is not None}
+
+
+def track_info_from_json(data: typing.Optional[dict]) -> typing.Optional[trackinfo.TrackInfo]:
+    """Convert a dictionary created by track_info_to_json back to a track information summary.
+
+    :param data: The dictionary.
+    :return: The track information summary.
+    """
+    if data is None:
+        return None
+
+    return trackinfo.TrackInfo(**(data | {'album_art': trackinfo.AlbumArt(None, b'') if data['album_art'] else None}))
+
+
+def check_file_result(scan_dir: pathlib.Path, file: pathlib.Path, check_album_art: bool = True) -> FileResult:
+    """Check a file, and keep its track information for the album rules.
+
+    :param scan_dir: The scan directory.
+    :param file: The file to check.
+    :param check_album_art: Set to true to check for album art existence.
+    :return: The result of checking the file.
+    """
+    logger.info("Checking file '%s'", file)
+    try:
+        track_info = trackinfo.TrackInfo.from_file(pathlib.Path(file))
+    except Exception as e:
+        return FileResult(file, check_path(scan_dir, file) + [Finding(str(file), 'unreadable', actual=str(e))])
+
+    return FileResult(file, check_track_info(scan_dir, file, track_info, check_album_art),
+                      summarize_track_info(track_info))
+
+
+def check_files(scan_dir: pathlib.Path, files: typing.Iterable[pathlib.Path], check_album_art: bool = True,
+                jobs: int = None) -> typing.Iterator[FileResult]:
+    """Check files in a process pool. The results are returned in the order of the files, regardless of the order in
+    which the files finish.
+
+    :param scan_dir: The scan directory.
+    :param files: The files to check.
+    :param check_album_art: Set to true to check for album art existence.
+    :param jobs: The number of worker processes. If one, the files are checked in the current process. By default, the
+        number of CPUs.
+    :return: An iterator over the result of each file.
+    """
+    check = functools.partial(check_file_result, scan_dir, check_album_art=check_album_art)
+    if jobs == 1:
+        yield from map(check, files)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            yield from executor.map(check, files, chunksize=CHUNK_SIZE)
+
+
+def has_album_art(file: pathlib.Path) -> bool:
+    """Check if a file has embedded album art.
+
+    :param file: The file.
+    :return: True if the file has album art.
+    """
+    try:
+        return trackinfo.TrackInfo.from_file(file).album_art is not None
+    except Exception:
+        return False
+
+
+def check_database(database: db.Database, scan_dir: pathlib.Path, check_album_art: bool = True,
+                   jobs: int = None) -> typing.Iterator[FileResult]:
+    """Check the tracks under a directory using the tag information stored in the database, so that files are only
+    read for the checks that need their contents. The findings are as current as the last scan of the directory.
+
+    :param database: The database.
+    :param scan_dir: The scan directory.
+    :param check_album_art: Set to true to check for album art existence. The files are only read for the tracks that
+        were scanned before the album art was recorded in the database.
+    :param jobs: The number of worker processes used to read the files.
+    :return: An iterator over the result of each file, with the files of every directory consecutive.
+    """
+    rows = database.track_tag_rows(str(scan_dir))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        # The rows are streamed in batches, and the files of a batch whose album art is not recorded are read together
+        while batch := list(itertools.islice(rows, db.QUERY_BATCH_SIZE)):
+            yield from _check_rows(scan_dir, batch, check_album_art, jobs, executor)
+
+
+def _check_rows(scan_dir: pathlib.Path, rows: list, check_album_art: bool, jobs: int,
+                executor: concurrent.futures.Executor) -> typing.Iterator[FileResult]:
+    """Check the tracks of a batch of database rows.
+
+    :param scan_dir: The scan directory.
+    :param rows: The rows, as returned by Database.track_tag_rows.
+    :param check_album_art: Set to true to check for album art existence.
+    :param jobs: The number of worker processes used to read the files. If one, the files are read in this process.
+    :param executor: The process pool used to read the files.
+    :return: An iterator over the result of each file.
+    """
+    files = [pathlib.Path(row.path) for row in rows]
+    unknown_art = [file for row, file in zip(rows, files) if row.art_size is None] if check_album_art else []
+    if jobs == 1:
+        album_art = map(has_album_art, unknown_art)
+    else:
+        album_art = executor.map(has_album_art, unknown_art, chunksize=CHUNK_SIZE)
+    for row, file in zip(rows, files):
+        if not check_album_art:
+            file_has_album_art = False
+        elif row.art_size is None:
+            file_has_album_art = next(album_art)
+        else:
+            file_has_album_art = row.art_hash is not None
+        # The album art content is not needed by the checks, only its existence
+        track_info = trackinfo.TrackInfo(
+            artist=row.artist, album_artist=row.album_artist, album=row.album, year=row.year,
+            disk_number=row.disk_number, title=row.title, number=row.number, compilation=bool(row.compilation),
+            album_art=trackinfo.AlbumArt(mime=None, data=b'') if file_has_album_art else None)
+        yield FileResult(file, check_track_info(scan_dir, file, track_info, check_album_art=check_album_art),
+                         track_info)
+
+
+def check_files_cached(database: db.Database, scan_dir: pathlib.Path, walked_files: list[walk.WalkedFile],
+                       check_album_art: bool = True, jobs: int = None,
+                       changed_only: bool = False) -> typing.Iterator[FileResult]:
+    """Check files, reusing the cached results of the files whose size and modification time have not changed since
+    they were last checked with the same rules.
+
+    :param database: The database where the results are cached.
+    :param scan_dir: The scan directory.
+    :param walked_files: The files to check, with the stat results recorded by the walk.
+    :param check_album_art: Set to true to check for album art existence.
+    :param jobs: The number of worker processes.
+    :param changed_only: Set to true in order to only return the findings that are new or resolved since the previous
+        check, with their status set accordingly.
+    :return: An iterator over the result of each file. Files removed since the previous check are returned last.
+    """
+    rules_version = f"{RULES_VERSION}:{int(check_album_art)}"
+    cached = database.check_results(str(scan_dir))
+    stats = {walked_file.path: walked_file.stat for walked_file in walked_files}
+    files = list(stats)
+
+    def is_cached(checked_file: pathlib.Path) -> bool:
+        check_result = cached.get(str(checked_file))
+        stat = stats[checked_file]
+        return check_result is not None and check_result.rules_version == rules_version and \
+            check_result.size == stat.st_size and check_result.mtime_ns == stat.st_mtime_ns
+
+    def previous_findings(checked_file: pathlib.Path) -> list[Finding]:
+        check_result = cached.get(str(checked_file))
+        if check_result is None or check_result.rules_version != rules_version:
+            return []
+        return [Finding(str(checked_file), *finding) for finding in check_result.findings]
+
+    to_check = [file for file in files if not is_cached(file)]
+    logger.info("%d of %d files changed since they were last checked", len(to_check), len(files))
+    results = check_files(scan_dir, to_check, check_album_art=check_album_art, jobs=jobs)
+    check_results = []
+    for file in files:
+        if is_cached(file):
+            yield FileResult(file, [] if changed_only else previous_findings(file),
+                             track_info_from_json(cached[str(file)].track_info), changed=False)
+            continue
+        result = next(results)
+        check_results.append({
+            'path': str(file), 'size': stats[file].st_size, 'mtime_ns': stats[file].st_mtime_ns,
+            'rules_version': rules_version, 'last_checked': datetime.datetime.now(),
+            'findings': [[finding.rule, finding.expected, finding.actual] for finding in result.findings],
+            'track_info': track_info_to_json(result.track_info),
+        })
+        if len(check_results) >= CACHE_BATCH_SIZE:
+            database.save_check_results(check_results)
+            check_results = []
+        if changed_only:
+            previous = previous_findings(file)
+            result.findings = [
+                dataclasses.replace(finding, status='new') for finding in result.findings if finding not in previous
+            ] + [
+                dataclasses.replace(finding, status='resolved') for finding in previous
+                if finding not in result.findings
+            ]
+        yield result
+    database.save_check_results(check_results)
+
+    # Files that were removed since the previous check resolve their findings
+    removed = sorted(set(cached) - {str(file) for file in files})
+    if changed_only:
+        for path in removed:
+            yield FileResult(pathlib.Path(path), [
+                dataclasses.replace(finding, status='resolved') for finding in previous_findings(pathlib.Path(path))
+            ])
+    database.delete_check_results(removed)
+
+
+# The album rules. Every rule is called with the album directory and the track information of the files in it, and
+# returns the problems found
+ALBUM_RULES: list[typing.Callable[[pathlib.Path, list[trackinfo.TrackInfo]], list[Finding]]] = []
+
+
+def album_rule(rule: typing.Callable[[pathlib.Path, list[trackinfo.TrackInfo]], list[Finding]]):
+    """Decorator that registers an album rule.
+
+    :param rule: The rule.
+    :return: The rule.
+    """
+    ALBUM_RULES.append(rule)
+
+    return rule
+
+
+def most_common(values: typing.Iterable) -> typing.Any:
+    """Return the most common value, preferring the smallest value in case of ties.
+
+    :param values: The values.
+    :return: The most common value.
+    """
+    counts = collections.Counter(values)
+
+    return min(counts, key=lambda value: (-counts[value], str(value)))
+
+
+@album_rule
+def check_album_year(album_dir: pathlib.Path, tracks: list[trackinfo.TrackInfo]) -> list[Finding]:
+    """Check that all tracks of an album have the same year.
+    """
+    years = [track.year for track in tracks if track.year]
+    if len(set(years)) > 1:
+        return [Finding(str(album_dir), 'album_year_mixed', most_common(years), sorted(set(years)))]
+
+    return []
+
+
+@album_rule
+def check_album_artist(album_dir: pathlib.Path, tracks: list[trackinfo.TrackInfo]) -> list[Finding]:
+    """Check that all tracks of an album have the same album artist.
+    """
+    album_artists = [track.album_artist or '' for track in tracks]
+    if len(set(album_artists)) > 1:
+        return [Finding(str(album_dir), 'album_artist_mixed', most_common(album_artists),
+                        sorted(set(album_artists)))]
+
+    return []
+
+
+@album_rule
+def check_album_name(album_dir: pathlib.Path, tracks: list[trackinfo.TrackInfo]) -> list[Finding]:
+    """Check that all tracks of an album have the same album name.
+    """
+    albums = [track.album or '' for track in tracks]
+    if len(set(albums)) > 1:
+        return [Finding(str(album_dir), 'album_name_mixed', most_common(albums), sorted(set(albums)))]
+
+    return []
+
+
+@album_rule
+def check_album_disk_numbers(album_dir: pathlib.Path, tracks: list[trackinfo.TrackInfo]) -> list[Finding]:
+    """Check that either all or none of the tracks of an album have a disk number, and that the disk numbers start
+    from one without gaps.
+    """
+    disk_numbers = {track.disk_number for track in tracks}
+    if None in disk_numbers and len(disk_numbers) > 1:
+        return [Finding(str(album_dir), 'disk_number_inconsistent', 'all tracks',
+                        sum(1 for track in tracks if track.disk_number))]
+    disk_numbers.discard(None)
+    if disk_numbers and disk_numbers != set(range(1, max(disk_numbers) + 1)):
+        return [Finding(str(album_dir), 'disk_number_gap', list(range(1, max(disk_numbers) + 1)),
+                        sorted(disk_numbers))]
+
+    return []
+
+
+@album_rule
+def check_album_track_numbers(album_dir: pathlib.Path, tracks: list[trackinfo.TrackInfo]) -> list[Finding]:
+    """Check that the track numbers of every disk of an album start from one, without gaps or duplicates. The expected
+    and actual track numbers are reported per disk number.
+    """
+    disks = collections.defaultdict(list)
+    for track in tracks:
+        if track.number:
+            disks[track.disk_number or 1].append(track.number)
+    findings = []
+    duplicates = {
+        disk_number: sorted(numbers) for disk_number, numbers in sorted(disks.items())
+        if len(set(numbers)) < len(numbers)
+    }
+    if duplicates:
+        findings.append(Finding(str(album_dir), 'track_number_duplicate', {
+            disk_number: sorted(set(numbers)) for disk_number, numbers in duplicates.items()
+        }, duplicates))
+    gaps = {
+        disk_number: sorted(set(numbers)) for disk_number, numbers in sorted(disks.items())
+        if len(set(numbers)) < max(numbers)
+    }
+    if gaps:
+        findings.append(Finding(str(album_dir), 'track_number_gap', {
+            disk_number: list(range(1, max(numbers) + 1)) for disk_number, numbers in gaps.items()
+        }, gaps))
+
+    return findings
+
+
+@album_rule
+def check_album_art_consistency(album_dir: pathlib.Path, tracks: list[trackinfo.TrackInfo]) -> list[Finding]:
+    """Check that either all or none of the tracks of an album have album art.
+    """
+    with_album_art = sum(1 for track in tracks if track.album_art)
+    if 0 < with_album_art < len(tracks):
+        return [Finding(str(album_dir), 'album_art_partial', len(tracks), with_album_art)]
+
+    return []
+
+
+def check_album(album_dir: pathlib.Path, tracks: list[trackinfo.TrackInfo]) -> list[Finding]:
+    """Evaluate all album rules for an album.
+
+    :param album_dir: The album directory.
+    :param tracks: The track information of the files in the album directory.
+    :return: The problems found.
+    """
+    return [finding for rule in ALBUM_RULES for finding in rule(album_dir, tracks)]
+
+
+def check_albums(results: typing.Iterable[FileResult], changed_only: bool = False) -> typing.Iterator[Finding]:
+    """Return the findings of the file results, followed after the files of every album directory by the findings of
+    the album rules for it. The files of an album directory are expected to be consecutive, as when they are sorted with
+    album_order, so that the albums are evaluated in a single pass.
+
+    :param results: The file results.
+    :param changed_only: Set to true in order to only evaluate the albums that contain changed files. The findings of
+        these albums are returned with their status set to current.
+    :return: An iterator over the findings.
+    """
+    for album_dir, album_results in itertools.groupby(results, key=lambda result: result.file.parent):
+        tracks = []
+        changed = False
+        for result in album_results:
+            yield from result.findings
+            changed = changed or result.changed
+            if result.track_info is not None:
+                tracks.append(result.track_info)
+        if tracks and (changed or not changed_only):
+            findings = check_album(album_dir, tracks)
+            yield from (dataclasses.replace(finding, status='current') for finding in findings) if changed_only \
+                else findings
+
+
+def write_findings(findings: typing.Iterable[Finding], output: typing.TextIO, output_format: str = 'jsonl'):
+    """Write findings as JSON Lines or CSV.
+
+    :param findings: The findings.
+    :param output: The output stream.
+    :param output_format: The output format, either jsonl or csv.
+    """
+    if output_format == 'csv':
+        writer = csv.DictWriter(output, fieldnames=[field.name for field in dataclasses.fields(Finding)])
+        writer.writeheader()
+        for finding in findings:
+            writer.writerow({
+                key: json.dumps(value, ensure_ascii=False) if isinstance(value, (list, dict)) else value
+                for key, value in dataclasses.asdict(finding).items()
+            })
     else:
-        logger.warning("File name '%s' does not match naming conventions", file)
+        for finding in findings:
+            output.write(json.dumps(dataclasses.asdict(finding), ensure_ascii=False) + '\n')
 
 
 def main():
     """Main entry point of the script.
     """
     # Configure logging
-    logging.basicConfig(stream=sys.stdout, level=logging.WARN)
+    logging.basicConfig(stream=sys.stderr, level=logging.WARN)
 
     # Parse arguments
     parser = argparse.ArgumentParser()
     parser.add_argument("scan_dir", help="The directory to scan for files")
     parser.add_argument("--check-album-art", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="The number of files to check in parallel")
+    parser.add_argument("--format", choices=["jsonl", "csv"], default="jsonl", help="The output format")
+    parser.add_argument("--output", help="The file to write the findings to. By default, the standard output")
+    parser.add_argument("--cache", action=argparse.BooleanOptionalAction, default=True,
+                        help="Reuse the findings of files that did not change since they were last checked")
+    parser.add_argument("--changed-only", action='store_true',
+                        help="Only report findings that are new or resolved since the previous check")
+    parser.add_argument("--database", action='store_true',
+                        help="Check the tag information stored in the database by the last scan, instead of reading "
+                             "the files")
+    parser.add_argument("--album-rules", action=argparse.BooleanOptionalAction, default=True,
+                        help="Check the consistency of the tracks of every album directory")
+    profiling.add_arguments(parser)
+    walk.add_arguments(parser)
     args = parser.parse_args()
 
-    scan_dir = pathlib.Path(args.scan_dir)
-    for file in itertools.chain(scan_dir.rglob('*.flac'), scan_dir.rglob('*.mp3')):
-        check_file(scan_dir=scan_dir, file=file, check_album_art=args.check_album_art)
+    with profiling.from_arguments(args):
+        scan_dir = pathlib.Path(args.scan_dir).resolve()
+        if args.database:
+            results = check_database(db.Database(), scan_dir, check_album_art=args.check_album_art, jobs=args.jobs)
+        elif args.cache or args.changed_only:
+            # The walk records the stat results, so that the files are not stat again to look up their cached results
+            walked_files = profiling.iterate(profiling.WALK, walk.walk_files(scan_dir, jobs=args.walk_jobs, stat=True))
+            walked_files = sorted(walked_files, key=lambda walked_file: album_order(walked_file.path))
+            results = check_files_cached(db.Database(), scan_dir, walked_files, check_album_art=args.check_album_art,
+                                         jobs=args.jobs, changed_only=args.changed_only)
+        else:
+            files = sorted(walk.audio_files(scan_dir, jobs=args.walk_jobs), key=album_order)
+            results = check_files(scan_dir, files, check_album_art=args.check_album_art, jobs=args.jobs)
+        findings = check_albums(results, changed_only=args.changed_only) if args.album_rules \
+            else itertools.chain.from_iterable(result.findings for result in results)
+        if args.output:
+            with open(args.output, 'w', newline='', encoding='utf-8') as output:
+                write_findings(findings, output, args.format)
+        else:
+            write_findings(findings, sys.stdout, args.format)
 
 
 if __name__ == '__main__':
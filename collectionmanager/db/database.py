@@ -1,16 +1,77 @@
 import argparse
+import collections
+import concurrent.futures
+import contextlib
 import datetime
+import itertools
 import logging
 import os
 import pathlib
 import sys
+import typing
 
+import mutagen
 from PyQt5 import QtCore
-from sqlalchemy import create_engine
+import sqlalchemy
+from sqlalchemy import create_engine, delete, func, inspect, select, text, update
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.engine.base import Engine
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.orm import aliased, sessionmaker, Session
 
+from collectionmanager import artstore, audiohash, profiling, walk
 from collectionmanager.db import models
+from collectionmanager.services import trackinfo
+
+# The number of rows fetched at once by queries that stream their results
+QUERY_BATCH_SIZE = 1000
+
+# The columns of the rows returned by Database.export_rows, with their types
+EXPORT_COLUMNS = {
+    'path': str,
+    'artist': str,
+    'album_artist': str,
+    'album': str,
+    'year': int,
+    'disk_number': int,
+    'number': int,
+    'title': str,
+    'compilation': bool,
+    'genre': str,
+    'length': float,
+    'codec': str,
+    'bitrate': int,
+    'bitrate_mode': str,
+    'sample_rate': int,
+    'channels': int,
+    'encoder': str,
+    'art_hash': str,
+    'art_size': int,
+    'audio_hash': str,
+    'integrity_status': str,
+    'integrity_checked': datetime.datetime,
+    'last_scanned': datetime.datetime,
+}
+
+# The events of the change log
+CHANGE_ADDED = 'added'
+CHANGE_MODIFIED = 'modified'
+CHANGE_REMOVED = 'removed'
+
+# The track columns compared in order to tell whether a track that is scanned again changed
+CHANGE_COLUMNS = (
+    'name', 'track_artist_id', 'album_artist_id', 'album_id', 'disk_number', 'number', 'compilation', 'genre', 'length',
+    'codec', 'bitrate', 'bitrate_mode', 'sample_rate', 'channels', 'encoder', 'art_hash', 'art_size', 'audio_hash',
+    'file_size',
+)
+
+# The number of files saved to the database in a single transaction
+COMMIT_BATCH_SIZE = 500
+
+# The number of files whose audio is hashed in parallel while scanning
+HASH_JOBS = 4
+
+# The maximum number of files hashed ahead of the file being saved while scanning
+HASH_WINDOW = 2 * HASH_JOBS
 
 
 class Database:
@@ -18,11 +79,23 @@ class Database:
     """
     db_file_name = 'db.sqlite'
 
-    def __init__(self):
+    def __init__(self, db_file_path: str | pathlib.Path = None):
         """Create the database.
+
+        :param db_file_path: The database file path. By default, the database of the application.
         """
+        self.db_file_path = pathlib.Path(db_file_path) if db_file_path else self.default_path()
         self.engine = self._get_engine()
 
+    @classmethod
+    def default_path(cls) -> pathlib.Path:
+        """Return the path of the database of the application.
+
+        :return: The database file path.
+        """
+        base_dir = QtCore.QStandardPaths.writableLocation(QtCore.QStandardPaths.AppDataLocation)
+        return pathlib.Path(base_dir) / cls.db_file_name
+
     def _get_engine(self) -> Engine:
         """Get the SQLAlchemy engine.
 
@@ -30,35 +103,85 @@ class Database:
         """
         logging.info("Creating SQLAlchemy engine")
         # Make sure the base directory exists
-        base_dir = QtCore.QStandardPaths.writableLocation(QtCore.QStandardPaths.AppDataLocation)
-        db_file_path = pathlib.Path(base_dir) / self.db_file_name
+        db_file_path = self.db_file_path
         db_file_path.parent.mkdir(parents=True, exist_ok=True)
         # Create engine
         engine = create_engine(f'sqlite:///{db_file_path}?check_same_thread=false')
         if not db_file_path.exists():
-            # Crate the database if it does not exist
             logging.info("Database file does not exist, creating")
-            models.Base.metadata.create_all(engine)
+        # Create the database if it does not exist, and any tables or columns added since it was created
+        models.Base.metadata.create_all(engine)
+        self._add_missing_columns(engine)
+        self._migrate_encoder_info(engine)
 
         return engine
 
-    def rescan(self, force: bool = False):
+    @staticmethod
+    def _add_missing_columns(engine: Engine):
+        """Add the model columns that do not exist in the database tables, for databases created by older versions.
+
+        :param engine: The SQLAlchemy engine.
+        """
+        inspector = inspect(engine)
+        with engine.begin() as connection:
+            for table in models.Base.metadata.sorted_tables:
+                existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name not in existing_columns:
+                        logging.info(f"Adding column {column.name} to table {table.name}")
+                        column_type = column.type.compile(engine.dialect)
+                        connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+                for index in table.indexes:
+                    index.create(connection, checkfirst=True)
+
+    @staticmethod
+    def _migrate_encoder_info(engine: Engine):
+        """Copy the encoder information of the tracks scanned by older versions, stored in the encoder_info JSON
+        column, to the typed encoder columns. The channels are not known until the tracks are scanned again.
+
+        :param engine: The SQLAlchemy engine.
+        """
+        if 'encoder_info' not in {column['name'] for column in inspect(engine).get_columns('tracks')}:
+            return
+        with engine.begin() as connection:
+            migrated = connection.execute(text("""
+                UPDATE tracks SET
+                    codec = CASE WHEN lower(file_name) LIKE '%.flac' THEN 'flac' ELSE 'mp3' END,
+                    bitrate = json_extract(encoder_info, '$.bitrate'),
+                    bitrate_mode = CASE WHEN lower(file_name) LIKE '%.flac' THEN NULL
+                        ELSE replace(json_extract(encoder_info, '$.bitrate_mode'), 'BitrateMode.', '') END,
+                    sample_rate = json_extract(encoder_info, '$.sample_rate'),
+                    encoder = nullif(json_extract(encoder_info, '$.encoder_info'), '')
+                WHERE codec IS NULL AND encoder_info IS NOT NULL
+            """)).rowcount
+            if migrated:
+                logging.info(f"Migrated the encoder information of {migrated} tracks")
+
+    def rescan(self, force: bool = False, art_store: artstore.ArtStore = None, walk_jobs: int = None):
         """Rescan the library.
 
         :param force: Force update file info
+        :param art_store: The store where the embedded album art is added. By default, album art is not stored.
+        :param walk_jobs: The number of directories listed in parallel. By default, walk.DEFAULT_JOBS.
         """
         logging.info("Rescanning the database")
 
         for directory in self.directories():
             directory_path = pathlib.Path(directory.path)
-            if datetime.datetime.fromtimestamp(os.path.getmtime(str(directory_path))) > directory.last_scanned or force:
-                self.add_directory(directory.path, force)
+            if force or directory.last_scanned is None or directory.scan_started is not None or \
+                    datetime.datetime.fromtimestamp(os.path.getmtime(str(directory_path))) > directory.last_scanned:
+                self.add_directory(directory.path, force, art_store, walk_jobs)
 
-    def add_directory(self, directory_path: str, force: bool = False):
-        """Add a directory to the library.
+    def add_directory(self, directory_path: str, force: bool = False, art_store: artstore.ArtStore = None,
+                      walk_jobs: int = None):
+        """Add a directory to the library. The files are scanned in batches of COMMIT_BATCH_SIZE, and every batch is
+        committed along with a checkpoint of the scan, so that the memory used does not grow with the size of the
+        directory. If a scan is interrupted, the next scan of the directory skips the files that it already scanned.
 
         :param directory_path: The directory path.
         :param force: Force update file info
+        :param art_store: The store where the embedded album art is added. By default, album art is not stored.
+        :param walk_jobs: The number of directories listed in parallel. By default, walk.DEFAULT_JOBS.
         """
         logging.info(f"Adding directory {directory_path} with force = {force}")
 
@@ -69,23 +192,109 @@ class Database:
         if not directory_path.is_dir():
             raise ValueError(f"Path {directory_path} is not a directory")
 
-        # Check if the directory exists in the database
-        session = sessionmaker(bind=self.engine)()
-        directory = session.query(models.Directory).filter(models.Directory.path == str(directory_path)).first()
-        if directory is None:
-            logging.debug("Directory does not exist, creating")
-            directory = models.Directory(path=str(directory_path))
-            session.add(directory)
+        with sessionmaker(bind=self.engine)() as session:
+            # Check if the directory exists in the database
+            directory = session.query(models.Directory).filter(models.Directory.path == str(directory_path)).first()
+            if directory is None:
+                logging.debug("Directory does not exist, creating")
+                directory = models.Directory(path=str(directory_path))
+                session.add(directory)
+
+            # Start a new scan, or resume an interrupted one
+            if directory.scan_started is None:
+                directory.scan_started = datetime.datetime.now()
+                directory.scan_progress = 0
+            else:
+                logging.info(f"Resuming the scan started at {directory.scan_started}, after {directory.scan_progress} "
+                             f"files")
+            scan_started = directory.scan_started
             session.commit()
+            directory_id = directory.id
+
+            logging.info(f"Scanning directory {directory_path}")
+            # The files are stated while walking, so that the modification times are read concurrently
+            files = profiling.iterate(profiling.WALK, walk.walk_files(directory_path, jobs=walk_jobs, stat=True))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=HASH_JOBS, thread_name_prefix='hash') as executor:
+                while batch := list(itertools.islice(files, COMMIT_BATCH_SIZE)):
+                    # Scan the changed files, hashing their audio in parallel
+                    changed_files = self._changed_files(session, directory_id, directory_path, batch, force,
+                                                        scan_started)
+                    for file_path, audio_hash in self._hashed_files(executor, changed_files):
+                        try:
+                            self._process_file(session, directory_path, file_path, True, art_store,
+                                               audio_hash=audio_hash)
+                        except (mutagen.MutagenError, OSError) as e:
+                            logging.error(f"Could not read {file_path}: {e}")
+
+                    # Save the batch along with the checkpoint, which counts the files that could not be read, so that
+                    # a resumed scan does not stop at them again, and let go of the saved objects
+                    session.get(models.Directory, directory_id).scan_progress += len(changed_files)
+                    with profiling.phase(profiling.DB_COMMIT):
+                        session.commit()
+                    session.expunge_all()
+
+            # Save the changes
+            directory = session.get(models.Directory, directory_id)
+            directory.last_scanned = datetime.datetime.now()
+            logging.info(f"Scanned {directory.scan_progress} files")
+            directory.scan_started = None
+            directory.scan_progress = None
+            with profiling.phase(profiling.DB_COMMIT):
+                session.commit()
+        self.compact_changes()
+
+    @staticmethod
+    def _hashed_files(executor: concurrent.futures.Executor, file_paths: list[pathlib.Path]) \
+            -> typing.Iterator[tuple[pathlib.Path, str]]:
+        """Hash the audio of files in an executor, keeping at most HASH_WINDOW files in flight, so that hashing does
+        not run far ahead of the files being saved.
+
+        :param executor: The executor.
+        :param file_paths: The file paths.
+        :return: An iterator over the file paths and their audio hashes, in the order of the files.
+        """
+        in_flight = collections.deque()
+        for file_path in file_paths:
+            in_flight.append((file_path, executor.submit(audiohash.try_audio_hash, file_path)))
+            if len(in_flight) >= HASH_WINDOW:
+                hashed_path, future = in_flight.popleft()
+                yield hashed_path, future.result()
+        while in_flight:
+            hashed_path, future = in_flight.popleft()
+            yield hashed_path, future.result()
 
-        # Scan the directory
-        logging.info(f"Scanning directory {directory_path}")
-        for file_path in directory_path.glob('**/*.mp3'):
-            self._process_file(session, directory_path, file_path, force)
+    @staticmethod
+    def _changed_files(session: Session, directory_id: int, directory_path: pathlib.Path,
+                       files: list[walk.WalkedFile], force: bool, scan_started: datetime.datetime) \
+            -> list[pathlib.Path]:
+        """Return the files that changed since they were last scanned, or that were scanned before their audio was
+        hashed. Files already scanned by the current scan, before it was interrupted, are never returned. Files whose
+        audio could not be hashed have the FAILED_HASH, so they are only returned again when they change.
 
-        # Save the changes
-        directory.last_scanned = datetime.datetime.now()
-        session.commit()
+        :param session: The database session to use.
+        :param directory_id: The id of the directory.
+        :param directory_path: The directory path.
+        :param files: The files, with their stat results.
+        :param force: Return all the files not scanned by the current scan.
+        :param scan_started: The time the current scan started.
+        :return: The changed files.
+        """
+        file_names = [str(walked_file.path.relative_to(directory_path)) for walked_file in files]
+        scanned = {
+            file_name: (last_scanned, audio_hash) for file_name, last_scanned, audio_hash in session.query(
+                models.Track.file_name, models.Track.last_scanned, models.Track.audio_hash
+            ).filter(models.Track.directory_id == directory_id, models.Track.file_name.in_(file_names))
+        }
+        changed_files = []
+        for walked_file, file_name in zip(files, file_names):
+            last_scanned, audio_hash = scanned.get(file_name, (None, None))
+            if last_scanned is not None and last_scanned >= scan_started:
+                continue
+            if force or last_scanned is None or audio_hash is None or \
+                    datetime.datetime.fromtimestamp(walked_file.stat.st_mtime) >= last_scanned:
+                changed_files.append(walked_file.path)
+
+        return changed_files
 
     def remove_missing(self):
         """Remove all missing tracks from the library
@@ -93,15 +302,174 @@ class Database:
         logging.info(f"Removing missing files from the database")
 
         # Scan all tracks
-        session = sessionmaker(bind=self.engine)()
-        for track in self.tracks():
-            track_path = pathlib.Path(track.directory.path, track.file_name)
-            if not track_path.exists():
-                logging.info(f"File {track_path} does not exist")
-                logging.info(f"Deleting track")
-                session.delete(track)
+        path = models.Directory.path + os.sep + models.Track.file_name
+        with sessionmaker(bind=self.engine)() as session:
+            missing = []
+            for track_id, track_path in session.execute(select(models.Track.id, path).join(models.Track.directory)):
+                if not os.path.exists(track_path):
+                    logging.info(f"File {track_path} does not exist")
+                    missing.append((track_id, track_path))
+
+            logging.info(f"Deleting {len(missing)} tracks")
+            now = datetime.datetime.now()
+            for start in range(0, len(missing), QUERY_BATCH_SIZE):
+                batch = missing[start:start + QUERY_BATCH_SIZE]
+                session.execute(delete(models.Track).where(models.Track.id.in_([track_id for track_id, _ in batch])))
+                session.add_all(models.Change(event=CHANGE_REMOVED, path=track_path, track_id=track_id, timestamp=now)
+                                for track_id, track_path in batch)
+            session.commit()
+        self.compact_changes()
 
-        session.commit()
+    def changes(self, since: int = 0, limit: int = None) -> typing.Iterator[sqlalchemy.Row]:
+        """Return the changes of the library after a sequence number, in the order they happened. The rows have the
+        columns sequence, event, path, track_id and timestamp, where the event is one of added, modified or removed.
+
+        A consumer stores the sequence number of the last change it processed and passes it on its next run. As the
+        change log is compacted to the last change of every path, a consumer should treat added and modified alike.
+
+        :param since: Return the changes with a greater sequence number. By default, all changes.
+        :param limit: The maximum number of changes.
+        :return: An iterator over the rows.
+        """
+        query = select(
+            models.Change.sequence, models.Change.event, models.Change.path, models.Change.track_id,
+            models.Change.timestamp
+        ).where(models.Change.sequence > since).order_by(models.Change.sequence).limit(limit)
+        with self.engine.connect() as connection:
+            yield from connection.execution_options(yield_per=QUERY_BATCH_SIZE).execute(query)
+
+    def last_change(self) -> int:
+        """Return the sequence number of the last change of the library.
+
+        :return: The sequence number, or zero if the library never changed.
+        """
+        with self.engine.connect() as connection:
+            return connection.execute(select(func.coalesce(func.max(models.Change.sequence), 0))).scalar_one()
+
+    def compact_changes(self):
+        """Compact the change log, by deleting the changes of a path that are followed by a later change of the same
+        path. The sequence numbers of the remaining changes are kept.
+        """
+        later = aliased(models.Change)
+        last_sequence = select(func.max(later.sequence)).where(later.path == models.Change.path).scalar_subquery()
+        with self.engine.begin() as connection:
+            compacted = connection.execute(
+                delete(models.Change).where(models.Change.sequence < last_sequence)
+            ).rowcount
+        if compacted:
+            logging.debug(f"Compacted {compacted} changes")
+
+    def record_saved(self, file_path: str | pathlib.Path):
+        """Append a modified change for a file whose tags were saved, so that the change log shows tag edits when they
+        are made instead of at the next scan. Files that are not tracks of the library are ignored.
+
+        :param file_path: The file path.
+        """
+        file_path = pathlib.Path(file_path).resolve()
+        with self.engine.begin() as connection:
+            for directory_id, directory_path in connection.execute(select(models.Directory.id, models.Directory.path)):
+                if not file_path.is_relative_to(directory_path):
+                    continue
+                track_id = connection.execute(select(models.Track.id).where(
+                    models.Track.directory_id == directory_id,
+                    models.Track.file_name == str(file_path.relative_to(directory_path))
+                )).scalar()
+                if track_id is not None:
+                    connection.execute(insert(models.Change).values(
+                        event=CHANGE_MODIFIED, path=str(file_path), track_id=track_id,
+                        timestamp=datetime.datetime.now()))
+                    return
+
+    def export_snapshot(self, snapshot_path: str | pathlib.Path):
+        """Write a compacted, consistent copy of the database to a file with VACUUM INTO. The database can be used
+        while the copy is written.
+
+        :param snapshot_path: The snapshot file path. It must not exist.
+        """
+        snapshot_path = pathlib.Path(snapshot_path)
+        if snapshot_path.exists():
+            raise ValueError(f"Snapshot {snapshot_path} already exists")
+        with self.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            connection.execute(text("VACUUM INTO :path"), {'path': str(snapshot_path)})
+
+    def rebase_paths(self, old_path: str, new_path: str) -> int:
+        """Move the directories under a path to another path, such as after moving the library to another mount
+        point. The paths of the check results and of the change log are moved along. The files are not scanned again.
+        The new path is resolved, like the paths of the directories added to the library.
+
+        :param old_path: The path the directories were under.
+        :param new_path: The path the directories are now under.
+        :return: The number of directories moved.
+        :raises ValueError: If a directory would be moved to the path of another directory in the library.
+        """
+        old_path = old_path.rstrip('/\\') or old_path
+        new_path = str(pathlib.Path(new_path).resolve())
+
+        def rebase(column):
+            under_old_path = (column == old_path) | column.startswith(old_path + os.sep, autoescape=True)
+            rebased = new_path + func.substr(column, len(old_path) + 1)
+            return update(column.class_).where(under_old_path).values({column.key: rebased})
+
+        with self.engine.begin() as connection:
+            # The directories under the old path are moved together, so only the other directories can collide
+            paths = {row.path for row in connection.execute(select(models.Directory.path))}
+            moving = {path for path in paths if path == old_path or path.startswith(old_path + os.sep)}
+            others = paths - moving
+            for path in sorted(moving):
+                rebased_path = new_path + path[len(old_path):]
+                if rebased_path in others:
+                    raise ValueError(f"Cannot move {path} to {rebased_path}, which is already in the library")
+            moved = connection.execute(rebase(models.Directory.path)).rowcount
+            connection.execute(rebase(models.CheckResult.path))
+            connection.execute(rebase(models.Change.path))
+
+        return moved
+
+    def scanned_tracks(self, directory_path: str, file_paths: list[pathlib.Path]) -> dict[pathlib.Path, sqlalchemy.Row]:
+        """Return what the last scan recorded for files of a directory of the library. The rows have the columns
+        file_size, last_scanned and audio_hash. The files that are not in the library are left out.
+
+        :param directory_path: The directory path.
+        :param file_paths: The file paths, under the directory.
+        :return: The rows, by file path.
+        """
+        directory_path = pathlib.Path(directory_path).resolve()
+        file_paths = {str(file_path.relative_to(directory_path)): file_path for file_path in file_paths}
+        file_names = list(file_paths)
+        tracks = {}
+        with self.engine.connect() as connection:
+            for start in range(0, len(file_names), QUERY_BATCH_SIZE):
+                query = select(models.Track.file_name, models.Track.file_size, models.Track.last_scanned,
+                               models.Track.audio_hash).join(models.Track.directory) \
+                    .where(models.Directory.path == str(directory_path)) \
+                    .where(models.Track.file_name.in_(file_names[start:start + QUERY_BATCH_SIZE]))
+                tracks.update((file_paths[row.file_name], row) for row in connection.execute(query))
+
+        return tracks
+
+    def track_files(self) -> typing.Iterator[tuple[int, str, int, datetime.datetime]]:
+        """Return the file of every track, with its size and the time it was last scanned.
+
+        :return: An iterator over the track ids, paths, file sizes and scan times.
+        """
+        path = models.Directory.path + os.sep + models.Track.file_name
+        query = select(models.Track.id, path, models.Track.file_size, models.Track.last_scanned) \
+            .join(models.Track.directory).order_by(models.Track.directory_id, models.Track.file_name)
+        with self.engine.connect() as connection:
+            yield from (tuple(row) for row in connection.execution_options(yield_per=QUERY_BATCH_SIZE).execute(query))
+
+    def mark_scanned(self, track_ids: list[int], last_scanned: datetime.datetime = None):
+        """Set the scan time of tracks, so that their files are not scanned again unless they change after it.
+
+        :param track_ids: The track ids.
+        :param last_scanned: The scan time. By default, now.
+        """
+        last_scanned = last_scanned or datetime.datetime.now()
+        with self.engine.begin() as connection:
+            for start in range(0, len(track_ids), QUERY_BATCH_SIZE):
+                connection.execute(update(models.Track).where(
+                    models.Track.id.in_(track_ids[start:start + QUERY_BATCH_SIZE])
+                ).values(last_scanned=last_scanned))
 
     def directories(self) -> list[models.Directory]:
         """Return the directories in the database.
@@ -137,13 +505,304 @@ class Database:
 
         return query.all()
 
+    def track_tag_rows(self, directory_path: str) -> typing.Iterator[sqlalchemy.Row]:
+        """Return the tag information of the tracks under a directory with a single query, ordered by directory and
+        file name, so that the tracks of every directory are consecutive. The rows are fetched in batches. The rows have
+        the columns path, artist, album_artist, album, year, disk_number, number, title, compilation, art_hash and
+        art_size.
+
+        :param directory_path: The directory path.
+        :return: An iterator over the rows.
+        """
+        album_artist = aliased(models.Artist)
+        path = models.Directory.path + os.sep + models.Track.file_name
+        # Trimming every character other than the separator from the end of the path leaves its directory. Ordering by
+        # path alone puts the files of a subdirectory between the files of its parent directory
+        file_directory = func.rtrim(path, func.replace(path, os.sep, ''))
+        query = select(
+            path.label('path'), models.Artist.name.label('artist'), album_artist.name.label('album_artist'),
+            models.Album.name.label('album'), models.Album.year.label('year'), models.Track.disk_number,
+            models.Track.number, models.Track.name.label('title'), models.Track.compilation, models.Track.art_hash,
+            models.Track.art_size
+        ).join(models.Track.directory) \
+            .outerjoin(models.Artist, models.Track.track_artist) \
+            .outerjoin(album_artist, models.Track.album_artist) \
+            .outerjoin(models.Album, models.Track.album) \
+            .where(path.startswith(str(pathlib.Path(directory_path).resolve()) + os.sep, autoescape=True)) \
+            .order_by(file_directory, path)
+        with self.engine.connect() as connection:
+            yield from connection.execution_options(yield_per=QUERY_BATCH_SIZE).execute(query)
+
+    def export_rows(self, directory_path: str = None) -> typing.Iterator[sqlalchemy.Row]:
+        """Return every column of the tracks, with the names of their artists and album joined, fetching the rows in
+        batches so that the memory used does not depend on the size of the library. The rows are ordered by directory
+        and file name, which follows the index on these columns and so needs no sorting. The rows have the columns
+        listed in EXPORT_COLUMNS.
+
+        :param directory_path: Only export the tracks under this directory. By default, all tracks.
+        :return: An iterator over the rows.
+        """
+        album_artist = aliased(models.Artist)
+        path = models.Directory.path + os.sep + models.Track.file_name
+        query = select(
+            path.label('path'), models.Artist.name.label('artist'), album_artist.name.label('album_artist'),
+            models.Album.name.label('album'), models.Album.year.label('year'), models.Track.disk_number,
+            models.Track.number, models.Track.name.label('title'), models.Track.compilation, models.Track.genre,
+            models.Track.length, models.Track.codec, models.Track.bitrate, models.Track.bitrate_mode,
+            models.Track.sample_rate, models.Track.channels, models.Track.encoder, models.Track.art_hash,
+            models.Track.art_size, models.Track.audio_hash, models.Track.integrity_status,
+            models.Track.integrity_checked, models.Track.last_scanned
+        ).join(models.Track.directory) \
+            .outerjoin(models.Artist, models.Track.track_artist) \
+            .outerjoin(album_artist, models.Track.album_artist) \
+            .outerjoin(models.Album, models.Track.album) \
+            .order_by(models.Track.directory_id, models.Track.file_name)
+        if directory_path is not None:
+            query = query.where(path.startswith(str(pathlib.Path(directory_path).resolve()) + os.sep, autoescape=True))
+        with self.engine.connect() as connection:
+            yield from connection.execution_options(yield_per=QUERY_BATCH_SIZE).execute(query)
+
+    def art_usage(self, directory_path: str) -> list[artstore.ArtUsage]:
+        """Return the usage of every distinct album art image embedded in the tracks under a directory, using the art
+        hashes recorded when the tracks were scanned.
+
+        :param directory_path: The directory path.
+        :return: A list with the usage of every image.
+        """
+        path = models.Directory.path + os.sep + models.Track.file_name
+        query = select(
+            models.Track.art_hash, func.max(models.Track.art_size), func.count(models.Track.id),
+            func.count(models.Track.album_id.distinct())
+        ).join(models.Track.directory) \
+            .where(models.Track.art_hash.is_not(None)) \
+            .where(path.startswith(str(pathlib.Path(directory_path).resolve()) + os.sep, autoescape=True)) \
+            .group_by(models.Track.art_hash)
+        with self.engine.connect() as connection:
+            return [artstore.ArtUsage(digest, size, tracks, albums)
+                    for digest, size, tracks, albums in connection.execute(query)]
+
+    def album_genres(self, directory_path: str) -> typing.Iterator[sqlalchemy.Row]:
+        """Return the number of tracks per genre for every album under a directory, as recorded by the last scan. The
+        rows have the columns artist, album, genre and tracks, where the artist is the album artist if it exists and
+        otherwise the track artist.
+
+        :param directory_path: The directory path.
+        :return: An iterator over the rows.
+        """
+        album_artist = aliased(models.Artist)
+        path = models.Directory.path + os.sep + models.Track.file_name
+        artist = func.coalesce(album_artist.name, models.Artist.name)
+        query = select(
+            artist.label('artist'), models.Album.name.label('album'), models.Track.genre,
+            func.count(models.Track.id).label('tracks')
+        ).join(models.Track.directory) \
+            .join(models.Album, models.Track.album) \
+            .outerjoin(models.Artist, models.Track.track_artist) \
+            .outerjoin(album_artist, models.Track.album_artist) \
+            .where(models.Track.genre.is_not(None)) \
+            .where(path.startswith(str(pathlib.Path(directory_path).resolve()) + os.sep, autoescape=True)) \
+            .group_by(artist, models.Album.name, models.Track.genre)
+        with self.engine.connect() as connection:
+            yield from connection.execution_options(yield_per=QUERY_BATCH_SIZE).execute(query)
+
+    def duplicates(self) -> typing.Iterator[sqlalchemy.Row]:
+        """Return the tracks whose audio is identical to the audio of other tracks, according to the audio hashes
+        recorded by the last scan. The rows have the columns audio_hash and path, and are ordered by hash, so that the
+        tracks with the same audio are consecutive.
+
+        :return: An iterator over the rows.
+        """
+        duplicate_hashes = select(models.Track.audio_hash) \
+            .where(models.Track.audio_hash.is_not(None), models.Track.audio_hash != audiohash.FAILED_HASH) \
+            .group_by(models.Track.audio_hash).having(func.count(models.Track.id) > 1)
+        path = models.Directory.path + os.sep + models.Track.file_name
+        query = select(models.Track.audio_hash, path.label('path')).join(models.Track.directory) \
+            .where(models.Track.audio_hash.in_(duplicate_hashes)) \
+            .order_by(models.Track.audio_hash, path)
+        with self.engine.connect() as connection:
+            yield from connection.execution_options(yield_per=QUERY_BATCH_SIZE).execute(query)
+
+    def low_bitrate_tracks(self, max_bitrate: int, bitrate_mode: str = None) -> typing.Iterator[sqlalchemy.Row]:
+        """Return the tracks with a bitrate lower than a limit, such as all VBR tracks under 192 kbps. The rows have
+        the columns path, codec, bitrate, bitrate_mode and sample_rate, and are ordered by bitrate.
+
+        :param max_bitrate: The bitrate limit, in bits per second.
+        :param bitrate_mode: The bitrate mode to filter by, one of CBR, VBR, ABR or UNKNOWN. By default, all modes.
+        :return: An iterator over the rows.
+        """
+        path = models.Directory.path + os.sep + models.Track.file_name
+        query = select(
+            path.label('path'), models.Track.codec, models.Track.bitrate, models.Track.bitrate_mode,
+            models.Track.sample_rate
+        ).join(models.Track.directory).where(models.Track.bitrate < max_bitrate).order_by(models.Track.bitrate, path)
+        if bitrate_mode is not None:
+            query = query.where(models.Track.bitrate_mode == bitrate_mode)
+        with self.engine.connect() as connection:
+            yield from connection.execution_options(yield_per=QUERY_BATCH_SIZE).execute(query)
+
+    def sample_rate_histogram(self) -> list[tuple[str, int, int]]:
+        """Return the number of tracks per codec and sample rate.
+
+        :return: A list with the codec, the sample rate and the number of tracks.
+        """
+        query = select(models.Track.codec, models.Track.sample_rate, func.count(models.Track.id)) \
+            .group_by(models.Track.codec, models.Track.sample_rate) \
+            .order_by(models.Track.codec, models.Track.sample_rate)
+        with self.engine.connect() as connection:
+            return [tuple(row) for row in connection.execute(query)]
+
+    def bitrate_mode_summary(self) -> list[tuple[str, str, int, float]]:
+        """Return the number of tracks and their average bitrate per codec and bitrate mode.
+
+        :return: A list with the codec, the bitrate mode, the number of tracks and their average bitrate.
+        """
+        query = select(
+            models.Track.codec, models.Track.bitrate_mode, func.count(models.Track.id), func.avg(models.Track.bitrate)
+        ).group_by(models.Track.codec, models.Track.bitrate_mode) \
+            .order_by(models.Track.codec, models.Track.bitrate_mode)
+        with self.engine.connect() as connection:
+            return [tuple(row) for row in connection.execute(query)]
+
+    def tracks_to_verify(self, max_age: datetime.timedelta = None,
+                         limit: int = None) -> typing.Iterator[tuple[int, str]]:
+        """Return the tracks whose integrity should be verified, starting with the tracks that were never verified and
+        continuing with the oldest verifications.
+
+        :param max_age: Include the tracks verified longer ago than this. By default, only the tracks that were never
+            verified.
+        :param limit: The maximum number of tracks.
+        :return: An iterator over the track ids and paths.
+        """
+        path = models.Directory.path + os.sep + models.Track.file_name
+        condition = models.Track.integrity_checked.is_(None)
+        if max_age is not None:
+            condition = condition | (models.Track.integrity_checked < datetime.datetime.now() - max_age)
+        query = select(models.Track.id, path).join(models.Track.directory).where(condition) \
+            .order_by(models.Track.integrity_checked.asc().nulls_first(), path).limit(limit)
+        with self.engine.connect() as connection:
+            yield from (tuple(row) for row in connection.execution_options(yield_per=QUERY_BATCH_SIZE).execute(query))
+
+    def save_integrity_results(self, results: list[dict]):
+        """Save the results of integrity verifications.
+
+        :param results: The results, as dictionaries with the track id and the integrity_status, integrity_detail and
+            integrity_checked columns as keys.
+        """
+        if not results:
+            return
+        with sessionmaker(bind=self.engine)() as session:
+            session.execute(update(models.Track), results)
+            session.commit()
+
+    def integrity_report(self) -> typing.Iterator[sqlalchemy.Row]:
+        """Return the tracks whose last integrity verification did not succeed. The rows have the columns path,
+        integrity_status, integrity_detail and integrity_checked.
+
+        :return: An iterator over the rows.
+        """
+        path = models.Directory.path + os.sep + models.Track.file_name
+        query = select(
+            path.label('path'), models.Track.integrity_status, models.Track.integrity_detail,
+            models.Track.integrity_checked
+        ).join(models.Track.directory).where(models.Track.integrity_status.is_not(None)) \
+            .where(models.Track.integrity_status != 'ok').order_by(models.Track.integrity_status, path)
+        with self.engine.connect() as connection:
+            yield from connection.execution_options(yield_per=QUERY_BATCH_SIZE).execute(query)
+
+    def check_results(self, directory_path: str) -> dict[str, models.CheckResult]:
+        """Return the cached check results for the files under a directory.
+
+        :param directory_path: The directory path.
+        :return: A dictionary from the file path to its check result.
+        """
+        session = sessionmaker(bind=self.engine)()
+        prefix = str(pathlib.Path(directory_path).resolve()) + os.sep
+        query = select(models.CheckResult).where(models.CheckResult.path.startswith(prefix, autoescape=True))
+
+        return {check_result.path: check_result for check_result in session.scalars(query)}
+
+    def save_check_results(self, check_results: list[dict]):
+        """Save check results, replacing the existing results for the same files.
+
+        :param check_results: The check results, as dictionaries with the CheckResult columns as keys.
+        """
+        if not check_results:
+            return
+        with sessionmaker(bind=self.engine)() as session:
+            statement = insert(models.CheckResult).values(check_results)
+            session.execute(statement.on_conflict_do_update(index_elements=[models.CheckResult.path], set_={
+                column: statement.excluded[column]
+                for column in ('size', 'mtime_ns', 'rules_version', 'findings', 'track_info', 'last_checked')
+            }))
+            session.commit()
+
+    def delete_check_results(self, paths: list[str]):
+        """Delete the check results for files, in batches of QUERY_BATCH_SIZE paths.
+
+        :param paths: The file paths.
+        """
+        with self.engine.begin() as connection:
+            for start in range(0, len(paths), QUERY_BATCH_SIZE):
+                connection.execute(delete(models.CheckResult).where(
+                    models.CheckResult.path.in_(paths[start:start + QUERY_BATCH_SIZE])
+                ))
+
+    @contextlib.contextmanager
+    def track_updates(self, directory_path: str, art_store: artstore.ArtStore = None) \
+            -> typing.Iterator[typing.Callable[[pathlib.Path, trackinfo.TrackInfo], None]]:
+        """Context manager for saving the track information of files that were already read, such as by a pipeline
+        that reads every file once. The directory is added to the library if needed, and the changes are committed
+        every COMMIT_BATCH_SIZE files and on exit.
+
+        :param directory_path: The directory path.
+        :param art_store: The store where the embedded album art is added. By default, album art is not stored.
+        :return: A function that saves the track information of a file, given its path, its track information and
+            optionally the hash of its audio.
+        """
+        directory_path = pathlib.Path(directory_path).resolve()
+        with sessionmaker(bind=self.engine)() as session:
+            directory = session.query(models.Directory).filter(models.Directory.path == str(directory_path)).first()
+            if directory is None:
+                directory = models.Directory(path=str(directory_path))
+                session.add(directory)
+                session.commit()
+            directory_id = directory.id
+            pending = 0
+
+            def update(file_path: pathlib.Path, track_info: trackinfo.TrackInfo, audio_hash: str = None):
+                nonlocal pending
+                try:
+                    self._process_file(session, directory_path, file_path, art_store=art_store,
+                                       track_info=track_info, audio_hash=audio_hash)
+                except OSError as e:
+                    logging.error(f"Could not read {file_path}: {e}")
+                    return
+                pending += 1
+                if pending >= COMMIT_BATCH_SIZE:
+                    with profiling.phase(profiling.DB_COMMIT):
+                        session.commit()
+                    session.expunge_all()
+                    pending = 0
+
+            yield update
+            session.get(models.Directory, directory_id).last_scanned = datetime.datetime.now()
+            with profiling.phase(profiling.DB_COMMIT):
+                session.commit()
+        self.compact_changes()
+
     @staticmethod
-    def _process_file(session: Session, directory_path: pathlib.Path, file_path: pathlib.Path, force: bool = False):
-        """Process a file.
+    def _process_file(session: Session, directory_path: pathlib.Path, file_path: pathlib.Path, force: bool = False,
+                      art_store: artstore.ArtStore = None, track_info: trackinfo.TrackInfo = None,
+                      audio_hash: str = None):
+        """Process a file. The file is read before the session is changed, so that a file that cannot be read, and
+        raises a mutagen or OS error, leaves the session as it was. Files of an unsupported type are skipped.
 
         :param session: The database session to use.
         :param directory_path: The directory where the file belongs to.
         :param file_path: The file path.
+        :param art_store: The store where the embedded album art is added.
+        :param track_info: The track information, if the file was already read. The track is then always updated.
+        :param audio_hash: The hash of the audio of the file, if it was already computed.
         """
         # Get the file directory
         directory = session.query(models.Directory).filter(models.Directory.path == str(directory_path)).first()
@@ -154,64 +813,114 @@ class Database:
         file_name = file_path.relative_to(directory_path)
         track = session.query(models.Track).filter(
             models.Track.directory == directory, models.Track.file_name == str(file_name)).first()
+        previous = None
+        if track is not None:
+            touched = track.last_scanned is None or \
+                track.last_scanned <= datetime.datetime.fromtimestamp(os.path.getmtime(str(file_path)))
+            if track_info is None and not force and not touched:
+                logging.debug(f"File {file_path} already scanned")
+                return
+            # A file read again without being touched is only logged as modified if its track changes
+            previous = None if touched else [getattr(track, column) for column in CHANGE_COLUMNS]
+
+        # Read the tag information
+        if track_info is None:
+            logging.info(f"Reading file information for {file_path}")
+            track_info = trackinfo.TrackInfo.from_file(file_path)
+        if track_info.type is None:
+            logging.warning(f"File {file_path} is not a supported audio file")
+            return
+        file_size = os.path.getsize(file_path)
+
         if track is None:
             track = models.Track()
             track.directory = directory
             track.file_name = str(file_name)
+            event = CHANGE_ADDED
         else:
-            if track.last_scanned > datetime.datetime.fromtimestamp(os.path.getmtime(str(file_path))) and not force:
-                logging.debug(f"File {file_path} already scanned")
-                return
-
-        # Populate track with ID3 information
-        logging.info(f"Reading file information for {file_path}")
-        track_info = models.Track.from_id3(file_path)
+            event = CHANGE_MODIFIED
 
         # Add album artist information
         album_artist = None
-        if track_info['album_artist']:
-            album_artist = session.query(models.Artist).filter(models.Artist.name == track_info['album_artist']).first()
+        if track_info.album_artist:
+            album_artist = session.query(models.Artist).filter(models.Artist.name == track_info.album_artist).first()
             if not album_artist:
-                album_artist = models.Artist(name=track_info['album_artist'])
+                album_artist = models.Artist(name=track_info.album_artist)
                 session.add(album_artist)
-            track.album_artist = album_artist
         else:
             logging.warning("Album artist is missing")
 
         # Add track artist information
         track_artist = None
-        if track_info['track_artist']:
-            track_artist = session.query(models.Artist).filter(models.Artist.name == track_info['track_artist']).first()
+        if track_info.artist:
+            track_artist = session.query(models.Artist).filter(models.Artist.name == track_info.artist).first()
             if not track_artist:
-                track_artist = models.Artist(name=track_info['track_artist'])
+                track_artist = models.Artist(name=track_info.artist)
                 session.add(track_artist)
-            track.track_artist = track_artist
         else:
             logging.warning("Track artist is missing")
 
         # Add the album information
-        if track_info['album'] and track_info['year']:
+        if track_info.album:
             album = session.query(models.Album).filter(
-                models.Album.name == track_info['album'], models.Album.year == track_info['year']
+                models.Album.name == track_info.album, models.Album.year == track_info.year
             ).first()
             if not album:
-                album = models.Album(name=track_info['album'], year=track_info['year'], artist=album_artist)
+                album = models.Album(name=track_info.album, year=track_info.year, artist=album_artist)
                 session.add(album)
             track.album = album
         else:
-            logging.warning("Album name and/or year is missing")
+            logging.warning("Album name is missing")
 
         # Add track information
-        track.name = track_info['name']
+        track.name = track_info.title
         track.track_artist = track_artist
         track.album_artist = album_artist
-        track.disk_number = track_info['disk_number']
-        track.number = track_info['disk_number']
-        track.length = track_info['length']
-        track.encoder_info = track_info['encoder_info']
+        track.disk_number = track_info.disk_number
+        track.number = track_info.number
+        track.compilation = track_info.compilation
+        track.genre = track_info.genre
+        track.length = track_info.file_info.info.length
+        stream_info = track_info.file_info.info
+        track.codec = track_info.type.value if track_info.type else None
+        track.bitrate = getattr(stream_info, 'bitrate', None)
+        # Mutagen's bitrate modes are printed as BitrateMode.CBR, and so on
+        track.bitrate_mode = str(stream_info.bitrate_mode).rpartition('.')[2] \
+            if hasattr(stream_info, 'bitrate_mode') else None
+        track.sample_rate = getattr(stream_info, 'sample_rate', None)
+        track.channels = getattr(stream_info, 'channels', None)
+        if track_info.type == trackinfo.FileType.FLAC:
+            track.encoder = track_info.file_info.tags.vendor if track_info.file_info.tags else None
+        else:
+            track.encoder = getattr(stream_info, 'encoder_info', None) or None
+        if track_info.album_art:
+            track.art_hash = track_info.album_art.digest
+            track.art_size = len(track_info.album_art.data)
+            if art_store is not None:
+                art_store.add(track_info.album_art)
+        else:
+            # A size of zero tells tracks without album art apart from tracks scanned before the art was recorded
+            track.art_hash = None
+            track.art_size = 0
+        track.audio_hash = audio_hash if audio_hash is not None else audiohash.try_audio_hash(file_path)
+        track.file_size = file_size
         track.last_scanned = datetime.datetime.now()
 
         session.add(track)
+        if previous is not None:
+            session.flush()
+            if previous == [getattr(track, column) for column in CHANGE_COLUMNS]:
+                return
+        session.add(models.Change(event=event, path=str(file_path), track=track, timestamp=track.last_scanned))
+
+
+def saved_file_recorder() -> typing.Callable[[pathlib.Path], None] | None:
+    """Return the function that records the files saved by a tag writer in the change log of the database of the
+    application.
+
+    :return: The function, or None if the database does not exist.
+    """
+    return Database().record_saved if Database.default_path().exists() else None
 
 
 def main():
@@ -221,21 +930,50 @@ def main():
     parser.add_argument('--log-level', default='INFO', help='The logging level')
     parser.add_argument('--force', type=bool, default=False, help='If true, the action is forced without checking '
                                                                   'modified times')
+    parser.add_argument('--art-store', nargs='?', const=artstore.default_store_path(),
+                        help='Add the embedded album art of the scanned files to this art store. By default, the art '
+                             'store next to the database')
+    parser.add_argument('--max-bitrate', type=int, default=192,
+                        help='The quality action lists the tracks under this bitrate, in kbps')
+    parser.add_argument('--bitrate-mode', choices=['CBR', 'VBR', 'ABR', 'UNKNOWN'],
+                        help='The quality action only lists the tracks with this bitrate mode')
+    parser.add_argument('--since', type=int, default=0,
+                        help='The changes action lists the changes after this sequence number')
     parser.add_argument('action', help='The action to perform.')
     parser.add_argument('files', nargs='*', help='The files for which to perform the action')
+    profiling.add_arguments(parser)
+    walk.add_arguments(parser)
     args = parser.parse_args()
 
     logging.basicConfig(stream=sys.stdout, level=args.log_level.upper())
-    d = Database()
-    if args.action == 'rescan':
-        d.rescan(args.force)
-    elif args.action == 'remove_missing':
-        d.remove_missing()
-    elif args.action == 'add_directories':
-        for directory in args.files:
-            d.add_directory(directory, args.force)
-    else:
-        raise ValueError(f"Unknown action {args.action}")
+    with profiling.from_arguments(args):
+        d = Database()
+        art_store = artstore.ArtStore(args.art_store) if args.art_store else None
+        if args.action == 'rescan':
+            d.rescan(args.force, art_store, args.walk_jobs)
+        elif args.action == 'remove_missing':
+            d.remove_missing()
+        elif args.action == 'add_directories':
+            for directory in args.files:
+                d.add_directory(directory, args.force, art_store, args.walk_jobs)
+        elif args.action == 'duplicates':
+            for audio_hash, rows in itertools.groupby(d.duplicates(), key=lambda row: row.audio_hash):
+                print(audio_hash)
+                for row in rows:
+                    print(f"    {row.path}")
+        elif args.action == 'changes':
+            for row in d.changes(args.since):
+                print(f"{row.sequence}\t{row.event}\t{row.path}")
+        elif args.action == 'quality':
+            for codec, bitrate_mode, tracks, average_bitrate in d.bitrate_mode_summary():
+                average = f"{round(average_bitrate / 1000)} kbps" if average_bitrate else "unknown bitrate"
+                print(f"{codec} {bitrate_mode or ''}: {tracks} tracks, {average} on average")
+            for codec, sample_rate, tracks in d.sample_rate_histogram():
+                print(f"{codec} {sample_rate or 'unknown'} Hz: {tracks} tracks")
+            for row in d.low_bitrate_tracks(args.max_bitrate * 1000, args.bitrate_mode):
+                print(f"{round(row.bitrate / 1000):>4} kbps {row.bitrate_mode or '':<7} {row.path}")
+        else:
+            raise ValueError(f"Unknown action {args.action}")
 
 
 if __name__ == '__main__':
@@ -16,6 +16,9 @@ class Directory(Base):
     id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
     path = sqlalchemy.Column(sqlalchemy.String)
     last_scanned = sqlalchemy.Column(sqlalchemy.DateTime)
+    # The checkpoint of a scan in progress, or of an interrupted scan that the next scan resumes
+    scan_started = sqlalchemy.Column(sqlalchemy.DateTime)
+    scan_progress = sqlalchemy.Column(sqlalchemy.Integer)
 
 
 class Artist(Base):
@@ -47,15 +50,32 @@ class Track(Base):
     """Information about a track.
     """
     __tablename__ = 'tracks'
-    __table_args__ = (sqlalchemy.Index('idx_directory_file_name', 'directory_id', 'file_name'), )
+    __table_args__ = (
+        sqlalchemy.Index('idx_directory_file_name', 'directory_id', 'file_name'),
+        sqlalchemy.Index('idx_bitrate_mode_bitrate', 'bitrate_mode', 'bitrate'),
+    )
 
     id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
     name = sqlalchemy.Column(sqlalchemy.String)
     disk_number = sqlalchemy.Column(sqlalchemy.Integer)
     number = sqlalchemy.Column(sqlalchemy.Integer)
-    length = sqlalchemy.Column(sqlalchemy.Float)
+    compilation = sqlalchemy.Column(sqlalchemy.Boolean)
+    genre = sqlalchemy.Column(sqlalchemy.String)
+    length = sqlalchemy.Column(sqlalchemy.Float, index=True)
+    codec = sqlalchemy.Column(sqlalchemy.String, index=True)
+    bitrate = sqlalchemy.Column(sqlalchemy.Integer, index=True)
+    bitrate_mode = sqlalchemy.Column(sqlalchemy.String)
+    sample_rate = sqlalchemy.Column(sqlalchemy.Integer, index=True)
+    channels = sqlalchemy.Column(sqlalchemy.Integer)
+    encoder = sqlalchemy.Column(sqlalchemy.String)
     file_name = sqlalchemy.Column(sqlalchemy.String)
-    encoder_info = sqlalchemy.Column(sqlalchemy.JSON)
+    file_size = sqlalchemy.Column(sqlalchemy.Integer)
+    art_hash = sqlalchemy.Column(sqlalchemy.String, index=True)
+    art_size = sqlalchemy.Column(sqlalchemy.Integer)
+    audio_hash = sqlalchemy.Column(sqlalchemy.String, index=True)
+    integrity_status = sqlalchemy.Column(sqlalchemy.String)
+    integrity_detail = sqlalchemy.Column(sqlalchemy.String)
+    integrity_checked = sqlalchemy.Column(sqlalchemy.DateTime, index=True)
     last_scanned = sqlalchemy.Column(sqlalchemy.DateTime)
 
     directory_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('directories.id'))
@@ -67,3 +87,38 @@ class Track(Base):
     track_artist = sqlalchemy.orm.relationship('Artist', foreign_keys=[track_artist_id])
     album_artist = sqlalchemy.orm.relationship('Artist', foreign_keys=[album_artist_id])
     album = sqlalchemy.orm.relationship('Album')
+
+
+class CheckResult(Base):
+    """The cached result of checking a file. The result is valid for as long as the size and the modification time of
+    the file, and the version of the check rules, do not change.
+    """
+    __tablename__ = 'check_results'
+
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    path = sqlalchemy.Column(sqlalchemy.String, unique=True, nullable=False)
+    size = sqlalchemy.Column(sqlalchemy.Integer)
+    mtime_ns = sqlalchemy.Column(sqlalchemy.Integer)
+    rules_version = sqlalchemy.Column(sqlalchemy.String)
+    findings = sqlalchemy.Column(sqlalchemy.JSON)
+    track_info = sqlalchemy.Column(sqlalchemy.JSON)
+    last_checked = sqlalchemy.Column(sqlalchemy.DateTime)
+
+
+class Change(Base):
+    """An entry of the change log, recording that a track was added, modified or removed. The sequence numbers are
+    never reused, so that a consumer can ask for the changes after the last sequence number it processed.
+    """
+    __tablename__ = 'changes'
+    __table_args__ = (
+        sqlalchemy.Index('idx_changes_path_sequence', 'path', 'sequence'),
+        {'sqlite_autoincrement': True},
+    )
+
+    sequence = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    event = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+    path = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+    track_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('tracks.id'))
+    timestamp = sqlalchemy.Column(sqlalchemy.DateTime)
+
+    track = sqlalchemy.orm.relationship('Track')
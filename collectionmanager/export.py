@@ -0,0 +1,164 @@
+"""Export of the scanned library to CSV, JSON Lines or Parquet. The tracks are streamed from the database in batches
+and written as they are fetched, so that the memory used does not depend on the size of the library.
+"""
+import argparse
+import csv
+import datetime
+import itertools
+import json
+import logging
+import pathlib
+import sys
+import typing
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from collectionmanager import db
+
+logger = logging.getLogger(__name__)
+
+# The export formats, by file extension
+FORMATS = {
+    '.csv': 'csv',
+    '.jsonl': 'jsonl',
+    '.parquet': 'parquet',
+}
+
+# The number of rows in a Parquet row group
+PARQUET_BATCH_SIZE = 64 * 1024
+
+
+def json_value(value):
+    """Convert a column value to a value that can be serialized as JSON.
+
+    :param value: The column value.
+    :return: The JSON value.
+    """
+    return value.isoformat() if isinstance(value, datetime.datetime) else value
+
+
+def write_csv(rows: typing.Iterable[tuple], output: typing.TextIO) -> int:
+    """Write rows as CSV, with a header line.
+
+    :param rows: The rows, with the columns of db.EXPORT_COLUMNS.
+    :param output: The output stream.
+    :return: The number of rows written.
+    """
+    writer = csv.writer(output)
+    writer.writerow(db.EXPORT_COLUMNS)
+    count = 0
+    for row in rows:
+        writer.writerow(json_value(value) for value in row)
+        count += 1
+
+    return count
+
+
+def write_jsonl(rows: typing.Iterable[tuple], output: typing.TextIO) -> int:
+    """Write rows as JSON Lines, one object per row.
+
+    :param rows: The rows, with the columns of db.EXPORT_COLUMNS.
+    :param output: The output stream.
+    :return: The number of rows written.
+    """
+    count = 0
+    for row in rows:
+        output.write(json.dumps({column: json_value(value) for column, value in zip(db.EXPORT_COLUMNS, row)},
+                                ensure_ascii=False) + '\n')
+        count += 1
+
+    return count
+
+
+def parquet_schema():
+    """Return the Parquet schema of the exported columns.
+
+    :return: The pyarrow schema.
+    """
+    types = {
+        str: pyarrow.string(),
+        int: pyarrow.int64(),
+        float: pyarrow.float64(),
+        bool: pyarrow.bool_(),
+        datetime.datetime: pyarrow.timestamp('us'),
+    }
+    return pyarrow.schema([(column, types[column_type]) for column, column_type in db.EXPORT_COLUMNS.items()])
+
+
+def write_parquet(rows: typing.Iterable[tuple], output_path: str | pathlib.Path) -> int:
+    """Write rows as a Parquet file, with one row group per batch of rows. Requires pyarrow.
+
+    :param rows: The rows, with the columns of db.EXPORT_COLUMNS.
+    :param output_path: The output file path.
+    :return: The number of rows written.
+    """
+    if pyarrow is None:
+        raise RuntimeError("Exporting to Parquet requires pyarrow to be installed")
+    schema = parquet_schema()
+    count = 0
+    rows = iter(rows)
+    with pyarrow.parquet.ParquetWriter(output_path, schema) as writer:
+        while batch := list(itertools.islice(rows, PARQUET_BATCH_SIZE)):
+            writer.write_batch(pyarrow.RecordBatch.from_arrays(
+                [pyarrow.array(column, type=field.type) for column, field in zip(zip(*batch), schema)], schema=schema))
+            count += len(batch)
+
+    return count
+
+
+def export(database: db.Database, export_format: str, output: str = None, directory_path: str = None) -> int:
+    """Export the tracks of the database.
+
+    :param database: The database.
+    :param export_format: The export format, one of csv, jsonl or parquet.
+    :param output: The output file path. By default, the standard output, which is not supported for Parquet.
+    :param directory_path: Only export the tracks under this directory. By default, all tracks.
+    :return: The number of tracks exported.
+    """
+    rows = database.export_rows(directory_path)
+    if export_format == 'parquet':
+        if output is None:
+            raise ValueError("An output file is required in order to export to Parquet")
+        return write_parquet(rows, output)
+    write = write_csv if export_format == 'csv' else write_jsonl
+    if output is None:
+        return write(rows, sys.stdout)
+    with open(output, 'w', encoding='utf-8', newline='' if export_format == 'csv' else None) as f:
+        return write(rows, f)
+
+
+def main():
+    """Main entry point of the script.
+    """
+    # Configure logging, to the standard error so that the export can be written to the standard output
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+
+    # Parse arguments
+    parser = argparse.ArgumentParser(description="Export the scanned library")
+    parser.add_argument("--output", help="The file to export to. By default, the standard output")
+    parser.add_argument("--format", choices=sorted(set(FORMATS.values())),
+                        help="The export format. By default, inferred from the extension of the output file, or "
+                             "JSON Lines for the standard output")
+    parser.add_argument("--directory", help="Only export the tracks under this directory")
+    args = parser.parse_args()
+
+    export_format = args.format
+    if export_format is None:
+        export_format = FORMATS.get(pathlib.Path(args.output).suffix.lower()) if args.output else 'jsonl'
+        if export_format is None:
+            logger.error("Cannot infer the export format of %s, use --format", args.output)
+            return
+    if export_format == 'parquet' and pyarrow is None:
+        logger.error("Exporting to Parquet requires pyarrow to be installed")
+        return
+
+    count = export(db.Database(), export_format, args.output, args.directory)
+    logger.info("Exported %d tracks", count)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,64 +1,274 @@
-"""Module to manage album art.
+"""Module to manage album genre.
 """
 import argparse
+import collections
+import contextlib
+import dataclasses
 import logging
 import os
 import pathlib
-import mutagen.id3
 import sys
 
-from collectionmanager import services
+from collectionmanager import db, profiling, services, tagwriter, walk
+from collectionmanager.services import metrics
+from collectionmanager.services import FileType
 
 logger = logging.getLogger(__name__)
 
+# The minimum share of the tagged albums of an artist that must have the same genre, for it to be inferred
+MIN_GENRE_SHARE = 0.8
 
-def clear_album_genre(input_dir: str, force: bool = False):
+# The minimum number of tagged albums of an artist, for a genre to be inferred
+MIN_GENRE_ALBUMS = 2
+
+
+@dataclasses.dataclass
+class GenreGuess:
+    """Class holding a genre inferred from the library
+    """
+    genre: str
+    share: float
+    albums: int
+
+
+class GenreInference:
+    """Infers the genre of albums from the genre tags already in the library. An album that is partially tagged gets
+    the genre of its tagged tracks, and an album that is not tagged gets the genre of the other albums of its artist,
+    if they mostly agree. The most common genre of every album is counted per artist as the genres are added, so that
+    inferring a genre does not depend on the size of the library.
+    """
+    def __init__(self, min_share: float = MIN_GENRE_SHARE, min_albums: int = MIN_GENRE_ALBUMS):
+        """Create the genre inference.
+
+        :param min_share: The minimum share of the tagged albums of an artist that must have the same genre.
+        :param min_albums: The minimum number of tagged albums of an artist.
+        """
+        self.min_share = min_share
+        self.min_albums = min_albums
+        self.album_genres = collections.defaultdict(collections.Counter)
+        self.artist_genres = collections.defaultdict(collections.Counter)
+        # The files without a genre, if the inference was created from the files
+        self.untagged_files = None
+
+    def add(self, artist: str, album: str, genre: str, tracks: int = 1):
+        """Add the genre of tracks of an album.
+
+        :param artist: The album artist.
+        :param album: The album name.
+        :param genre: The genre.
+        :param tracks: The number of tracks with the genre.
+        """
+        genres = self.album_genres[(artist, album)]
+        if genres:
+            previous = genres.most_common(1)[0][0]
+            self.artist_genres[artist][previous] -= 1
+            if not self.artist_genres[artist][previous]:
+                del self.artist_genres[artist][previous]
+        genres[genre] += tracks
+        self.artist_genres[artist][genres.most_common(1)[0][0]] += 1
+
+    @classmethod
+    def from_files(cls, input_dir: str, walk_jobs: int = None, **kwargs) -> 'GenreInference':
+        """Create the genre inference from the tags of the files in a directory. The files without a genre are kept, so
+        that they are the only files read again when setting the genre.
+
+        :param input_dir: The input directory.
+        :param walk_jobs: The number of directories listed in parallel. By default, walk.DEFAULT_JOBS.
+        :param kwargs: The inference parameters.
+        :return: The genre inference.
+        """
+        inference = cls(**kwargs)
+        inference.untagged_files = []
+        input_dir_path = pathlib.Path(input_dir)
+        for file_path in walk.audio_files(input_dir_path, jobs=walk_jobs):
+            track_info = services.TrackInfo.from_file(file_path)
+            if track_info.genre:
+                artist = track_info.album_artist if track_info.album_artist else track_info.artist
+                inference.add(artist, track_info.album, track_info.genre)
+            else:
+                inference.untagged_files.append(file_path)
+
+        return inference
+
+    @classmethod
+    def from_database(cls, database: db.Database, input_dir: str, **kwargs) -> 'GenreInference':
+        """Create the genre inference from the genres stored in the database by the last scan, without reading the
+        files.
+
+        :param database: The database.
+        :param input_dir: The input directory.
+        :param kwargs: The inference parameters.
+        :return: The genre inference.
+        """
+        inference = cls(**kwargs)
+        for row in database.album_genres(input_dir):
+            inference.add(row.artist, row.album, row.genre, row.tracks)
+
+        return inference
+
+    def infer(self, artist: str, album: str) -> GenreGuess | None:
+        """Infer the genre of an album.
+
+        :param artist: The album artist.
+        :param album: The album name.
+        :return: The inferred genre, or None if the library does not have enough information about it.
+        """
+        # The tagged tracks of the album itself
+        if self.album_genres.get((artist, album)):
+            genre, tracks = self.album_genres[(artist, album)].most_common(1)[0]
+            return GenreGuess(genre, tracks / self.album_genres[(artist, album)].total(), 1)
+
+        # The other albums of the artist, counting every album once with its most common genre
+        artist_genres = self.artist_genres.get(artist)
+        if not artist_genres:
+            return None
+        albums = artist_genres.total()
+        if albums < self.min_albums:
+            return None
+        genre, count = artist_genres.most_common(1)[0]
+        if count / albums < self.min_share:
+            return None
+
+        return GenreGuess(genre, count / albums, albums)
+
+
+class AlbumGenreLookup:
+    """Looks up the genre of albums once per album, inferring it from the library where possible and otherwise
+    fetching it from a service.
+    """
+    def __init__(self, service, inference: GenreInference = None, apply_inferred: bool = True):
+        """Create the lookup.
+
+        :param service: The service to use in order to fetch the genre.
+        :param inference: The genre inference. By default, the genre is always fetched from the service.
+        :param apply_inferred: Set to false in order to only log the inferred genres, instead of returning them.
+        """
+        self.service = service
+        self.inference = inference
+        self.apply_inferred = apply_inferred
+        self.inferred_albums = 0
+        self.fetched_albums = 0
+        self._album_genres = {}
+
+    def genre(self, artist: str, album: str, infer: bool = True) -> str | None:
+        """Return the genre of an album.
+
+        :param artist: The album artist.
+        :param album: The album name.
+        :param infer: Set to false in order to always fetch the genre from the service.
+        :return: The genre, or None if it is not found.
+        """
+        if (artist, album) not in self._album_genres:
+            guess = self.inference.infer(artist, album) if self.inference and infer else None
+            if guess:
+                logger.info("Inferred genre %s for artist %s and album %s (%.0f%% of %d albums)", guess.genre,
+                            artist, album, guess.share * 100, guess.albums)
+                self._album_genres[(artist, album)] = guess.genre if self.apply_inferred else None
+                self.inferred_albums += 1
+            else:
+                self._album_genres[(artist, album)] = self.service.genre(artist, album)
+                self.fetched_albums += 1
+
+        return self._album_genres[(artist, album)]
+
+    def log_summary(self):
+        """Log the number of inferred and fetched albums.
+        """
+        logger.info("Inferred the genre of %d albums, fetched the genre of %d albums from %s", self.inferred_albums,
+                    self.fetched_albums, self.service.name)
+
+
+def clear_album_genre(input_dir: str, force: bool = False, writer: tagwriter.TagWriter = None, walk_jobs: int = None):
     """Clears album genre for all files in a directory.
 
     :param input_dir: The file path.
     :param force: Set to true in order not to ask for user confirmation.
+    :param writer: The tag writer used to save the files. By default, a new tag writer.
+    :param walk_jobs: The number of directories listed in parallel. By default, walk.DEFAULT_JOBS.
     """
-    if not force:
-        response = input("Are you sure you want to clear all album genre (y/n)? ")
-        if response == 'y':
-            logging.info("Clearing album genre for all files in %s", input_dir)
-            for file_path in pathlib.Path(input_dir).glob('**/*.mp3'):
-                track_info = services.TrackInfo(str(file_path))
-                if 'TCON' in track_info.file_info:
+    if force or input("Are you sure you want to clear all album genre (y/n)? ") == 'y':
+        logging.info("Clearing album genre for all files in %s", input_dir)
+        scan_dir = pathlib.Path(input_dir)
+        with contextlib.nullcontext(writer) if writer else tagwriter.TagWriter() as writer:
+            for file_path in walk.audio_files(scan_dir, jobs=walk_jobs):
+                if writer.is_done(file_path):
+                    continue
+                track_info = services.TrackInfo.from_file(file_path)
+                if track_info.genre:
                     logger.info("Clearing album genre from file %s", file_path)
-                    track_info.file_info.pop('TCON')
-                    track_info.file_info.save()
+                    if track_info.type == FileType.MP3:
+                        track_info.file_info.pop('TCON')
+                    elif track_info.type == FileType.FLAC:
+                        track_info.file_info.pop('genre')
+                    writer.save(track_info.file_info)
 
 
-def fetch_album_genre(input_dir: str, service, force: bool = False):
-    """Fetch album genre for files in a directory.
+def fetch_album_genre(input_dir: str, service, force: bool = False, fetch_album_art: bool = False,
+                      writer: tagwriter.TagWriter = None, inference: GenreInference = None, apply_inferred: bool = True,
+                      walk_jobs: int = None):
+    """Fetch album genre for files in a directory. If a genre inference is given, the genre of the albums is inferred
+    from the library where possible, and the service is only asked for the albums that are not known. If the inference
+    was created from the files, only the files without a genre are read again, unless album art is also fetched.
 
     :param input_dir: The input directory.
-    :param service: The service to use in order to fetch album art.
-    :param force: Set to true in order to save the album art even if it exists.
+    :param service: The service to use in order to fetch the genre.
+    :param force: Set to true in order to save the genre even if it exists. The genre is then not inferred.
+    :param fetch_album_art: Set to true in order to also fetch the album art in the same pass, if it does not exist.
+    :param writer: The tag writer used to save the files. By default, a new tag writer.
+    :param inference: The genre inference. By default, the genre is always fetched from the service.
+    :param apply_inferred: Set to false in order to only log the inferred genres, instead of saving them.
+    :param walk_jobs: The number of directories listed in parallel. By default, walk.DEFAULT_JOBS.
     """
     logging.info("Fetching album genre for all files in %s", input_dir)
-    for file_path in pathlib.Path(input_dir).glob('**/*.mp3'):
-        track_info = services.TrackInfo(str(file_path))
-        if track_info.genre is None or force:
-            genre = service.genre(track_info.album_artist, track_info.album)
-            if genre:
-                track_info.file_info.tags.add(mutagen.id3.TCON(encoding=mutagen.id3.Encoding.UTF8, text=genre))
-                track_info.file_info.save()
+    input_dir_path = pathlib.Path(input_dir)
+    lookup = AlbumGenreLookup(service, inference, apply_inferred)
+
+    if inference and inference.untagged_files is not None and not force and not fetch_album_art:
+        file_paths = inference.untagged_files
+    else:
+        file_paths = walk.audio_files(input_dir_path, jobs=walk_jobs)
+
+    def pending_album_art(writer: tagwriter.TagWriter):
+        for file_path in file_paths:
+            if writer.is_done(file_path):
+                continue
+            track_info = services.TrackInfo.from_file(file_path)
+            artist = track_info.album_artist if track_info.album_artist else track_info.artist
+            save = False
+            if not track_info.genre or force:
+                genre = lookup.genre(artist, track_info.album, infer=not force)
+                if genre:
+                    track_info.set_genre(genre)
+                    save = True
+            future = None
+            if fetch_album_art and (not track_info.album_art or force):
+                future = service.album_art_async(artist, track_info.album)
+            yield (track_info, save), future
+
+    with contextlib.nullcontext(writer) if writer else tagwriter.TagWriter() as writer:
+        # The album art images are converted while the next files are read
+        for (track_info, save), album_art in services.base.resolve_in_order(pending_album_art(writer)):
+            if album_art:
+                track_info.set_album_art(album_art)
+                save = True
+            if save:
+                writer.save(track_info.file_info)
+    lookup.log_summary()
 
 
-def export_album_genre(input_dir: str, service, force: bool = False):
-    """Export album art to a directory.
+def export_album_genre(input_dir: str, service, force: bool = False, walk_jobs: int = None):
+    """Export album genre.
 
     :param input_dir: The input directory.
-    :param service: The service to use in order to fetch album art.
-    :param force: Set to true in order to save the album art even if it exists.
-    :return:
+    :param service: The service to use in order to fetch the genre.
+    :param force: Set to true in order to fetch the genre even if it exists.
+    :param walk_jobs: The number of directories listed in parallel. By default, walk.DEFAULT_JOBS.
     """
     logging.info("Fetching genre for all files in %s", input_dir)
-    for file_path in pathlib.Path(input_dir).glob('**/*.mp3'):
-        track_info = services.TrackInfo(str(file_path))
-        if track_info.genre is None or force:
+    input_dir_path = pathlib.Path(input_dir)
+    for file_path in walk.audio_files(input_dir_path, jobs=walk_jobs):
+        track_info = services.TrackInfo.from_file(file_path)
+        if not track_info.genre or force:
             genre = service.genre(track_info.album_artist, track_info.album)
             if genre:
                 logger.info("Genre for artist %s and album %s is %s", track_info.album_artist, track_info.album, genre)
@@ -76,6 +286,23 @@ def main():
     parser.add_argument("directory", help="The directory to scan for files")
     parser.add_argument("--force", action='store_true', help="Force the action")
     parser.add_argument("--api-key", help="The API key for the service")
+    parser.add_argument("--metrics", help="Write service metrics to this file, in the Prometheus text format if it has "
+                                          "a .prom extension, otherwise as JSON. Also written on SIGUSR1")
+    parser.add_argument("--album-art", action='store_true', help="Also fetch the album art while fetching genre")
+    parser.add_argument("--infer", choices=["apply", "propose", "off"], default="apply",
+                        help="Infer the genre of albums from the genre of the other albums of the same artist, and "
+                             "only fetch the genre of the rest. With propose, the inferred genres are logged but not "
+                             "saved")
+    parser.add_argument("--database", action='store_true',
+                        help="Infer the genre from the genres stored in the database by the last scan, instead of "
+                             "reading the files")
+    parser.add_argument("--min-share", type=float, default=MIN_GENRE_SHARE,
+                        help="The minimum share of the tagged albums of an artist that must agree on a genre")
+    parser.add_argument("--min-albums", type=int, default=MIN_GENRE_ALBUMS,
+                        help="The minimum number of tagged albums of an artist, for a genre to be inferred")
+    tagwriter.add_arguments(parser)
+    profiling.add_arguments(parser)
+    walk.add_arguments(parser)
     args = parser.parse_args()
 
     service = services.DiscogsService(args.api_key)
@@ -84,12 +311,30 @@ def main():
         logging.error("%s is not a directory", args.directory)
         return
 
-    if args.action == 'fetch':
-        fetch_album_genre(args.directory, service, args.force)
-    elif args.action == 'clear':
-        clear_album_genre(args.directory, args.force)
-    elif args.action == 'export':
-        export_album_genre(args.directory, service, args.force)
+    with profiling.from_arguments(args):
+        if args.metrics:
+            metrics.REGISTRY.dump_on_signal(args.metrics)
+        try:
+            if args.action == 'fetch':
+                inference = None
+                if args.infer != 'off' and not args.force:
+                    if args.database:
+                        inference = GenreInference.from_database(
+                            db.Database(), args.directory, min_share=args.min_share, min_albums=args.min_albums)
+                    else:
+                        inference = GenreInference.from_files(
+                            args.directory, args.walk_jobs, min_share=args.min_share, min_albums=args.min_albums)
+                with tagwriter.from_arguments(args, db.saved_file_recorder()) as writer:
+                    fetch_album_genre(args.directory, service, args.force, args.album_art, writer, inference,
+                                      args.infer == 'apply', args.walk_jobs)
+            elif args.action == 'clear':
+                with tagwriter.from_arguments(args, db.saved_file_recorder()) as writer:
+                    clear_album_genre(args.directory, args.force, writer, args.walk_jobs)
+            elif args.action == 'export':
+                export_album_genre(args.directory, service, args.force, args.walk_jobs)
+        finally:
+            if args.metrics:
+                metrics.REGISTRY.dump(args.metrics)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,437 @@
+"""Verification of the integrity of the audio of FLAC and MP3 files, in order to detect bit rot. FLAC files are tested
+with the flac command line tool if it is installed, which decodes the audio and compares it with the MD5 in the
+STREAMINFO block. Otherwise, and for MP3 files, the checksums stored in the frames are verified: the header and frame
+CRCs of every FLAC frame, the CRC of MP3 frames that are protected by one, and the music CRC of the LAME tag. The
+CRCs are computed with crcmod if it is installed, which is much faster than the fallback implementation in Python. The
+results are stored in the database, so that a verification can be resumed, and repeated when it gets old.
+"""
+import argparse
+import concurrent.futures
+import dataclasses
+import datetime
+import logging
+import mmap
+import os
+import pathlib
+import shutil
+import subprocess
+import sys
+
+try:
+    import crcmod
+except ImportError:
+    crcmod = None
+
+from collectionmanager import audiohash, db
+
+logger = logging.getLogger(__name__)
+
+# The number of files sent to a worker process at once
+CHUNK_SIZE = 4
+
+# The number of results saved to the database at once
+SAVE_BATCH_SIZE = 100
+
+# The result statuses
+STATUS_OK = 'ok'
+STATUS_CORRUPT = 'corrupt'
+STATUS_WARNING = 'warning'
+STATUS_UNVERIFIED = 'unverified'
+STATUS_ERROR = 'error'
+
+# The MP3 bitrates in kbps, by version and layer, and sample rates in Hz, by version
+MP3_BITRATES = {
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (2, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+MP3_SAMPLE_RATES = {1: [44100, 48000, 32000], 2: [22050, 24000, 16000], 2.5: [11025, 12000, 8000]}
+
+
+def _crc_table(polynomial: int, width: int) -> list[int]:
+    """Create the lookup table of a most significant bit first CRC.
+
+    :param polynomial: The CRC polynomial.
+    :param width: The CRC width in bits.
+    :return: The table.
+    """
+    top_bit = 1 << (width - 1)
+    mask = (1 << width) - 1
+    table = []
+    for byte in range(256):
+        crc = byte << (width - 8)
+        for _ in range(8):
+            crc = ((crc << 1) ^ polynomial) & mask if crc & top_bit else (crc << 1) & mask
+        table.append(crc)
+
+    return table
+
+
+def _reflected_crc_table(polynomial: int) -> list[int]:
+    """Create the lookup table of a least significant bit first CRC.
+
+    :param polynomial: The reflected CRC polynomial.
+    :return: The table.
+    """
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ polynomial if crc & 1 else crc >> 1
+        table.append(crc)
+
+    return table
+
+
+CRC8_TABLE = _crc_table(0x07, 8)
+CRC16_TABLE = _crc_table(0x8005, 16)
+CRC16_ARC_TABLE = _reflected_crc_table(0xA001)
+
+
+def crc8(data, crc: int = 0) -> int:
+    """Compute the CRC-8 used by FLAC frame headers.
+
+    :param data: The data.
+    :param crc: The initial value.
+    :return: The CRC.
+    """
+    for byte in data:
+        crc = CRC8_TABLE[crc ^ byte]
+
+    return crc
+
+
+def _crc16(data, crc: int = 0) -> int:
+    """Compute the CRC-16 used by FLAC frames and MP3 frames.
+
+    :param data: The data.
+    :param crc: The initial value, which allows computing the CRC in parts.
+    :return: The CRC.
+    """
+    table = CRC16_TABLE
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ table[(crc >> 8) ^ byte]
+
+    return crc
+
+
+def _crc16_arc(data, crc: int = 0) -> int:
+    """Compute the CRC-16 used by the LAME tag.
+
+    :param data: The data.
+    :param crc: The initial value, which allows computing the CRC in parts.
+    :return: The CRC.
+    """
+    table = CRC16_ARC_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+
+    return crc
+
+
+if crcmod is not None:
+    crc16 = crcmod.mkCrcFun(0x18005, initCrc=0, rev=False, xorOut=0)
+    crc16_arc = crcmod.mkCrcFun(0x18005, initCrc=0, rev=True, xorOut=0)
+else:
+    crc16 = _crc16
+    crc16_arc = _crc16_arc
+
+
+@dataclasses.dataclass
+class IntegrityResult:
+    """Class holding the result of verifying a file
+    """
+    status: str
+    detail: str = None
+
+
+def _flac_header_size(data, offset: int) -> int | None:
+    """Return the size of a FLAC frame header, including its CRC-8, if a valid header starts at an offset.
+
+    :param data: The file data.
+    :param offset: The offset.
+    :return: The header size, or None if there is no valid header at the offset.
+    """
+    if len(data) - offset < 6 or data[offset] != 0xFF or data[offset + 1] not in (0xF8, 0xF9):
+        return None
+    block_size_code = data[offset + 2] >> 4
+    sample_rate_code = data[offset + 2] & 0x0F
+    if block_size_code == 0 or sample_rate_code == 0x0F or data[offset + 3] & 0x01:
+        return None
+    # The frame or sample number, coded like UTF-8
+    first = data[offset + 4]
+    if first < 0x80:
+        number_size = 1
+    elif first >= 0xC0:
+        number_size = 2
+        while number_size < 7 and first & (0x80 >> number_size):
+            number_size += 1
+    else:
+        return None
+    size = 4 + number_size
+    size += {6: 1, 7: 2}.get(block_size_code, 0)
+    size += {12: 1, 13: 2, 14: 2}.get(sample_rate_code, 0)
+    if offset + size >= len(data) or crc8(data[offset:offset + size]) != data[offset + size]:
+        return None
+
+    return size + 1
+
+
+def verify_flac_frames(file_path: pathlib.Path) -> IntegrityResult:
+    """Verify the header CRC-8 and the frame CRC-16 of every frame of a FLAC file. Frames are delimited by looking for
+    the next valid frame header after which the CRC-16 of the frame so far is zero.
+
+    :param file_path: The file path.
+    :return: The result.
+    """
+    start, end = audiohash.audio_region(file_path)
+    if end - start == 0:
+        return IntegrityResult(STATUS_CORRUPT, "No audio frames")
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        view = memoryview(data)
+        try:
+            frames = 0
+            frame_start = start
+            if _flac_header_size(data, frame_start) is None:
+                return IntegrityResult(STATUS_CORRUPT, f"No frame header at offset {frame_start}")
+            crc = 0
+            position = frame_start
+            while True:
+                # Find the next sync code, which may be the start of the next frame
+                candidate = data.find(b'\xff\xf8', position + 1, end)
+                candidate_variable = data.find(b'\xff\xf9', position + 1, end)
+                if candidate_variable != -1 and (candidate == -1 or candidate_variable < candidate):
+                    candidate = candidate_variable
+                if candidate == -1:
+                    crc = crc16(view[position:end], crc)
+                    if crc != 0:
+                        return IntegrityResult(STATUS_CORRUPT, f"CRC mismatch in frame at offset {frame_start}")
+                    frames += 1
+                    break
+                crc = crc16(view[position:candidate], crc)
+                position = candidate
+                if crc == 0 and _flac_header_size(data, candidate) is not None:
+                    frames += 1
+                    frame_start = candidate
+        finally:
+            view.release()
+
+    return IntegrityResult(STATUS_OK, f"{frames} frames")
+
+
+def verify_flac(file_path: pathlib.Path) -> IntegrityResult:
+    """Verify a FLAC file, with the flac command line tool if it is installed, or else by verifying its frame CRCs.
+
+    :param file_path: The file path.
+    :return: The result.
+    """
+    flac = shutil.which('flac')
+    if flac is None:
+        return verify_flac_frames(file_path)
+    process = subprocess.run([flac, '--test', '--silent', str(file_path)], capture_output=True, text=True)
+    if process.returncode != 0:
+        return IntegrityResult(STATUS_CORRUPT, process.stderr.strip().splitlines()[-1] if process.stderr else None)
+
+    return IntegrityResult(STATUS_OK, "MD5 verified")
+
+
+def _mp3_frame(data, offset: int) -> tuple[int, bool, int] | None:
+    """Parse an MP3 frame header.
+
+    :param data: The file data.
+    :param offset: The offset of the header.
+    :return: The frame size, whether it is protected by a CRC and the size of its layer III side information, or None
+        if there is no valid header at the offset.
+    """
+    if len(data) - offset < 4 or data[offset] != 0xFF or data[offset + 1] & 0xE0 != 0xE0:
+        return None
+    version = {3: 1, 2: 2, 0: 2.5}.get((data[offset + 1] >> 3) & 0x03)
+    layer = {3: 1, 2: 2, 1: 3}.get((data[offset + 1] >> 1) & 0x03)
+    bitrate_index = data[offset + 2] >> 4
+    sample_rate_index = (data[offset + 2] >> 2) & 0x03
+    if version is None or layer is None or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+    protected = not data[offset + 1] & 0x01
+    padding = (data[offset + 2] >> 1) & 0x01
+    mono = data[offset + 3] >> 6 == 3
+    bitrate = MP3_BITRATES[(1 if version == 1 else 2, layer)][bitrate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][sample_rate_index]
+    if layer == 1:
+        size = (12 * bitrate // sample_rate + padding) * 4
+    elif layer == 3 and version != 1:
+        size = 72 * bitrate // sample_rate + padding
+    else:
+        size = 144 * bitrate // sample_rate + padding
+    side_info_size = 0
+    if layer == 3:
+        side_info_size = (17 if mono else 32) if version == 1 else (9 if mono else 17)
+
+    return size, protected, side_info_size
+
+
+def _mp3_resync(data, offset: int, end: int) -> int | None:
+    """Find the next offset where a valid MP3 frame is followed by another valid frame.
+
+    :param data: The file data.
+    :param offset: The offset to start searching from.
+    :param end: The end of the audio payload.
+    :return: The offset, or None if the frames cannot be found again before the end of the audio payload.
+    """
+    position = data.find(b'\xff', offset, end)
+    while position != -1:
+        frame = _mp3_frame(data, position)
+        if frame is not None and position + frame[0] < end and _mp3_frame(data, position + frame[0]) is not None:
+            return position
+        position = data.find(b'\xff', position + 1, end)
+
+    return None
+
+
+def verify_mp3(file_path: pathlib.Path) -> IntegrityResult:
+    """Verify an MP3 file, by walking its frames, verifying the CRC of the layer III frames that have one, and the
+    music CRC of the LAME tag if the file has one. Data after the last frame that is not followed by more frames, such
+    as junk or a Lyrics3 tag, results in a warning, since the audio is not damaged.
+
+    :param file_path: The file path.
+    :return: The result.
+    """
+    start, end = audiohash.audio_region(file_path)
+    if end - start == 0:
+        return IntegrityResult(STATUS_CORRUPT, "No audio frames")
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        view = memoryview(data)
+        try:
+            frames = 0
+            checked_frames = 0
+            music_crc = None
+            music_start = start
+            position = start
+            trailing = None
+            while position < end:
+                frame = _mp3_frame(data, position)
+                if frame is None:
+                    if frames == 0 or _mp3_resync(data, position + 1, end) is not None:
+                        return IntegrityResult(STATUS_CORRUPT, f"Lost frame sync at offset {position}")
+                    description = "Lyrics3 tag" if data[position:position + 11] == b'LYRICSBEGIN' else "trailing data"
+                    trailing = f"{end - position} bytes of {description} at offset {position}"
+                    break
+                size, protected, side_info_size = frame
+                if position + size > end:
+                    return IntegrityResult(STATUS_CORRUPT, f"Truncated frame at offset {position}")
+                if frames == 0:
+                    # The LAME tag follows the Xing header of the first frame, and ends with a CRC of the frame up to it
+                    header = bytes(view[position:position + size])
+                    xing = max(header.find(b'Xing'), header.find(b'Info'))
+                    lame = xing + 120
+                    if xing != -1 and header[lame:lame + 4] == b'LAME' and len(header) >= lame + 36 and \
+                            crc16_arc(header[:lame + 34]) == int.from_bytes(header[lame + 34:lame + 36], 'big'):
+                        music_crc = int.from_bytes(header[lame + 32:lame + 34], 'big')
+                        music_start = position + size
+                if protected and side_info_size:
+                    crc = crc16(view[position + 2:position + 4], 0xFFFF)
+                    crc = crc16(view[position + 6:position + 6 + side_info_size], crc)
+                    if crc != int.from_bytes(view[position + 4:position + 6], 'big'):
+                        return IntegrityResult(STATUS_CORRUPT, f"CRC mismatch in frame at offset {position}")
+                    checked_frames += 1
+                frames += 1
+                position += size
+            if music_crc is not None and crc16_arc(view[music_start:position]) != music_crc:
+                return IntegrityResult(STATUS_CORRUPT, "LAME music CRC mismatch")
+        finally:
+            view.release()
+
+    if music_crc is not None:
+        result = IntegrityResult(STATUS_OK, f"{frames} frames, LAME music CRC verified")
+    elif checked_frames:
+        result = IntegrityResult(STATUS_OK, f"{frames} frames, {checked_frames} frame CRCs verified")
+    else:
+        result = IntegrityResult(STATUS_UNVERIFIED, f"{frames} frames, no checksums")
+    if trailing:
+        return IntegrityResult(STATUS_WARNING, f"{result.detail}, {trailing}")
+
+    return result
+
+
+def verify_file(file_path: str | pathlib.Path) -> IntegrityResult:
+    """Verify a file.
+
+    :param file_path: The file path.
+    :return: The result.
+    """
+    file_path = pathlib.Path(file_path)
+    try:
+        if file_path.suffix.lower() == '.flac':
+            return verify_flac(file_path)
+        elif file_path.suffix.lower() == '.mp3':
+            return verify_mp3(file_path)
+        return IntegrityResult(STATUS_UNVERIFIED, "Unsupported file type")
+    except (OSError, ValueError) as e:
+        return IntegrityResult(STATUS_ERROR, str(e))
+
+
+def verify_tracks(database: db.Database, max_age: datetime.timedelta = None, limit: int = None,
+                  jobs: int = None) -> dict[str, int]:
+    """Verify the tracks of the registered directories in a process pool, starting with the tracks that were never
+    verified and then the oldest verifications. The results are saved in batches, so an interrupted verification
+    resumes where it stopped.
+
+    :param database: The database.
+    :param max_age: Verify again the tracks verified longer ago than this. By default, tracks are verified once.
+    :param limit: The maximum number of tracks to verify.
+    :param jobs: The number of worker processes. By default, the number of CPUs.
+    :return: The number of tracks verified per status.
+    """
+    tracks = list(database.tracks_to_verify(max_age, limit))
+    logger.info("Verifying %d tracks", len(tracks))
+    counts = dict.fromkeys([STATUS_OK, STATUS_WARNING, STATUS_CORRUPT, STATUS_UNVERIFIED, STATUS_ERROR], 0)
+    batch = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        results = executor.map(verify_file, [path for _, path in tracks], chunksize=CHUNK_SIZE)
+        for (track_id, path), result in zip(tracks, results):
+            if result.status in (STATUS_WARNING, STATUS_CORRUPT, STATUS_ERROR):
+                logger.warning("%s: %s (%s)", path, result.status, result.detail)
+            else:
+                logger.debug("%s: %s (%s)", path, result.status, result.detail)
+            counts[result.status] += 1
+            batch.append({
+                'id': track_id, 'integrity_status': result.status, 'integrity_detail': result.detail,
+                'integrity_checked': datetime.datetime.now(),
+            })
+            if len(batch) >= SAVE_BATCH_SIZE:
+                database.save_integrity_results(batch)
+                batch = []
+    database.save_integrity_results(batch)
+
+    return counts
+
+
+def main():
+    """Main entry point of the script.
+    """
+    # Configure logging
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    # Parse arguments
+    parser = argparse.ArgumentParser(description="Verify the integrity of the audio of the tracks in the library")
+    parser.add_argument("action", choices=["verify", "report"], help="The action to perform")
+    parser.add_argument("--max-age", type=float,
+                        help="Verify again the tracks verified more than this many days ago")
+    parser.add_argument("--limit", type=int, help="The maximum number of tracks to verify in this run")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="The number of files to verify in parallel")
+    args = parser.parse_args()
+
+    database = db.Database()
+    if args.action == 'verify':
+        max_age = datetime.timedelta(days=args.max_age) if args.max_age is not None else None
+        counts = verify_tracks(database, max_age, args.limit, args.jobs)
+        logger.info("Verified tracks: %s", ', '.join(f"{count} {status}" for status, count in counts.items()))
+    elif args.action == 'report':
+        for row in database.integrity_report():
+            print(f"{row.integrity_status}\t{row.integrity_checked:%Y-%m-%d %H:%M}\t{row.path}\t{row.integrity_detail}")
+
+
+if __name__ == '__main__':
+    main()
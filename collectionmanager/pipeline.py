@@ -0,0 +1,465 @@
+"""A maintenance pipeline, that walks the library once and reads every file once. The track information of every file
+is streamed through the selected stages, which run in their own threads and are connected with bounded queues, so that
+the network bound stages overlap with reading the files and the memory use does not depend on the size of the
+library. The files changed by the stages are saved before they reach the database stage, so that the database records
+them as they are on disk.
+"""
+import argparse
+import collections
+import concurrent.futures
+import dataclasses
+import datetime
+import itertools
+import logging
+import pathlib
+import queue
+import sys
+import threading
+import time
+import typing
+
+from collectionmanager import albumart, artstore, audiohash, autofix, check, db, genre, profiling, services, \
+    tagwriter, walk
+from collectionmanager.services import metrics, trackinfo
+
+logger = logging.getLogger(__name__)
+
+# The stages, in the order in which they run
+STAGES = ['autofix', 'art', 'genre', 'check', 'db']
+
+# The stages that use the track information of every file, including the files that did not change since the last scan
+READING_STAGES = {'autofix', 'art', 'genre', 'check'}
+
+# The default number of records waiting between two stages
+DEFAULT_QUEUE_SIZE = 64
+
+# The default number of files read in parallel
+DEFAULT_READ_JOBS = 4
+
+# Marks the end of the records in a queue
+_END = object()
+
+
+@dataclasses.dataclass
+class Record:
+    """Class holding a file while it passes through the pipeline
+    """
+    path: pathlib.Path
+    track_info: trackinfo.TrackInfo
+    audio_hash: str = None
+    save: bool = False
+    # True if the changes of the track information were not saved to the file, because the save failed or in a dry run
+    unsaved: bool = False
+    # True if the file did not change since the last scan, so that the audio hash is the one recorded by it
+    unchanged: bool = False
+
+
+# A stage transforms a stream of records into a stream of records
+Stage = typing.Callable[[typing.Iterator[Record]], typing.Iterator[Record]]
+
+
+def read_file(file_path: pathlib.Path, hash_audio: bool = False, stored_hash: str = None) -> Record:
+    """Read a file.
+
+    :param file_path: The file path.
+    :param hash_audio: Set to true in order to also hash the audio of the file.
+    :param stored_hash: The audio hash recorded by the last scan, if the file did not change since it. The audio is
+        then not hashed again.
+    :return: The record of the file.
+    """
+    if stored_hash is not None:
+        return Record(file_path, trackinfo.TrackInfo.from_file(file_path), stored_hash, unchanged=True)
+
+    return Record(file_path, trackinfo.TrackInfo.from_file(file_path),
+                  audiohash.try_audio_hash(file_path) if hash_audio else None)
+
+
+def stored_hashes(database: db.Database, scan_dir: pathlib.Path,
+                  files: typing.Iterable[walk.WalkedFile]) -> typing.Iterator[tuple[pathlib.Path, str | None]]:
+    """Pair files with the audio hash recorded by the last scan, if their size is the same and they were not modified
+    after it, like the scan of a directory does. The scan records are looked up in batches of QUERY_BATCH_SIZE files.
+
+    :param database: The database.
+    :param scan_dir: The scan directory.
+    :param files: The files, with their stat results.
+    :return: An iterator over the file paths and their recorded audio hashes, or None for the files that changed.
+    """
+    files = iter(files)
+    while batch := list(itertools.islice(files, db.QUERY_BATCH_SIZE)):
+        tracks = database.scanned_tracks(str(scan_dir), [walked_file.path for walked_file in batch])
+        for walked_file in batch:
+            track = tracks.get(walked_file.path)
+            unchanged = track is not None and track.audio_hash is not None and track.last_scanned is not None and \
+                track.file_size == walked_file.stat.st_size and \
+                datetime.datetime.fromtimestamp(walked_file.stat.st_mtime) < track.last_scanned
+            yield walked_file.path, track.audio_hash if unchanged else None
+
+
+def read_files(files: typing.Iterable[pathlib.Path | tuple[pathlib.Path, str | None]], jobs: int = DEFAULT_READ_JOBS,
+               window: int = DEFAULT_QUEUE_SIZE, hash_audio: bool = False) -> typing.Iterator[Record]:
+    """Read files in a thread pool, keeping at most a window of files in flight. The records are returned in the order
+    of the files. Files that cannot be read are logged and skipped.
+
+    :param files: The files, or pairs of a file and the audio hash recorded by the last scan, as returned by
+        stored_hashes.
+    :param jobs: The number of files read in parallel.
+    :param window: The maximum number of files read ahead.
+    :param hash_audio: Set to true in order to also hash the audio of the files.
+    :return: An iterator over the records.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='reader') as executor:
+        in_flight = collections.deque()
+        for file_path in itertools.chain(files, [None]):
+            if file_path is not None:
+                file_path, stored_hash = file_path if isinstance(file_path, tuple) else (file_path, None)
+                in_flight.append((file_path, executor.submit(read_file, file_path, hash_audio, stored_hash)))
+            while in_flight and (len(in_flight) >= window or file_path is None):
+                read_path, future = in_flight.popleft()
+                try:
+                    record = future.result()
+                except Exception as e:
+                    logger.error("Could not read %s: %s", read_path, e)
+                    continue
+                if record.track_info.type is not None:
+                    yield record
+
+
+def autofix_stage() -> Stage:
+    """Create the stage that fixes the track number, disk number and album artist of MP3 files.
+
+    :return: The stage.
+    """
+    def stage(records: typing.Iterator[Record]) -> typing.Iterator[Record]:
+        for record in records:
+            fixes = autofix.plan_track_info(record.path, record.track_info)
+            if fixes:
+                for fix in fixes:
+                    logger.info("%s: setting %s from %r to %r (%s)", record.path, fix.frame, fix.old, fix.new,
+                                fix.rule)
+                autofix.apply_fixes(record.track_info.file_info, fixes)
+                record.track_info = trackinfo.TrackInfo.from_file_info(record.track_info.file_info)
+                record.save = True
+            yield record
+
+    return stage
+
+
+def art_stage(service, force: bool = False) -> Stage:
+    """Create the stage that fetches the album art of files that do not have it. Album art is fetched once per album.
+    Only the album art of the current album is kept, as the tracks of an album are consecutive in the order of a walk.
+
+    :param service: The service to use in order to fetch album art.
+    :param force: Set to true in order to save the album art even if it exists.
+    :return: The stage.
+    """
+    def stage(records: typing.Iterator[Record]) -> typing.Iterator[Record]:
+        def pending_album_art():
+            album, album_art = None, None
+            for record in records:
+                track_info = record.track_info
+                future = None
+                if not track_info.album_art or force:
+                    artist = track_info.album_artist if track_info.album_artist else track_info.artist
+                    if (artist, track_info.album) != album:
+                        album = (artist, track_info.album)
+                        album_art = service.album_art_async(artist, track_info.album, cache=False)
+                    future = album_art
+                yield record, future
+
+        # The images are converted while the next records are read and their album art is fetched
+        for record, data in services.base.resolve_in_order(pending_album_art()):
+            if data:
+                record.track_info.set_album_art(data)
+                record.save = True
+            yield record
+
+    return stage
+
+
+def genre_stage(lookup: genre.AlbumGenreLookup, force: bool = False) -> Stage:
+    """Create the stage that sets the genre of files that do not have it.
+
+    :param lookup: The album genre lookup.
+    :param force: Set to true in order to save the genre even if it exists.
+    :return: The stage.
+    """
+    def stage(records: typing.Iterator[Record]) -> typing.Iterator[Record]:
+        for record in records:
+            track_info = record.track_info
+            if not track_info.genre or force:
+                artist = track_info.album_artist if track_info.album_artist else track_info.artist
+                album_genre = lookup.genre(artist, track_info.album, infer=not force)
+                if album_genre:
+                    track_info.set_genre(album_genre)
+                    record.save = True
+            yield record
+        lookup.log_summary()
+
+    return stage
+
+
+def check_stage(scan_dir: pathlib.Path, output: typing.TextIO, check_album_art: bool = True,
+                album_rules: bool = True) -> Stage:
+    """Create the stage that checks the files, and the consistency of every album directory. The files of an album
+    directory are held until the next directory starts, so they are expected to be consecutive, as they are in the
+    order of a walk.
+
+    :param scan_dir: The scan directory.
+    :param output: The stream where the findings are written as JSON Lines.
+    :param check_album_art: Set to true to check for album art existence.
+    :param album_rules: Set to true to check the consistency of the tracks of every album directory.
+    :return: The stage.
+    """
+    def stage(records: typing.Iterator[Record]) -> typing.Iterator[Record]:
+        for album_dir, album_records in itertools.groupby(records, key=lambda record: record.path.parent):
+            album_records = list(album_records)
+            findings = [
+                finding for record in album_records
+                for finding in check.check_track_info(scan_dir, record.path, record.track_info, check_album_art)
+            ]
+            if album_rules:
+                findings.extend(check.check_album(album_dir, [record.track_info for record in album_records]))
+            check.write_findings(findings, output)
+            yield from album_records
+
+    return stage
+
+
+def save_stage(writer: tagwriter.TagWriter, dry_run: bool = False, window: int = DEFAULT_QUEUE_SIZE) -> Stage:
+    """Create the stage that saves the files changed by the previous stages. Files are saved in the background by the
+    tag writer, and the records are passed on in order once their file is saved.
+
+    :param writer: The tag writer.
+    :param dry_run: Set to true in order to not save the files, marking the changed records as unsaved instead.
+    :param window: The maximum number of records waiting for their file to be saved.
+    :return: The stage.
+    """
+    def stage(records: typing.Iterator[Record]) -> typing.Iterator[Record]:
+        in_flight = collections.deque()
+        for record in itertools.chain(records, [None]):
+            if record is not None:
+                if record.save and dry_run:
+                    record.unsaved = True
+                in_flight.append((record, writer.save(record.track_info.file_info) if record.save and not dry_run
+                                  else None))
+            while in_flight and (record is None or len(in_flight) >= window or
+                                 in_flight[0][1] is None or in_flight[0][1].done()):
+                saved_record, future = in_flight.popleft()
+                if future is not None and not future.result():
+                    saved_record.unsaved = True
+                yield saved_record
+
+    return stage
+
+
+def db_stage(database: db.Database, scan_dir: pathlib.Path, art_store: artstore.ArtStore = None) -> Stage:
+    """Create the stage that saves the track information of the files to the database. The files whose changes were
+    not saved are skipped, so that they are read again by the next scan, and so are the files that did not change since
+    the last scan.
+
+    :param database: The database.
+    :param scan_dir: The scan directory, which is added to the library.
+    :param art_store: The store where the embedded album art is added. By default, album art is not stored.
+    :return: The stage.
+    """
+    def stage(records: typing.Iterator[Record]) -> typing.Iterator[Record]:
+        with database.track_updates(str(scan_dir), art_store) as update:
+            for record in records:
+                if not record.unsaved and (record.save or not record.unchanged):
+                    update(record.path, record.track_info, record.audio_hash)
+                yield record
+
+    return stage
+
+
+def _drain(records_queue: queue.Queue) -> typing.Iterator[Record]:
+    """Return the records of a queue, until the end marker.
+
+    :param records_queue: The queue.
+    :return: An iterator over the records.
+    """
+    while (record := records_queue.get()) is not _END:
+        yield record
+
+
+class Pipeline:
+    """Runs stages in their own threads, connected with bounded queues. A stage that fails is logged, and the records
+    are passed through it unchanged from then on, so that the rest of the pipeline can finish.
+    """
+    def __init__(self, stages: list[tuple[str, Stage]], queue_size: int = DEFAULT_QUEUE_SIZE):
+        """Create the pipeline.
+
+        :param stages: The stages and their names, in order.
+        :param queue_size: The maximum number of records waiting between two stages.
+        """
+        self.stages = stages
+        self.queue_size = queue_size
+        self.counts = collections.Counter()
+
+    def _run_stage(self, name: str, stage: Stage, input_queue: queue.Queue, output_queue: queue.Queue):
+        """Run a stage, moving records from its input queue to its output queue.
+
+        :param name: The stage name.
+        :param stage: The stage.
+        :param input_queue: The input queue.
+        :param output_queue: The output queue.
+        """
+        try:
+            for record in stage(_drain(input_queue)):
+                self.counts[name] += 1
+                output_queue.put(record)
+        except Exception:
+            logger.exception("Stage %s failed, passing the remaining records through", name)
+            for record in _drain(input_queue):
+                output_queue.put(record)
+        finally:
+            output_queue.put(_END)
+
+    def _feed(self, records: typing.Iterable[Record], output_queue: queue.Queue):
+        """Move the source records to the first queue.
+
+        :param records: The source records.
+        :param output_queue: The first queue.
+        """
+        try:
+            for record in records:
+                self.counts['read'] += 1
+                output_queue.put(record)
+        except Exception:
+            logger.exception("Reading the files failed")
+        finally:
+            output_queue.put(_END)
+
+    def run(self, records: typing.Iterable[Record]) -> typing.Iterator[Record]:
+        """Run the pipeline.
+
+        :param records: The source records.
+        :return: An iterator over the records that passed through all stages.
+        """
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self._feed, args=(records, queues[0]), name='pipeline-read', daemon=True)]
+        for (name, stage), input_queue, output_queue in zip(self.stages, queues, queues[1:]):
+            threads.append(threading.Thread(target=self._run_stage, args=(name, stage, input_queue, output_queue),
+                                            name=f'pipeline-{name}', daemon=True))
+        for thread in threads:
+            thread.start()
+        yield from _drain(queues[-1])
+        for thread in threads:
+            thread.join()
+
+
+def run(args: argparse.Namespace):
+    """Run the maintenance pipeline.
+
+    :param args: The parsed arguments.
+    """
+    scan_dir = pathlib.Path(args.directory).resolve()
+    if not scan_dir.is_dir():
+        logging.error("%s is not a directory", args.directory)
+        return
+    selected = set(args.stages)
+    database = db.Database() if {'db', 'genre'} & selected else None
+
+    # The genres are fetched from Discogs. When the album art is fetched from it too, the stages share the service, so
+    # that every album is searched once, and the requests of both stages are within its rate limit
+    shared_service = {'art', 'genre'} <= selected and args.art_service == 'discogs'
+    genre_service = None
+    if 'genre' in selected:
+        genre_service = services.DiscogsService(args.genre_api_key or (args.art_api_key if shared_service else None))
+
+    stages = []
+    if 'autofix' in selected:
+        stages.append(('autofix', autofix_stage()))
+    if 'art' in selected:
+        service = genre_service if shared_service else albumart.create_service(args.art_service, args.art_api_key)
+        service.image_options.max_dimension = args.max_size
+        stages.append(('art', art_stage(service, args.force)))
+    if 'genre' in selected:
+        inference = genre.GenreInference.from_database(database, str(scan_dir)) if args.infer != 'off' else None
+        lookup = genre.AlbumGenreLookup(genre_service, inference, args.infer == 'apply')
+        stages.append(('genre', genre_stage(lookup, args.force)))
+    output = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    if 'check' in selected:
+        stages.append(('check', check_stage(scan_dir, output, args.check_album_art, args.album_rules)))
+    if 'db' in selected:
+        art_store = artstore.ArtStore(args.art_store) if args.art_store else None
+        stages.append(('db', db_stage(database, scan_dir, art_store)))
+
+    if args.metrics:
+        metrics.REGISTRY.dump_on_signal(args.metrics)
+    start = time.perf_counter()
+    try:
+        # The db stage records the saved files itself, after they are saved
+        with tagwriter.from_arguments(args, None if 'db' in selected else db.saved_file_recorder()) as writer:
+            if {'autofix', 'art', 'genre'} & selected:
+                stages.insert(len(stages) - 1 if 'db' in selected else len(stages),
+                              ('save', save_stage(writer, args.dry_run, args.queue_size)))
+            pipeline = Pipeline(stages, args.queue_size)
+            # The files of a directory are walked consecutively, as the check stage expects
+            if 'db' in selected:
+                # The files that did not change since the last scan are not hashed again, and are only read if another
+                # stage needs them
+                files = profiling.iterate(profiling.WALK, walk.walk_files(scan_dir, jobs=args.walk_jobs, stat=True))
+                files = stored_hashes(database, scan_dir, files)
+                if not READING_STAGES & selected:
+                    files = (file_path for file_path, stored_hash in files if stored_hash is None)
+            else:
+                files = walk.audio_files(scan_dir, jobs=args.walk_jobs)
+            records = read_files(files, args.read_jobs, args.queue_size, hash_audio='db' in selected)
+            for _ in pipeline.run(records):
+                pass
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        if args.metrics:
+            metrics.REGISTRY.dump(args.metrics)
+    seconds = time.perf_counter() - start
+    logger.info("Processed %d files in %.2f seconds (%.2f files/sec)", pipeline.counts['read'], seconds,
+                pipeline.counts['read'] / seconds if seconds else 0.0)
+
+
+def main():
+    """Main entry point of the script.
+    """
+    # Configure logging, to the standard error so that the findings can be written to the standard output
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+
+    # Parse arguments
+    parser = argparse.ArgumentParser(prog='collection-manager', description="Maintain the music library")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help="Walk the library once, passing every file through the stages")
+    run_parser.add_argument("directory", help="The directory to scan for files")
+    run_parser.add_argument("--stages", nargs='+', choices=STAGES, default=['check', 'db'],
+                            help="The stages to run. They always run in the order autofix, art, genre, check, db")
+    run_parser.add_argument("--force", action='store_true', help="Fetch album art and genre even if they exist")
+    run_parser.add_argument("--dry-run", action='store_true', help="Do not save the changed files")
+    run_parser.add_argument("--read-jobs", type=int, default=DEFAULT_READ_JOBS,
+                            help="The number of files to read in parallel")
+    run_parser.add_argument("--queue-size", type=int, default=DEFAULT_QUEUE_SIZE,
+                            help="The maximum number of files waiting between two stages")
+    run_parser.add_argument("--output", help="The file to write the findings to. By default, the standard output")
+    run_parser.add_argument("--check-album-art", action=argparse.BooleanOptionalAction, default=True)
+    run_parser.add_argument("--album-rules", action=argparse.BooleanOptionalAction, default=True,
+                            help="Check the consistency of the tracks of every album directory")
+    run_parser.add_argument("--art-service", choices=["lastfm", "musicbrainz", "discogs"], default="lastfm",
+                            help="The service to fetch album art from")
+    run_parser.add_argument("--art-api-key", help="The API key for the album art service")
+    run_parser.add_argument("--max-size", type=int, help="Downscale album art so that no side exceeds this many pixels")
+    run_parser.add_argument("--genre-api-key", help="The Discogs token used to fetch genres")
+    run_parser.add_argument("--infer", choices=["apply", "propose", "off"], default="apply",
+                            help="Infer the genre of albums from the genres stored in the database before fetching it")
+    run_parser.add_argument("--art-store", help="Add the embedded album art of the files to this art store")
+    run_parser.add_argument("--metrics", help="Write service metrics to this file, in the Prometheus text format if "
+                                              "it has a .prom extension, otherwise as JSON. Also written on SIGUSR1")
+    tagwriter.add_arguments(run_parser)
+    profiling.add_arguments(run_parser)
+    walk.add_arguments(run_parser)
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        with profiling.from_arguments(args):
+            run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,274 @@
+"""Profiling of the command line tools. When enabled, the wall and CPU time spent in every phase of a run, such as
+walking directories, parsing tags or waiting on the network, are recorded along with the SQL statements executed, and
+written as a single JSON report when the run ends. Optionally, a cProfile profile of the main thread and a tracemalloc
+snapshot are included in the report.
+
+Phases are recorded per thread and may nest, so the time of a phase includes the time of the phases inside it. Work
+done in worker processes is not recorded.
+"""
+import argparse
+import contextlib
+import cProfile
+import dataclasses
+import json
+import logging
+import os
+import pathlib
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+import typing
+
+import sqlalchemy.event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# The names of the phases recorded by the tools
+WALK = 'walk'
+TAG_PARSE = 'tag_parse'
+AUDIO_HASH = 'audio_hash'
+DB_COMMIT = 'db_commit'
+NETWORK = 'network'
+IMAGE_CONVERSION = 'image_conversion'
+TAG_WRITE = 'tag_write'
+
+# The number of functions and allocation sites listed in the report
+TOP_ENTRIES = 30
+
+
+@dataclasses.dataclass
+class PhaseStats:
+    """Class holding the time spent in a phase
+    """
+    calls: int = 0
+    wall: float = 0.0
+    cpu: float = 0.0
+
+
+class Profiler:
+    """Records the time spent in the phases of a run and the SQL statements executed. Does nothing until started.
+    """
+    def __init__(self):
+        """Create the profiler.
+        """
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._phases = {}
+        self._statements = {}
+        self._sql_seconds = 0.0
+        self._commits = 0
+        self._start_wall = None
+        self._start_cpu = None
+        self._cpu_profile = None
+
+    def start(self, cpu_profile: bool = False, memory_profile: bool = False):
+        """Start recording.
+
+        :param cpu_profile: Set to true in order to profile the main thread with cProfile.
+        :param memory_profile: Set to true in order to trace memory allocations with tracemalloc.
+        """
+        self._start_wall = time.perf_counter()
+        self._start_cpu = time.process_time()
+        sqlalchemy.event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+        sqlalchemy.event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+        sqlalchemy.event.listen(Engine, 'commit', self._commit)
+        if memory_profile:
+            tracemalloc.start()
+        if cpu_profile:
+            self._cpu_profile = cProfile.Profile()
+            self._cpu_profile.enable()
+        self.enabled = True
+
+    def stop(self) -> dict:
+        """Stop recording.
+
+        :return: The report.
+        """
+        self.enabled = False
+        report = {
+            'command': sys.argv,
+            'wall': time.perf_counter() - self._start_wall,
+            'cpu': time.process_time() - self._start_cpu,
+        }
+        if self._cpu_profile is not None:
+            self._cpu_profile.disable()
+        sqlalchemy.event.remove(Engine, 'before_cursor_execute', self._before_cursor_execute)
+        sqlalchemy.event.remove(Engine, 'after_cursor_execute', self._after_cursor_execute)
+        sqlalchemy.event.remove(Engine, 'commit', self._commit)
+        with self._lock:
+            report['phases'] = {name: dataclasses.asdict(stats) for name, stats in sorted(self._phases.items())}
+            report['sql'] = {
+                'statements': dict(sorted(self._statements.items())),
+                'seconds': self._sql_seconds,
+                'commits': self._commits,
+            }
+        if self._cpu_profile is not None:
+            report['cprofile'] = self._cpu_profile_report()
+            self._cpu_profile = None
+        if tracemalloc.is_tracing():
+            report['tracemalloc'] = self._memory_report()
+            tracemalloc.stop()
+
+        return report
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> typing.Iterator[None]:
+        """Context manager that adds the time spent in it to a phase.
+
+        :param name: The phase name.
+        """
+        if not self.enabled:
+            yield
+            return
+        start_wall = time.perf_counter()
+        start_cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            self._record(name, time.perf_counter() - start_wall, time.thread_time() - start_cpu)
+
+    def iterate(self, name: str, iterable: typing.Iterable) -> typing.Iterator:
+        """Iterate over an iterable, adding the time spent producing every item to a phase, such as the time spent
+        listing directories by a lazy directory walk.
+
+        :param name: The phase name.
+        :param iterable: The iterable.
+        :return: An iterator over the items of the iterable.
+        """
+        if not self.enabled:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            start_wall = time.perf_counter()
+            start_cpu = time.thread_time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self._record(name, time.perf_counter() - start_wall, time.thread_time() - start_cpu)
+            yield item
+
+    def _record(self, name: str, wall: float, cpu: float):
+        """Add a measurement to a phase.
+
+        :param name: The phase name.
+        :param wall: The wall time, in seconds.
+        :param cpu: The CPU time of the current thread, in seconds.
+        """
+        with self._lock:
+            stats = self._phases.setdefault(name, PhaseStats())
+            stats.calls += 1
+            stats.wall += wall
+            stats.cpu += cpu
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('profiling_start', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['profiling_start'].pop()
+        kind = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'EMPTY'
+        with self._lock:
+            self._statements[kind] = self._statements.get(kind, 0) + 1
+            self._sql_seconds += elapsed
+
+    def _commit(self, conn):
+        with self._lock:
+            self._commits += 1
+
+    def _cpu_profile_report(self) -> list[dict]:
+        """Return the functions where the main thread spent the most time.
+
+        :return: The functions, by descending cumulative time.
+        """
+        stats = pstats.Stats(self._cpu_profile)
+        entries = []
+        for (file_name, line, function), (_, calls, total, cumulative, _) in stats.stats.items():
+            entries.append({
+                'function': f"{file_name}:{line}({function})",
+                'calls': calls,
+                'total': total,
+                'cumulative': cumulative,
+            })
+
+        return sorted(entries, key=lambda entry: entry['cumulative'], reverse=True)[:TOP_ENTRIES]
+
+    @staticmethod
+    def _memory_report() -> dict:
+        """Return the peak traced memory and the sites that allocated the most memory still in use.
+
+        :return: The memory report.
+        """
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ])
+        return {
+            'current_bytes': current,
+            'peak_bytes': peak,
+            'top': [
+                {'site': str(stat.traceback), 'bytes': stat.size, 'blocks': stat.count}
+                for stat in snapshot.statistics('lineno')[:TOP_ENTRIES]
+            ],
+        }
+
+
+# The profiler used by all tools
+PROFILER = Profiler()
+
+
+def phase(name: str) -> typing.ContextManager[None]:
+    """Return a context manager that adds the time spent in it to a phase of the profiler.
+
+    :param name: The phase name.
+    :return: The context manager.
+    """
+    return PROFILER.phase(name)
+
+
+def iterate(name: str, iterable: typing.Iterable) -> typing.Iterator:
+    """Iterate over an iterable, adding the time spent producing every item to a phase of the profiler.
+
+    :param name: The phase name.
+    :param iterable: The iterable.
+    :return: An iterator over the items of the iterable.
+    """
+    return PROFILER.iterate(name, iterable)
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """Add the profiling arguments to an argument parser.
+
+    :param parser: The argument parser.
+    """
+    parser.add_argument("--profile", help="Write a JSON report of the time spent in every phase of the run, and of the "
+                                          "SQL statements executed, to this file")
+    parser.add_argument("--profile-cpu", action='store_true', help="Include a cProfile profile in the report")
+    parser.add_argument("--profile-memory", action='store_true', help="Include a tracemalloc snapshot in the report")
+
+
+@contextlib.contextmanager
+def from_arguments(args: argparse.Namespace) -> typing.Iterator[None]:
+    """Context manager that profiles the code run in it, if requested by parsed arguments, and writes the report on
+    exit.
+
+    :param args: The parsed arguments.
+    """
+    if not args.profile:
+        yield
+        return
+    PROFILER.start(cpu_profile=args.profile_cpu, memory_profile=args.profile_memory)
+    try:
+        yield
+    finally:
+        report = PROFILER.stop()
+        report_path = pathlib.Path(args.profile)
+        temp_path = report_path.with_name(f".{report_path.name}.{os.getpid()}.tmp")
+        temp_path.write_text(json.dumps(report, indent=2))
+        os.replace(temp_path, report_path)
+        logger.info("Wrote the profile report to %s", report_path)
@@ -1,25 +1,232 @@
 import collections
+import concurrent.futures
+import dataclasses
 import datetime
+import email.utils
 import io
+import itertools
+import random
+import threading
 import time
 import typing
 import logging
+import urllib.parse
 
 from PIL import Image, UnidentifiedImageError
 import requests
 from requests import HTTPError
 
+from collectionmanager import profiling
+from .metrics import REGISTRY as metrics
+
 logger = logging.getLogger(__name__)
 
+# The size of the chunks in which images are downloaded
+IMAGE_CHUNK_SIZE = 64 * 1024
+
+# The maximum number of items waiting for their image to be converted, by resolve_in_order
+IMAGE_WINDOW = 16
+
+# The worker pool where images are converted, created on first use
+_image_executor = None
+
+
+@dataclasses.dataclass
+class ImageOptions:
+    """Class holding the options for downloading and converting images
+    """
+    max_bytes: int = 20 * 1024 * 1024
+    max_pixels: int = 64 * 1024 * 1024
+    max_dimension: int = None
+    jpeg_quality: int = 90
+    progressive: bool = True
+
+
+def image_executor() -> concurrent.futures.ThreadPoolExecutor:
+    """Return the worker pool used for image conversion. Pillow releases the GIL while decoding and encoding, so a
+    thread pool is enough to keep conversions off the calling thread.
+
+    :return: The worker pool.
+    """
+    global _image_executor
+    if _image_executor is None:
+        _image_executor = concurrent.futures.ThreadPoolExecutor(thread_name_prefix='image')
+
+    return _image_executor
+
+
+def resolved(value) -> concurrent.futures.Future:
+    """Return a future that is already resolved.
+
+    :param value: The value of the future.
+    :return: The future.
+    """
+    future = concurrent.futures.Future()
+    future.set_result(value)
+
+    return future
+
+
+def resolve_in_order(pending: typing.Iterable[tuple[typing.Any, typing.Optional[concurrent.futures.Future]]],
+                     window: int = IMAGE_WINDOW) -> typing.Iterator[tuple[typing.Any, typing.Any]]:
+    """Pair items with the results of their futures, such as the album art being converted for the tracks of an
+    album, in the order of the items. At most a window of items wait for their futures, so that the next items, and
+    the requests they make, are produced while the images of the previous items are converted.
+
+    :param pending: The items and their futures. The future of an item may be None.
+    :param window: The maximum number of items waiting for their futures.
+    :return: An iterator over the items and the results of their futures, or None for the items without a future.
+    """
+    in_flight = collections.deque()
+    for item in itertools.chain(pending, [None]):
+        if item is not None:
+            in_flight.append(item)
+        while in_flight and (item is None or len(in_flight) >= window or in_flight[0][1] is None or
+                             in_flight[0][1].done()):
+            waiting_item, future = in_flight.popleft()
+            yield waiting_item, future.result() if future is not None else None
+
+
+def convert_image(content: bytes, content_type: str, options: ImageOptions) -> typing.Optional[bytes]:
+    """Convert an image to JPEG, downscaling it if it exceeds the maximum dimension. JPEG images that need no
+    downscaling are returned as is.
+
+    :param content: The image content.
+    :param content_type: The image content type.
+    :param options: The image options.
+    :return: The image as JPEG, or None if the image could not be decoded or is too large.
+    """
+    with profiling.phase(profiling.IMAGE_CONVERSION):
+        try:
+            image = Image.open(io.BytesIO(content))
+            if image.width * image.height > options.max_pixels:
+                logger.error("Image dimensions %dx%d exceed the limit of %d pixels", image.width, image.height,
+                             options.max_pixels)
+                return None
+            downscale = options.max_dimension is not None and max(image.size) > options.max_dimension
+            if content_type == 'image/jpeg' and not downscale:
+                return content
+            logger.info("Transforming image to JPEG")
+            if downscale:
+                # Let the JPEG decoder skip detail that will be thrown away anyway
+                image.draft('RGB', (options.max_dimension, options.max_dimension))
+                image.thumbnail((options.max_dimension, options.max_dimension))
+            image = image.convert('RGB')
+            output = io.BytesIO()
+            image.save(output, format='JPEG', quality=options.jpeg_quality, progressive=options.progressive,
+                       optimize=True)
+
+            return output.getvalue()
+        except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+            return None
+
+
+class ServiceUnavailableError(Exception):
+    """Raised when a service keeps failing, and requests to it are no longer attempted
+    """
+
+
+class CircuitBreaker:
+    """Stops requests to a service after a number of consecutive failures. After a cool down period a single trial
+    request is let through, which closes the circuit again if it succeeds.
+    """
+    def __init__(self, failure_threshold: int, cool_down: float):
+        """Create the circuit breaker.
+
+        :param failure_threshold: The number of consecutive failures after which the circuit opens.
+        :param cool_down: The number of seconds for which the circuit stays open.
+        """
+        self.failure_threshold = failure_threshold
+        self.cool_down = cool_down
+        self.failures = 0
+        self.opened_at = None
+
+    @property
+    def is_open(self) -> bool:
+        """True if requests should not be attempted.
+        """
+        return self.opened_at is not None and time.monotonic() - self.opened_at < self.cool_down
+
+    def record_success(self):
+        """Record a successful request, closing the circuit.
+        """
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        """Record a failed request, opening the circuit if the failure threshold is reached.
+        """
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+def retry_after_secs(response: requests.Response) -> typing.Optional[float]:
+    """Parse the Retry-After header of a response, which holds either a number of seconds or an HTTP date.
+
+    :param response: The response.
+    :return: The number of seconds to wait, or None if the header is not set.
+    """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
 
 class BaseService:
     """Abstract base class for services
     """
+    API_ROOT = None
     MIN_SECS_BETWEEN_REQUESTS = 0
+    MAX_RETRIES = 5
+    RETRY_BACKOFF_SECS = 1
+    MAX_RETRY_BACKOFF_SECS = 120
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+    CIRCUIT_BREAKER_FAILURES = 5
+    CIRCUIT_BREAKER_COOL_DOWN_SECS = 300
+    # The connect and read timeouts of a request, in seconds
+    REQUEST_TIMEOUT_SECS = (10, 60)
+
+    def __init__(self, api_root: str = None):
+        """Create the service.
 
-    def __init__(self):
+        :param api_root: Override the root URL of the service API, for example in order to point to a local server.
+        """
+        self.api_root = api_root or self.API_ROOT
+        self.image_options = ImageOptions()
+        self._circuit_breakers = {}
         self._last_request_time = None
+        self._not_before = None
+        self._wait_lock = threading.Lock()
         self._release_cache = collections.defaultdict(dict)
+        self._response_cache = {}
+
+    @property
+    def name(self) -> str:
+        """The name of the service, as used in metrics.
+        """
+        return type(self).__name__
+
+    def circuit_breaker(self, url: str) -> CircuitBreaker:
+        """Return the circuit breaker of the host of a URL. Every host has its own circuit breaker, so that failures of
+        an image host do not stop requests to the API.
+
+        :param url: The URL.
+        :return: The circuit breaker.
+        """
+        host = urllib.parse.urlsplit(url).netloc
+        if host not in self._circuit_breakers:
+            self._circuit_breakers[host] = CircuitBreaker(self.CIRCUIT_BREAKER_FAILURES,
+                                                          self.CIRCUIT_BREAKER_COOL_DOWN_SECS)
+
+        return self._circuit_breakers[host]
 
     def album_art(self, artist: str, album: str) -> typing.Optional[bytes]:
         """Get the album art for a release.
@@ -28,7 +235,64 @@ class BaseService:
         :param album: The album art.
         :return: The album art.
         """
-        return self._get_info(artist, album, 'album_art', 'Album art')
+        return self.album_art_async(artist, album).result()
+
+    def album_art_async(self, artist: str, album: str, cache: bool = True) -> concurrent.futures.Future:
+        """Get the album art for a release, without waiting for the image to be converted to JPEG. The requests are
+        made in the calling thread, and the image is converted in the image worker pool, so that the caller can make
+        the requests for the next release in the meantime. The future is cached, so that the tracks of a release share
+        it.
+
+        :param artist: The artist name.
+        :param album: The album name.
+        :param cache: Set to false in order to not keep the album art in the cache, for callers that keep it for as
+            long as they need it, so that the images of all the releases are not held in memory.
+        :return: A future that resolves to the album art, or to None if it was not found.
+        """
+        if not artist or not album:
+            logger.warning("Artist or album not set, cannot fetch album art")
+            return resolved(None)
+        future = self._release_cache.get((artist, album), {}).get('album_art')
+        if future is not None:
+            logger.debug("Album art found in cache")
+            metrics.increment('cache_hits', service=self.name, cache='album_art')
+            return future
+
+        metrics.increment('cache_misses', service=self.name, cache='album_art')
+        logger.info("Fetching album art for artist %s and album %s from service", artist, album)
+        try:
+            future = self.fetch_album_art_async(artist, album)
+        except ServiceUnavailableError as e:
+            logger.warning("Could not fetch album art for artist %s and album %s: %s", artist, album, e)
+            return resolved(None)
+        if future is None:
+            logger.warning("Album art not found")
+            return resolved(None)
+        if cache:
+            self._release_cache[(artist, album)]['album_art'] = future
+
+        return future
+
+    def fetch_album_art(self, artist: str, album: str) -> typing.Optional[bytes]:
+        """Fetch album art, waiting for the image to be converted.
+
+        :param artist: The artist name.
+        :param album: The album name.
+        :return: The album art if found.
+        """
+        future = self.fetch_album_art_async(artist, album)
+
+        return future.result() if future else None
+
+    def fetch_album_art_async(self, artist: str, album: str) -> typing.Optional[concurrent.futures.Future]:
+        """Fetch album art, without waiting for the image to be converted. Implemented by the services that provide
+        album art.
+
+        :param artist: The artist name.
+        :param album: The album name.
+        :return: A future that resolves to the album art, or None if it was not found.
+        """
+        raise NotImplementedError()
 
     def genre(self, artist: str, album: str) -> typing.Optional[str]:
         """Get the genre a release.
@@ -58,12 +322,18 @@ class BaseService:
 
         info = self._release_cache.get((artist, album), {}).get(key)
         if info:
-            logger.debug("% found in cache", description)
+            logger.debug("%s found in cache", description)
+            metrics.increment('cache_hits', service=self.name, cache=key)
 
             return info
         else:
+            metrics.increment('cache_misses', service=self.name, cache=key)
             logger.info("Fetching %s for artist %s and album %s from service", description, artist, album)
-            info = getattr(self, f'fetch_{key}')(artist, album)
+            try:
+                info = getattr(self, f'fetch_{key}')(artist, album)
+            except ServiceUnavailableError as e:
+                logger.warning("Could not fetch %s for artist %s and album %s: %s", description, artist, album, e)
+                return None
             if info:
                 logger.info("%s found", description)
                 self._release_cache[(artist, album)][key] = info
@@ -72,56 +342,155 @@ class BaseService:
             else:
                 logger.warning("%s not found", description)
 
-    def perform_request(self, url: str, params: dict = None, headers: dict = None) -> dict:
+    def perform_request(self, url: str, params: dict = None, headers: dict = None, cache: bool = False) -> dict:
         """Performs a request to the service API. This method makes sure that requests do not happen more frequently
         than the parameter MIN_SECS_BETWEEN_REQUESTS dictates.
 
         :param url: The url for the request.
         :param params: The request parameters.
         :param headers: The request headers.
+        :param cache: Set to true in order to reuse the response of a previous identical request.
         :return: The response data as JSON.
         """
-        if self._last_request_time is not None:
-            secs_since_last_request = (datetime.datetime.now() - self._last_request_time).total_seconds()
-            if secs_since_last_request < self.MIN_SECS_BETWEEN_REQUESTS:
-                sleep_time = self.MIN_SECS_BETWEEN_REQUESTS - secs_since_last_request
-                logger.info(f"Waiting for %.2f seconds before next request", sleep_time)
-                time.sleep(sleep_time)
-        self._last_request_time = datetime.datetime.now()
+        cache_key = (url, tuple(sorted((params or {}).items())))
+        if cache and cache_key in self._response_cache:
+            logger.debug("Response for %s found in cache", url)
+            metrics.increment('cache_hits', service=self.name, cache='response')
+            return self._response_cache[cache_key]
+        if cache:
+            metrics.increment('cache_misses', service=self.name, cache='response')
 
-        response = requests.get(url, params=params, headers=headers)
+        response = self.request(url, params=params, headers=headers)
         response.raise_for_status()
+        data = response.json()
+        if cache:
+            self._response_cache[cache_key] = data
 
-        return response.json()
+        return data
 
-    @staticmethod
-    def fetch_image_from_url(url: str) -> typing.Optional[bytes]:
-        """Fetch an image from a URL. The image is transformed to JPEG if needed.
+    def request(self, url: str, params: dict = None, headers: dict = None, rate_limit: bool = True,
+                stream: bool = False, endpoint: str = None) -> requests.Response:
+        """Performs a GET request. Requests that fail with a connection error or one of the RETRY_STATUS_CODES are
+        retried with jittered exponential backoff, honouring the Retry-After header of the response up to
+        MAX_RETRY_BACKOFF_SECS, up to MAX_RETRIES times. The wait before a retry is applied to all subsequent requests
+        of the service. Responses with any other status are returned as is. Requests time out after
+        REQUEST_TIMEOUT_SECS.
+
+        :param url: The url for the request.
+        :param params: The request parameters.
+        :param headers: The request headers.
+        :param rate_limit: Set to false for requests that are not subject to MIN_SECS_BETWEEN_REQUESTS, such as
+            requests to a different host.
+        :param stream: Set to true in order not to download the response content immediately.
+        :param endpoint: The endpoint name used in metrics. By default, the path of the URL.
+        :return: The response.
+        """
+        endpoint = endpoint or urllib.parse.urlsplit(url).path
+        circuit_breaker = self.circuit_breaker(url)
+        for attempt in range(self.MAX_RETRIES + 1):
+            if circuit_breaker.is_open:
+                metrics.increment('circuit_breaker_rejections', service=self.name)
+                raise ServiceUnavailableError(f"{urllib.parse.urlsplit(url).netloc} failed {circuit_breaker.failures} "
+                                              f"times in a row, not retrying for {circuit_breaker.cool_down} seconds")
+            self._wait(rate_limit)
+            retry_after = None
+            try:
+                with metrics.timer('request_seconds', service=self.name, endpoint=endpoint), \
+                        profiling.phase(profiling.NETWORK):
+                    response = requests.get(url, params=params, headers=headers, stream=stream,
+                                            timeout=self.REQUEST_TIMEOUT_SECS)
+                metrics.increment('requests', service=self.name, endpoint=endpoint, status=str(response.status_code))
+                if response.status_code not in self.RETRY_STATUS_CODES:
+                    circuit_breaker.record_success()
+                    if not stream:
+                        metrics.increment('bytes_downloaded', len(response.content), service=self.name,
+                                          endpoint=endpoint)
+                    return response
+                retry_after = retry_after_secs(response)
+                if retry_after is not None:
+                    retry_after = min(retry_after, self.MAX_RETRY_BACKOFF_SECS)
+                error = f"status {response.status_code}"
+                response.close()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                metrics.increment('requests', service=self.name, endpoint=endpoint, status='error')
+                error = str(e)
+            if attempt == self.MAX_RETRIES:
+                break
+            backoff = random.uniform(0, min(self.MAX_RETRY_BACKOFF_SECS, self.RETRY_BACKOFF_SECS * 2 ** attempt))
+            delay = retry_after + random.uniform(0, self.RETRY_BACKOFF_SECS) if retry_after is not None else backoff
+            logger.warning("Request to %s failed with %s, retrying in %.2f seconds", url, error, delay)
+            metrics.increment('retries', service=self.name, endpoint=endpoint)
+            self._not_before = max(self._not_before or 0.0, time.monotonic() + delay)
+
+        circuit_breaker.record_failure()
+        raise ServiceUnavailableError(f"Request to {url} failed {self.MAX_RETRIES + 1} times, last with {error}")
+
+    def _wait(self, rate_limit: bool = True):
+        """Waits until the next request is allowed. This method makes sure that requests do not happen more frequently
+        than the parameter MIN_SECS_BETWEEN_REQUESTS dictates, and that no request happens before the time that the
+        service asked us to retry after. The requests of threads that share the service wait for their turn.
+
+        :param rate_limit: Set to false in order to only wait for retries.
+        """
+        with self._wait_lock:
+            now = time.monotonic()
+            wait_until = self._not_before or now
+            if rate_limit and self._last_request_time is not None:
+                wait_until = max(wait_until, self._last_request_time + self.MIN_SECS_BETWEEN_REQUESTS)
+            if wait_until > now:
+                logger.info("Waiting for %.2f seconds before next request", wait_until - now)
+                time.sleep(wait_until - now)
+                metrics.increment('throttle_sleep_seconds', wait_until - now, service=self.name)
+            if rate_limit:
+                self._last_request_time = time.monotonic()
+
+    def fetch_image_from_url(self, url: str) -> typing.Optional[bytes]:
+        """Fetch an image from a URL. The image is downloaded in chunks, up to the maximum size set in the image
+        options, and is transformed to JPEG in the image worker pool if needed.
 
         :param url: The image URL.
         :return: The image.
         """
+        future = self.fetch_image_from_url_async(url)
+
+        return future.result() if future else None
+
+    def fetch_image_from_url_async(self, url: str) -> typing.Optional[concurrent.futures.Future]:
+        """Fetch an image from a URL, without waiting for the conversion to JPEG to finish.
+
+        :param url: The image URL.
+        :return: A future that resolves to the image, or None if the image could not be downloaded.
+        """
         # Get the image content from the URL
-        response = requests.get(url)
-        try:
-            response.raise_for_status()
-        except HTTPError:
-            logger.warning("Could not fetch image %s", url)
-            return None
-        content = response.content
-        content_type = response.headers['Content-Type']
-        # Transform the image to JPEG if needed
-        if content_type != 'image/jpeg':
+        with self.request(url, rate_limit=False, stream=True, endpoint='image') as response:
             try:
-                logger.info("Transforming image to JPEG")
-                image = Image.open(io.BytesIO(content))
-                image = image.convert('RGB')
-                output = io.BytesIO()
-                image.save(output, format='JPEG')
-
-                content = output.getvalue()
-            except UnidentifiedImageError:
-                logger.error("Could not decode file fetched from %s", url)
+                response.raise_for_status()
+            except HTTPError:
+                logger.warning("Could not fetch image %s", url)
                 return None
+            content_length = response.headers.get('Content-Length')
+            if content_length and content_length.isdigit() and int(content_length) > self.image_options.max_bytes:
+                logger.warning("Image %s is larger than %d bytes", url, self.image_options.max_bytes)
+                return None
+            content = bytearray()
+            for chunk in response.iter_content(IMAGE_CHUNK_SIZE):
+                content += chunk
+                metrics.increment('bytes_downloaded', len(chunk), service=self.name, endpoint='image')
+                if len(content) > self.image_options.max_bytes:
+                    logger.warning("Image %s is larger than %d bytes", url, self.image_options.max_bytes)
+                    return None
+            content_type = response.headers.get('Content-Type')
+
+        # Transform the image to JPEG if needed
+        def log_failure(done: concurrent.futures.Future):
+            if done.result() is None:
+                logger.error("Could not decode file fetched from %s", url)
+
+        def timed_convert_image(*args) -> typing.Optional[bytes]:
+            with metrics.timer('image_conversion_seconds', service=self.name):
+                return convert_image(*args)
+
+        future = image_executor().submit(timed_convert_image, bytes(content), content_type, self.image_options)
+        future.add_done_callback(log_failure)
 
-        return content
+        return future
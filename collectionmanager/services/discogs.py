@@ -1,5 +1,7 @@
 """Integration with discogs
 """
+import concurrent.futures
+import dataclasses
 import logging
 import typing
 
@@ -8,6 +10,15 @@ from . import base
 logger = logging.getLogger(__name__)
 
 
+@dataclasses.dataclass
+class ReleaseInfo:
+    """Class holding the release information returned by a discogs search
+    """
+    album_art_url: str = None
+    genre: str = None
+    style: str = None
+
+
 class DiscogsService(base.BaseService):
     """Connector for the discogs service
     """
@@ -15,43 +26,67 @@ class DiscogsService(base.BaseService):
     USER_AGENT = 'collection-manager/0.0.1 +https://github.com/mavroprovato/collection-manager'
     MIN_SECS_BETWEEN_REQUESTS = 2
 
-    def __init__(self, token: str):
+    def __init__(self, token: str, api_root: str = None):
         """Create the discogs service.
 
         :param token: The token for the service.
+        :param api_root: Override the root URL of the service API.
         """
-        super().__init__()
+        super().__init__(api_root)
         self._token = token
 
-    def fetch_album_art(self, artist: str, album: str) -> typing.Optional[bytes]:
-        """Fetch album art.
+    def search(self, artist: str, album: str) -> list[dict]:
+        """Search the discogs database for a release. The search response is cached, so that all the information for a
+        release is retrieved with a single request.
 
         :param artist: The artist name.
         :param album: The album name.
-        :return The album art if found.
+        :return: The search results.
         """
-        response = self.perform_request(f"{self.API_ROOT}/database/search", params={
+        response = self.perform_request(f"{self.api_root}/database/search", params={
             'artist': artist.replace(',', ' '), 'release_title': album.replace(',', ' '), 'token': self._token
-        }, headers={'User-Agent': self.USER_AGENT})
+        }, headers={'User-Agent': self.USER_AGENT}, cache=True)
+
+        return response['results']
+
+    def release_info(self, artist: str, album: str) -> ReleaseInfo:
+        """Get the album art URL, the genre and the style of a release with a single search request.
+
+        :param artist: The artist name.
+        :param album: The album name.
+        :return: The release information.
+        """
+        release_info = ReleaseInfo()
+        for result in self.search(artist, album):
+            if not release_info.album_art_url and result.get('cover_image'):
+                release_info.album_art_url = result['cover_image']
+            if not release_info.genre and result.get('genre'):
+                release_info.genre = result['genre'][0]
+            if not release_info.style and result.get('style'):
+                release_info.style = result['style'][0]
+
+        return release_info
 
-        for result in response['results']:
+    def fetch_album_art_async(self, artist: str, album: str) -> typing.Optional[concurrent.futures.Future]:
+        """Fetch album art, without waiting for the image to be converted. The image of the next search result is
+        tried if an image cannot be downloaded.
+
+        :param artist: The artist name.
+        :param album: The album name.
+        :return A future that resolves to the album art, if found.
+        """
+        for result in self.search(artist, album):
             url = result.get('cover_image')
             if url:
-                image = self.fetch_image_from_url(url)
-                if image:
-                    return image
+                future = self.fetch_image_from_url_async(url)
+                if future:
+                    return future
 
-    def fetch_genre(self, artist: str, album: str) -> typing.Optional[bytes]:
+    def fetch_genre(self, artist: str, album: str) -> typing.Optional[str]:
         """Fetch album genre.
 
         :param artist: The artist name.
         :param album: The album name.
-        :return The album art if found.
+        :return The album genre if found.
         """
-        response = self.perform_request(f"{self.API_ROOT}/database/search", params={
-            'artist': artist.replace(',', ' '), 'release_title': album.replace(',', ' '), 'token': self._token
-        }, headers={'User-Agent': self.USER_AGENT})
-
-        for result in response['results']:
-            if 'style' in result and result['style']:
-                return result['style'][0]
+        return self.release_info(artist, album).style
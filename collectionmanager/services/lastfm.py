@@ -1,10 +1,9 @@
 """Integration with last.fm
 """
+import concurrent.futures
 import logging
 import typing
 
-import requests
-
 from . import base
 
 logger = logging.getLogger(__name__)
@@ -16,23 +15,24 @@ class LastFmService(base.BaseService):
     API_ROOT = 'https://ws.audioscrobbler.com/2.0/'
     USER_AGENT = 'collection-manager/0.0.1 (https://github.com/mavroprovato/collection-manager)'
 
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, api_root: str = None):
         """Create the last.fm service.
 
         :param api_key: The API key for the service.
+        :param api_root: Override the root URL of the service API.
         """
-        super().__init__()
+        super().__init__(api_root)
         self._api_key = api_key
 
-    def fetch_album_art(self, artist: str, album: str) -> typing.Optional[bytes]:
-        """Fetch album art.
+    def fetch_album_art_async(self, artist: str, album: str) -> typing.Optional[concurrent.futures.Future]:
+        """Fetch album art, without waiting for the image to be converted.
 
         :param artist: The artist name.
         :param album: The album name.
-        :return The album art if found.
+        :return A future that resolves to the album art, if found.
         """
         # Make the request for the album info
-        response = requests.get(self.API_ROOT, params={
+        response = self.request(self.api_root, params={
             'method': 'album.getinfo', 'api_key': self._api_key, 'artist': artist, 'album': album, 'format': 'json'
         })
         if response.status_code == 404:
@@ -45,4 +45,4 @@ class LastFmService(base.BaseService):
             url = data['album']['image'][-1]['#text']
 
             if url:
-                return self.fetch_image_from_url(url)
+                return self.fetch_image_from_url_async(url)
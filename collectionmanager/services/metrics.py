@@ -0,0 +1,212 @@
+"""Counters and histograms for the service layer, that can be dumped as JSON or in the Prometheus text format.
+"""
+import bisect
+import json
+import pathlib
+import signal
+import threading
+import time
+import typing
+
+# The default histogram bucket upper bounds, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# The prefix of the metric names in the Prometheus format
+PROMETHEUS_PREFIX = 'collectionmanager_'
+
+
+class Histogram:
+    """A histogram with fixed buckets
+    """
+    def __init__(self, buckets: typing.Sequence[float] = DEFAULT_BUCKETS):
+        """Create the histogram.
+
+        :param buckets: The upper bounds of the buckets, in increasing order.
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        """Add a value to the histogram.
+
+        :param value: The value.
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_dict(self) -> dict:
+        """Return the histogram as a dictionary.
+
+        :return: The histogram as a dictionary.
+        """
+        return {
+            'buckets': {str(bound): count for bound, count in zip(self.buckets + ('+Inf', ), self.counts)},
+            'sum': self.sum,
+            'count': self.count,
+        }
+
+
+class Metrics:
+    """A registry of counters and histograms. Every metric is identified by its name and a set of labels, such as the
+    service and the endpoint.
+    """
+    def __init__(self):
+        """Create the registry.
+        """
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def increment(self, name: str, value: float = 1, **labels):
+        """Increment a counter.
+
+        :param name: The counter name.
+        :param value: The amount to increment the counter by.
+        :param labels: The counter labels.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        """Add a value to a histogram.
+
+        :param name: The histogram name.
+        :param value: The value.
+        :param labels: The histogram labels.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram()
+            self._histograms[key].observe(value)
+
+    def timer(self, name: str, **labels) -> 'Timer':
+        """Return a context manager that adds its duration in seconds to a histogram.
+
+        :param name: The histogram name.
+        :param labels: The histogram labels.
+        :return: The context manager.
+        """
+        return Timer(self, name, labels)
+
+    def reset(self):
+        """Remove all metrics.
+        """
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def to_dict(self) -> dict:
+        """Return the metrics as a dictionary.
+
+        :return: The metrics as a dictionary.
+        """
+        with self._lock:
+            return {
+                'counters': [
+                    {'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(self._counters.items())
+                ],
+                'histograms': [
+                    {'name': name, 'labels': dict(labels), **histogram.to_dict()}
+                    for (name, labels), histogram in sorted(self._histograms.items(), key=lambda item: item[0])
+                ],
+            }
+
+    def to_json(self) -> str:
+        """Return the metrics as JSON.
+
+        :return: The metrics as JSON.
+        """
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self) -> str:
+        """Return the metrics in the Prometheus text exposition format.
+
+        :return: The metrics in the Prometheus format.
+        """
+        def format_labels(labels: typing.Iterable[tuple[str, str]]) -> str:
+            escaped = [
+                '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                for key, value in labels
+            ]
+            return '{' + ','.join(escaped) + '}' if escaped else ''
+
+        lines = []
+        with self._lock:
+            typed = set()
+            for (name, labels), value in sorted(self._counters.items()):
+                metric_name = f"{PROMETHEUS_PREFIX}{name}_total"
+                if metric_name not in typed:
+                    lines.append(f"# TYPE {metric_name} counter")
+                    typed.add(metric_name)
+                lines.append(f"{metric_name}{format_labels(labels)} {value}")
+            for (name, labels), histogram in sorted(self._histograms.items(), key=lambda item: item[0]):
+                metric_name = f"{PROMETHEUS_PREFIX}{name}"
+                if metric_name not in typed:
+                    lines.append(f"# TYPE {metric_name} histogram")
+                    typed.add(metric_name)
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ('+Inf', ), histogram.counts):
+                    cumulative += count
+                    lines.append(f"{metric_name}_bucket{format_labels(labels + (('le', bound), ))} {cumulative}")
+                lines.append(f"{metric_name}_sum{format_labels(labels)} {histogram.sum}")
+                lines.append(f"{metric_name}_count{format_labels(labels)} {histogram.count}")
+
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, file_path: str | pathlib.Path):
+        """Write the metrics to a file. Files with a .prom extension are written in the Prometheus format, and all
+        other files as JSON.
+
+        :param file_path: The file path.
+        """
+        file_path = pathlib.Path(file_path)
+        file_path.write_text(self.to_prometheus() if file_path.suffix == '.prom' else self.to_json())
+
+    def dump_on_signal(self, file_path: str | pathlib.Path):
+        """Write the metrics to a file whenever the process receives SIGUSR1, so that they can be inspected while a
+        long run is in progress. Does nothing on platforms without SIGUSR1.
+
+        The handler runs on the main thread, which may be holding the registry lock when the signal arrives, so the
+        metrics are written from a separate thread that waits for the lock to be released.
+
+        :param file_path: The file path.
+        """
+        def handler(signum, frame):
+            threading.Thread(target=self.dump, args=(file_path, ), name='metrics-dump', daemon=True).start()
+
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, handler)
+
+
+class Timer:
+    """Context manager that adds its duration to a histogram
+    """
+    def __init__(self, metrics: Metrics, name: str, labels: dict):
+        """Create the timer.
+
+        :param metrics: The metrics registry.
+        :param name: The histogram name.
+        :param labels: The histogram labels.
+        """
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self) -> 'Timer':
+        self.start = time.perf_counter()
+
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+# The registry used by all services
+REGISTRY = Metrics()
@@ -1,10 +1,9 @@
 """Integration with musicbrainz.
 """
+import concurrent.futures
 import logging
 import typing
 
-import requests
-
 from .base import BaseService
 
 logger = logging.getLogger(__name__)
@@ -14,35 +13,35 @@ class MusicbrainzService(BaseService):
     """Connector for the musicbrainz service
     """
     API_ROOT = 'https://musicbrainz.org/ws/2/release-group/'
+    COVER_ART_ROOT = 'https://coverartarchive.org/release-group/'
     USER_AGENT = 'collection-manager/0.0.1 (https://github.com/mavroprovato/collection-manager)'
     MIN_SECS_BETWEEN_REQUESTS = 1
 
-    def __init__(self):
+    def __init__(self, api_root: str = None, cover_art_root: str = None):
         """Create the service
+
+        :param api_root: Override the root URL of the service API.
+        :param cover_art_root: Override the root URL of the cover art archive API.
         """
-        super().__init__()
-        self._last_request_time = None
+        super().__init__(api_root)
+        self.cover_art_root = cover_art_root or self.COVER_ART_ROOT
 
-    def fetch_album_art(self, artist: str, album: str) -> typing.Optional[bytes]:
-        """Fetch album art.
+    def fetch_album_art_async(self, artist: str, album: str) -> typing.Optional[concurrent.futures.Future]:
+        """Fetch album art, without waiting for the image to be converted.
 
         :param artist: The artist name.
         :param album: The album name.
-        :return The album art if found.
+        :return A future that resolves to the album art, if found.
         """
-        response = self.perform_request(url=self.API_ROOT, params={
+        response = self.perform_request(url=self.api_root, params={
             'query': 'release:{} AND artist:{}'.format(album, artist), 'fmt': 'json'
         }, headers={'User-Agent': self.USER_AGENT})
         for release in response['release-groups']:
-            url = f"https://coverartarchive.org/release-group/{release['id']}"
-            try:
-                response = requests.get(url)
-                response.raise_for_status()
-                for image in response.json()['images']:
-                    if image['approved'] and image['front']:
-                        return self.fetch_image_from_url(image['thumbnails']['large'])
-            except requests.HTTPError as e:
-                if e.response.status_code == 404:
-                    continue
-                else:
-                    raise
+            url = f"{self.cover_art_root}{release['id']}"
+            response = self.request(url, rate_limit=False, endpoint='coverartarchive')
+            if response.status_code == 404:
+                continue
+            response.raise_for_status()
+            for image in response.json()['images']:
+                if image['approved'] and image['front']:
+                    return self.fetch_image_from_url_async(image['thumbnails']['large'])
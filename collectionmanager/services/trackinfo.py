@@ -2,11 +2,16 @@
 """
 import dataclasses
 import enum
+import functools
+import hashlib
 import pathlib
 
 import mutagen
-import mutagen.mp3
 import mutagen.flac
+import mutagen.id3
+import mutagen.mp3
+
+from collectionmanager import profiling
 
 
 class FileType(enum.Enum):
@@ -16,6 +21,18 @@ class FileType(enum.Enum):
     FLAC = 'flac'
 
 
+def parse_number(text: str) -> int | None:
+    """Parse a track or disk number, which can be followed by the total, as in 3/12.
+
+    :param text: The number text.
+    :return: The number, or None if the text is not a number.
+    """
+    try:
+        return int(str(text).partition('/')[0])
+    except ValueError:
+        return None
+
+
 @dataclasses.dataclass
 class AlbumArt:
     """Class holding album art information
@@ -23,6 +40,13 @@ class AlbumArt:
     mime: str
     data: bytes
 
+    @functools.cached_property
+    def digest(self) -> str:
+        """The SHA-256 hash of the image data, as a hexadecimal string. Identical images have the same digest. It is
+        computed once, so the data must not be changed afterwards.
+        """
+        return hashlib.sha256(self.data).hexdigest()
+
 
 @dataclasses.dataclass
 class TrackInfo:
@@ -36,6 +60,7 @@ class TrackInfo:
     disk_number: int = None
     title: str = None
     number: int = None
+    genre: str = None
     compilation: bool = False
     file_info: dict = None
     album_art: AlbumArt = None
@@ -47,8 +72,18 @@ class TrackInfo:
         :param file: The file.
         :return: The track information
         """
+        with profiling.phase(profiling.TAG_PARSE):
+            return TrackInfo.from_file_info(mutagen.File(file))
+
+    @staticmethod
+    def from_file_info(file_info) -> 'TrackInfo':
+        """Create the track information from already read mutagen file information.
+
+        :param file_info: The mutagen file information.
+        :return: The track information
+        """
         track_info = TrackInfo()
-        track_info.file_info = mutagen.File(file)
+        track_info.file_info = file_info
 
         if isinstance(track_info.file_info, mutagen.mp3.MP3):
             track_info.type = FileType.MP3
@@ -61,16 +96,11 @@ class TrackInfo:
                 except ValueError:
                     pass
             if 'TPOS' in track_info.file_info:
-                try:
-                    track_info.disk_number = int(str(track_info.file_info['TPOS'][0]))
-                except ValueError:
-                    pass
+                track_info.disk_number = parse_number(track_info.file_info['TPOS'][0])
             if 'TRCK' in track_info.file_info:
-                try:
-                    track_info.number = int(str(track_info.file_info['TRCK'][0]))
-                except ValueError:
-                    pass
+                track_info.number = parse_number(track_info.file_info['TRCK'][0])
             track_info.title = track_info.file_info['TIT2'][0] if 'TIT2' in track_info.file_info else None
+            track_info.genre = track_info.file_info['TCON'][0] if 'TCON' in track_info.file_info else None
             if 'APIC:' in track_info.file_info:
                 track_info.album_art = AlbumArt(track_info.file_info['APIC:'].mime, track_info.file_info['APIC:'].data)
             track_info.compilation = track_info.file_info['TCMP'][0] == '1' if 'TCMP' in track_info.file_info else False
@@ -86,16 +116,11 @@ class TrackInfo:
                 except ValueError:
                     pass
             if 'discnumber' in track_info.file_info:
-                try:
-                    track_info.disk_number = int(str(track_info.file_info['discnumber'][0]))
-                except ValueError:
-                    pass
+                track_info.disk_number = parse_number(track_info.file_info['discnumber'][0])
             if 'tracknumber' in track_info.file_info:
-                try:
-                    track_info.number = int(str(track_info.file_info['tracknumber'][0]))
-                except ValueError:
-                    pass
+                track_info.number = parse_number(track_info.file_info['tracknumber'][0])
             track_info.title = track_info.file_info['title'][0] if 'title' in track_info.file_info else None
+            track_info.genre = track_info.file_info['genre'][0] if 'genre' in track_info.file_info else None
             if track_info.file_info.pictures:
                 track_info.album_art = AlbumArt(
                     track_info.file_info.pictures[0].mime, track_info.file_info.pictures[0].data)
@@ -103,3 +128,33 @@ class TrackInfo:
                 if 'compilation' in track_info.file_info else False
 
         return track_info
+
+    def set_album_art(self, data: bytes):
+        """Set the front cover album art of the track. The file is not saved.
+
+        :param data: The album art as JPEG data.
+        """
+        if self.type == FileType.MP3:
+            self.file_info.tags.add(mutagen.id3.APIC(
+                encoding=mutagen.id3.Encoding.LATIN1, data=data, mime='image/jpeg',
+                type=mutagen.id3.PictureType.COVER_FRONT)
+            )
+        elif self.type == FileType.FLAC:
+            image = mutagen.flac.Picture()
+            image.mime = 'image/jpeg'
+            image.data = data
+            image.type = mutagen.id3.PictureType.COVER_FRONT
+            self.file_info.clear_pictures()
+            self.file_info.add_picture(image)
+        self.album_art = AlbumArt('image/jpeg', data)
+
+    def set_genre(self, genre: str):
+        """Set the genre of the track. The file is not saved.
+
+        :param genre: The genre.
+        """
+        if self.type == FileType.MP3:
+            self.file_info.tags.add(mutagen.id3.TCON(encoding=mutagen.id3.Encoding.UTF8, text=genre))
+        elif self.type == FileType.FLAC:
+            self.file_info['genre'] = genre
+        self.genre = genre
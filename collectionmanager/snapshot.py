@@ -0,0 +1,208 @@
+"""Portable snapshots of the library database. A snapshot is a compacted copy of the database, written with VACUUM INTO
+while the database stays in use. When a snapshot is imported on another machine, or after the library moved to another
+mount point, the directory paths are rebased to the new location, and a verification pass that only stats the files
+tells which tracks are missing or changed, so that the library is usable without reading every file again.
+"""
+import argparse
+import concurrent.futures
+import dataclasses
+import datetime
+import itertools
+import logging
+import os
+import pathlib
+import shutil
+import sys
+import uuid
+
+from collectionmanager import db
+
+logger = logging.getLogger(__name__)
+
+# The number of files stated in parallel while verifying
+DEFAULT_JOBS = 16
+
+# The number of missing and modified files listed in the verification report
+REPORT_FILES = 20
+
+
+@dataclasses.dataclass
+class Verification:
+    """Class holding the result of verifying the tracks of the database against their files
+    """
+    # The number of files unchanged since they were scanned
+    unchanged: int = 0
+    # The paths of the missing files
+    missing: list[str] = dataclasses.field(default_factory=list)
+    # The paths of the files modified since they were scanned, which the next scan reads again
+    modified: list[str] = dataclasses.field(default_factory=list)
+    # The ids of the tracks whose files have a newer modification time but the same size, such as files copied without
+    # preserving their modification times
+    retimed: list[int] = dataclasses.field(default_factory=list)
+
+
+def parse_rebase(rebase: str) -> tuple[str, str]:
+    """Parse a path rebase argument.
+
+    :param rebase: The argument, as OLD=NEW.
+    :return: The old and the new path.
+    """
+    old_path, separator, new_path = rebase.partition('=')
+    if not separator or not old_path or not new_path:
+        raise argparse.ArgumentTypeError(f"Expected OLD=NEW, got {rebase}")
+
+    return old_path, new_path
+
+
+def stat_file(path: str) -> os.stat_result | None:
+    """Stat a file.
+
+    :param path: The file path.
+    :return: The stat result, or None if the file does not exist or cannot be accessed.
+    """
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+def verify(database: db.Database, jobs: int = DEFAULT_JOBS, trust_size: bool = False) -> Verification:
+    """Verify the tracks of the database against their files, by only comparing the modification time and the size of
+    every file to the values recorded when it was scanned. The files are stated in parallel.
+
+    :param database: The database.
+    :param jobs: The number of files stated in parallel.
+    :param trust_size: Set to true in order to consider the files with a newer modification time but the same size as
+        unchanged, and mark them as scanned. Tags updated in place do not change the size of a file, so this is only
+        safe if the files were copied without preserving their modification times and not edited since.
+    :return: The verification result.
+    """
+    verification = Verification()
+    tracks = database.track_files()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='stat') as executor:
+        while batch := list(itertools.islice(tracks, db.QUERY_BATCH_SIZE)):
+            for (track_id, path, file_size, last_scanned), stat in zip(
+                    batch, executor.map(stat_file, [path for _, path, _, _ in batch])):
+                if stat is None:
+                    verification.missing.append(path)
+                elif last_scanned is not None and datetime.datetime.fromtimestamp(stat.st_mtime) < last_scanned:
+                    verification.unchanged += 1
+                elif file_size is not None and stat.st_size == file_size:
+                    verification.retimed.append(track_id)
+                else:
+                    verification.modified.append(path)
+    if trust_size and verification.retimed:
+        database.mark_scanned(verification.retimed)
+
+    return verification
+
+
+def import_snapshot(snapshot_path: str | pathlib.Path, rebases: list[tuple[str, str]] = (),
+                    db_file_path: str | pathlib.Path = None, force: bool = False) -> db.Database:
+    """Import a snapshot as the database. The snapshot is copied next to the database, upgraded to the current schema
+    and rebased, and only then replaces the database, so that an interrupted import leaves the database as it was.
+
+    :param snapshot_path: The snapshot file path.
+    :param rebases: The old and new paths of the directories that moved.
+    :param db_file_path: The database file path. By default, the database of the application.
+    :param force: Set to true in order to replace an existing database. It is kept with a .bak extension.
+    :return: The imported database.
+    """
+    db_file_path = pathlib.Path(db_file_path) if db_file_path else db.Database.default_path()
+    if db_file_path.exists() and not force:
+        raise ValueError(f"Database {db_file_path} already exists")
+    db_file_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = db_file_path.with_name(f".{db_file_path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        shutil.copyfile(snapshot_path, temp_path)
+        database = db.Database(temp_path)
+        for old_path, new_path in rebases:
+            moved = database.rebase_paths(old_path, new_path)
+            logger.info("Moved %d directories from %s to %s", moved, old_path, new_path)
+        database.engine.dispose()
+        if db_file_path.exists():
+            os.replace(db_file_path, db_file_path.with_name(db_file_path.name + '.bak'))
+        os.replace(temp_path, db_file_path)
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+    return db.Database(db_file_path)
+
+
+def print_verification(verification: Verification, trust_size: bool):
+    """Print a report of a verification.
+
+    :param verification: The verification result.
+    :param trust_size: True if the files with the same size were marked as scanned.
+    """
+    print(f"Unchanged files: {verification.unchanged}")
+    if trust_size:
+        print(f"Files with a newer modification time but the same size, marked as scanned: {len(verification.retimed)}")
+    else:
+        print(f"Files with a newer modification time but the same size: {len(verification.retimed)}")
+    print(f"Modified files: {len(verification.modified)}")
+    for path in verification.modified[:REPORT_FILES]:
+        print(f"    {path}")
+    print(f"Missing files: {len(verification.missing)}")
+    for path in verification.missing[:REPORT_FILES]:
+        print(f"    {path}")
+
+
+def main():
+    """Main entry point of the script.
+    """
+    # Configure logging
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+
+    # Parse arguments
+    parser = argparse.ArgumentParser(description="Export, import and verify snapshots of the library database")
+    parser.add_argument("action", choices=["export", "import", "rebase", "verify"],
+                        help="Export the database to a snapshot, import a snapshot as the database, rebase the "
+                             "directory paths of the database, or verify the database against the files")
+    parser.add_argument("snapshot", nargs='?', help="The snapshot file to export to or import from")
+    parser.add_argument("--rebase", type=parse_rebase, action='append', default=[], metavar="OLD=NEW",
+                        help="Move the directories under the path OLD to the path NEW. Can be repeated")
+    parser.add_argument("--force", action='store_true', help="Replace an existing database when importing")
+    parser.add_argument("--verify", action='store_true', help="Verify the database against the files after importing")
+    parser.add_argument("--jobs", type=int, default=DEFAULT_JOBS, help="The number of files to stat in parallel")
+    parser.add_argument("--trust-size", action='store_true',
+                        help="Mark the files with a newer modification time but the same size as scanned, such as "
+                             "files copied without preserving their modification times")
+    args = parser.parse_args()
+
+    if args.action in ('export', 'import') and not args.snapshot:
+        parser.error(f"The {args.action} action requires a snapshot file")
+
+    if args.action == 'export':
+        if os.path.exists(args.snapshot):
+            logger.error("%s already exists", args.snapshot)
+            return
+        db.Database().export_snapshot(args.snapshot)
+        logger.info("Exported the database to %s", args.snapshot)
+    elif args.action == 'import':
+        if db.Database.default_path().exists() and not args.force:
+            logger.error("The database already exists, use --force to replace it")
+            return
+        try:
+            database = import_snapshot(args.snapshot, args.rebase, force=args.force)
+        except ValueError as e:
+            logger.error("%s", e)
+            return
+        logger.info("Imported %s to %s", args.snapshot, database.db_file_path)
+        if args.verify:
+            print_verification(verify(database, args.jobs, args.trust_size), args.trust_size)
+    elif args.action == 'rebase':
+        database = db.Database()
+        for old_path, new_path in args.rebase:
+            try:
+                moved = database.rebase_paths(old_path, new_path)
+            except ValueError as e:
+                logger.error("%s", e)
+                return
+            logger.info("Moved %d directories from %s to %s", moved, old_path, new_path)
+    elif args.action == 'verify':
+        print_verification(verify(db.Database(), args.jobs, args.trust_size), args.trust_size)
+
+
+if __name__ == '__main__':
+    main()
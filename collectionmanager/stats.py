@@ -0,0 +1,232 @@
+"""Statistics about the library, computed with SQL aggregates over the track columns recorded when the library was
+scanned, so that no track is loaded as an object and no file is read.
+"""
+import argparse
+import dataclasses
+import datetime
+import logging
+import os
+import pathlib
+import sys
+
+import sqlalchemy
+from sqlalchemy import case, func, select
+
+from collectionmanager import db
+
+logger = logging.getLogger(__name__)
+
+# The width of the buckets of the bitrate histogram, in bits per second
+BITRATE_BUCKET = 32000
+
+# The number of rows listed per table in the report
+DEFAULT_TOP = 20
+
+
+@dataclasses.dataclass
+class Summary:
+    """Class holding the totals of the library
+    """
+    tracks: int
+    artists: int
+    albums: int
+    directories: int
+    length: float
+    average_bitrate: float | None
+    missing_art: int
+
+
+@dataclasses.dataclass
+class LibraryStatistics:
+    """Class holding the statistics of the library. Every table is a list of tuples, in the order of its columns.
+    """
+    summary: Summary
+    # Artist, tracks and total length in seconds, by descending length
+    artist_lengths: list[tuple[str, int, float]]
+    # Bucket start in bits per second, and tracks
+    bitrate_histogram: list[tuple[int, int]]
+    # Year, albums and tracks
+    years: list[tuple[int, int, int]]
+    # Album folder, tracks, tracks without art and missing art ratio, by descending ratio
+    missing_art: list[tuple[str, int, int, float]]
+
+
+class StatisticsQuery:
+    """Computes the statistics of the library, or of the tracks under a directory.
+    """
+    def __init__(self, database: db.Database, directory_path: str = None):
+        """Create the query.
+
+        :param database: The database.
+        :param directory_path: Only the tracks under this directory are counted. By default, the whole library.
+        """
+        self.database = database
+        self.directory_path = str(pathlib.Path(directory_path).resolve()) if directory_path else None
+
+    def _select(self, *columns) -> sqlalchemy.Select:
+        """Return a query over the tracks, restricted to the directory of the statistics.
+
+        :param columns: The selected columns.
+        :return: The query.
+        """
+        query = select(*columns).select_from(db.Track).join(db.Track.directory)
+        if self.directory_path:
+            path = db.Directory.path + os.sep + db.Track.file_name
+            query = query.where(path.startswith(self.directory_path + os.sep, autoescape=True))
+
+        return query
+
+    def _execute(self, query: sqlalchemy.Select) -> list[tuple]:
+        """Execute a query.
+
+        :param query: The query.
+        :return: The result rows, as tuples.
+        """
+        with self.database.engine.connect() as connection:
+            return [tuple(row) for row in connection.execute(query)]
+
+    def summary(self) -> Summary:
+        """Return the totals of the library.
+
+        :return: The totals.
+        """
+        query = self._select(
+            func.count(db.Track.id), func.count(db.Track.track_artist_id.distinct()),
+            func.count(db.Track.album_id.distinct()), func.count(db.Track.directory_id.distinct()),
+            func.coalesce(func.sum(db.Track.length), 0), func.avg(db.Track.bitrate),
+            func.count(case((db.Track.art_size == 0, 1)))
+        )
+        return Summary(*self._execute(query)[0])
+
+    def artist_lengths(self, top: int = None) -> list[tuple[str, int, float]]:
+        """Return the number of tracks and the total length per track artist.
+
+        :param top: The number of artists to return. By default, all artists.
+        :return: The artist, the number of tracks and the total length in seconds, by descending length.
+        """
+        length = func.coalesce(func.sum(db.Track.length), 0)
+        query = self._select(db.Artist.name, func.count(db.Track.id), length) \
+            .join(db.Artist, db.Track.track_artist_id == db.Artist.id) \
+            .group_by(db.Artist.id).order_by(length.desc(), db.Artist.name).limit(top)
+        return self._execute(query)
+
+    def bitrate_histogram(self, bucket: int = BITRATE_BUCKET) -> list[tuple[int, int]]:
+        """Return the number of tracks per bitrate bucket. Tracks with an unknown bitrate are not counted.
+
+        :param bucket: The width of the buckets, in bits per second.
+        :return: The start of every non empty bucket and the number of tracks in it, by ascending bitrate.
+        """
+        bucket_start = (db.Track.bitrate // bucket) * bucket
+        query = self._select(bucket_start, func.count(db.Track.id)) \
+            .where(db.Track.bitrate.is_not(None)).group_by(bucket_start).order_by(bucket_start)
+        return self._execute(query)
+
+    def years(self) -> list[tuple[int, int, int]]:
+        """Return the number of albums and tracks per album year. Albums without a year are counted under None.
+
+        :return: The year, the number of albums and the number of tracks, by ascending year.
+        """
+        query = self._select(db.Album.year, func.count(db.Album.id.distinct()), func.count(db.Track.id)) \
+            .join(db.Track.album).group_by(db.Album.year).order_by(db.Album.year)
+        return self._execute(query)
+
+    def missing_art(self, top: int = None) -> list[tuple[str, int, int, float]]:
+        """Return the ratio of tracks without embedded album art per album folder. Tracks scanned before the art was
+        recorded are not counted.
+
+        :param top: The number of folders to return. By default, all folders with missing art.
+        :return: The folder path, the number of tracks, the number of tracks without art and their ratio, by
+            descending ratio.
+        """
+        # Strip the file name from the relative path, by trimming every trailing character that is not a separator
+        file_name = db.Track.file_name
+        folder = db.Directory.path + os.sep + func.rtrim(file_name, func.replace(file_name, os.sep, ''))
+        missing = func.count(case((db.Track.art_size == 0, 1)))
+        tracks = func.count(db.Track.id)
+        ratio = sqlalchemy.cast(missing, sqlalchemy.Float) / tracks
+        query = self._select(folder, tracks, missing, ratio) \
+            .where(db.Track.art_size.is_not(None)).group_by(folder).having(missing > 0) \
+            .order_by(ratio.desc(), missing.desc(), folder).limit(top)
+        return [(path.rstrip(os.sep), tracks, missing, ratio) for path, tracks, missing, ratio in self._execute(query)]
+
+    def compute(self, top: int = DEFAULT_TOP, bucket: int = BITRATE_BUCKET) -> LibraryStatistics:
+        """Compute all the statistics.
+
+        :param top: The number of rows of the artist and missing art tables.
+        :param bucket: The width of the bitrate buckets, in bits per second.
+        :return: The statistics.
+        """
+        return LibraryStatistics(
+            self.summary(), self.artist_lengths(top), self.bitrate_histogram(bucket), self.years(),
+            self.missing_art(top)
+        )
+
+
+def format_length(seconds: float) -> str:
+    """Format a length as hours, minutes and seconds.
+
+    :param seconds: The length in seconds.
+    :return: The formatted length.
+    """
+    return str(datetime.timedelta(seconds=round(seconds or 0)))
+
+
+def print_report(statistics: LibraryStatistics):
+    """Print a report of the library statistics.
+
+    :param statistics: The statistics.
+    """
+    summary = statistics.summary
+    print(f"Tracks: {summary.tracks}")
+    print(f"Artists: {summary.artists}")
+    print(f"Albums: {summary.albums}")
+    print(f"Directories: {summary.directories}")
+    print(f"Total length: {format_length(summary.length)}")
+    if summary.average_bitrate:
+        print(f"Average bitrate: {round(summary.average_bitrate / 1000)} kbps")
+    print(f"Tracks without album art: {summary.missing_art}")
+
+    print()
+    print(f"{'artist':<40} {'tracks':>7} {'length':>12}")
+    for artist, tracks, length in statistics.artist_lengths:
+        print(f"{artist[:40]:<40} {tracks:>7} {format_length(length):>12}")
+
+    print()
+    print(f"{'bitrate':<16} {'tracks':>7}")
+    largest = max((tracks for _, tracks in statistics.bitrate_histogram), default=0)
+    for bucket_start, tracks in statistics.bitrate_histogram:
+        bar = '#' * round(40 * tracks / largest)
+        print(f"{f'{bucket_start // 1000} kbps':<16} {tracks:>7} {bar}")
+
+    print()
+    print(f"{'year':<6} {'albums':>7} {'tracks':>7}")
+    for year, albums, tracks in statistics.years:
+        print(f"{year if year else '-':<6} {albums:>7} {tracks:>7}")
+
+    if statistics.missing_art:
+        print()
+        print(f"{'missing art':>11} {'tracks':>7}  folder")
+        for folder, tracks, missing, ratio in statistics.missing_art:
+            print(f"{ratio:>11.0%} {tracks:>7}  {folder}")
+
+
+def main():
+    """Main entry point of the script.
+    """
+    # Configure logging
+    logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+
+    # Parse arguments
+    parser = argparse.ArgumentParser(description="Print statistics about the scanned library")
+    parser.add_argument("directory", nargs='?', help="Only count the tracks under this directory")
+    parser.add_argument("--top", type=int, default=DEFAULT_TOP,
+                        help="The number of artists and folders with missing art to list")
+    parser.add_argument("--bucket", type=int, default=BITRATE_BUCKET // 1000,
+                        help="The width of the bitrate histogram buckets, in kbps")
+    args = parser.parse_args()
+
+    print_report(StatisticsQuery(db.Database(), args.directory).compute(args.top, args.bucket * 1000))
+
+
+if __name__ == '__main__':
+    main()
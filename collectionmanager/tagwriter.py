@@ -0,0 +1,467 @@
+"""Saving of tag changes to files. Files are saved in a thread pool. Tags that fit in the padding of the file are
+updated in place, and otherwise the file is written again, with the new tags, to a temporary file which then replaces
+the original file, so that an interrupted rewrite never leaves a half written file behind. The original tags of every
+saved file can be recorded in a journal, so that a batch can be resumed or rolled back.
+
+An in place update only overwrites the tag region of the file, never the audio data, but it is not atomic: a crash in
+the middle of it can leave the tags of the file damaged. Use a journal in order to be able to restore them, since the
+overwritten region is recorded in it before the update.
+"""
+import argparse
+import base64
+import concurrent.futures
+import dataclasses
+import json
+import logging
+import os
+import pathlib
+import shutil
+import sys
+import threading
+import time
+import typing
+import uuid
+
+from collectionmanager import profiling
+
+logger = logging.getLogger(__name__)
+
+# The default number of files saved in parallel
+DEFAULT_JOBS = 4
+
+# The size of an ID3v1 tag, found at the end of MP3 files
+ID3V1_SIZE = 128
+
+# The default padding reserved when a file has to be rewritten, in bytes
+DEFAULT_PADDING = 128 * 1024
+
+
+def tag_regions(file_path: str | pathlib.Path) -> tuple[int, int]:
+    """Return the size of the tag regions at the start and at the end of an MP3 or FLAC file, which are the parts of
+    the file that are changed when tags are saved.
+
+    :param file_path: The file path.
+    :return: The size of the region at the start and the size of the region at the end of the file.
+    """
+    with open(file_path, 'rb') as f:
+        head_size = 0
+        header = f.read(10)
+        # ID3v2 tag, used by MP3 files and sometimes found before FLAC metadata
+        if header[:3] == b'ID3' and len(header) == 10:
+            size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+            head_size = 10 + size + (10 if header[5] & 0x10 else 0)
+        # FLAC metadata blocks
+        f.seek(head_size)
+        if f.read(4) == b'fLaC':
+            head_size += 4
+            while True:
+                block_header = f.read(4)
+                if len(block_header) < 4:
+                    break
+                head_size += 4 + int.from_bytes(block_header[1:], 'big')
+                f.seek(head_size)
+                if block_header[0] & 0x80:
+                    break
+        # ID3v1 tag
+        tail_size = 0
+        file_size = f.seek(0, os.SEEK_END)
+        if file_size - head_size >= ID3V1_SIZE:
+            f.seek(file_size - ID3V1_SIZE)
+            if f.read(3) == b'TAG':
+                tail_size = ID3V1_SIZE
+
+    return head_size, tail_size
+
+
+def read_tag_regions(file_path: str | pathlib.Path) -> tuple[bytes, bytes]:
+    """Read the tag regions of a file.
+
+    :param file_path: The file path.
+    :return: The contents of the region at the start and of the region at the end of the file.
+    """
+    head_size, tail_size = tag_regions(file_path)
+    with open(file_path, 'rb') as f:
+        head = f.read(head_size)
+        tail = b''
+        if tail_size:
+            f.seek(-tail_size, os.SEEK_END)
+            tail = f.read(tail_size)
+
+    return head, tail
+
+
+def temp_file_path(file_path: pathlib.Path) -> pathlib.Path:
+    """Return a unique temporary file path in the directory of a file, so that it can be renamed over the file.
+
+    :param file_path: The file path.
+    :return: The temporary file path.
+    """
+    return file_path.with_name(f".{file_path.name}.{uuid.uuid4().hex}.tmp")
+
+
+def replace_tag_regions(file_path: pathlib.Path, head: bytes, tail: bytes, regions: tuple[int, int] = None):
+    """Replace the tag regions of a file, keeping the audio data of the file. The file is written in a single pass to
+    a temporary file in the same directory, which is then renamed over the original file.
+
+    :param file_path: The file path.
+    :param head: The new contents of the region at the start of the file.
+    :param tail: The new contents of the region at the end of the file.
+    :param regions: The size of the current regions at the start and at the end of the file. By default, they are read
+        from the file.
+    """
+    head_size, tail_size = regions if regions else tag_regions(file_path)
+    temp_path = temp_file_path(file_path)
+    try:
+        with open(file_path, 'rb') as source, open(temp_path, 'wb') as target:
+            file_size = source.seek(0, os.SEEK_END)
+            source.seek(head_size)
+            target.write(head)
+            remaining = file_size - head_size - tail_size
+            while remaining > 0:
+                chunk = source.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    raise OSError(f"{file_path} was truncated while it was copied")
+                target.write(chunk)
+                remaining -= len(chunk)
+            target.write(tail)
+            target.flush()
+            os.fsync(target.fileno())
+        shutil.copymode(file_path, temp_path)
+        os.replace(temp_path, file_path)
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+
+def rewrite_tags(file_path: pathlib.Path, file_info, padding: typing.Callable):
+    """Save the tags of a file that do not fit in its tag regions. The tag regions alone are copied to a small
+    temporary file, where mutagen saves the new tags, and the file is then written once with the new regions around its
+    audio data, instead of copying the whole file and having mutagen move the audio data of the copy again.
+
+    :param file_path: The file path.
+    :param file_info: The mutagen file information.
+    :param padding: The mutagen padding function.
+    """
+    regions = tag_regions(file_path)
+    head, tail = read_tag_regions(file_path)
+    stub_path = temp_file_path(file_path)
+    try:
+        stub_path.write_bytes(head + tail)
+        file_info.save(str(stub_path), padding=padding)
+        stub = stub_path.read_bytes()
+        new_head_size, new_tail_size = tag_regions(stub_path)
+    finally:
+        stub_path.unlink(missing_ok=True)
+    if new_head_size + new_tail_size != len(stub):
+        raise ValueError(f"Unexpected tag layout when saving {file_path}")
+    replace_tag_regions(file_path, stub[:new_head_size], stub[new_head_size:], regions)
+
+
+class Journal:
+    """A journal of the original tags of the files saved in a batch, stored as JSON Lines. Every file is recorded
+    before it is saved, and marked as done after it is saved. The size of the file is recorded along with its tag
+    regions, so that a file whose tags were damaged by an interrupted in place update, which keeps the size of the
+    file, can be restored without parsing its tags.
+    """
+    def __init__(self, journal_path: str | pathlib.Path):
+        """Create the journal, reading the entries of an existing journal file.
+
+        :param journal_path: The journal file path.
+        """
+        self.journal_path = pathlib.Path(journal_path)
+        self.originals = {}
+        self.done = set()
+        self._lock = threading.Lock()
+        if self.journal_path.exists():
+            with open(self.journal_path, encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    entry = json.loads(line)
+                    if entry['status'] == 'pending':
+                        # Keep the tags from before the first save of the file
+                        self.originals.setdefault(entry['path'], (
+                            base64.b64decode(entry['head']), base64.b64decode(entry['tail']), entry.get('size')))
+                    elif entry['status'] == 'done':
+                        self.done.add(entry['path'])
+
+    def _append(self, entry: dict):
+        """Append an entry to the journal file, making sure that it reaches the disk.
+
+        :param entry: The entry.
+        """
+        with self._lock, open(self.journal_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def record(self, file_path: pathlib.Path):
+        """Record the original tags of a file, before it is saved.
+
+        :param file_path: The file path.
+        """
+        head, tail = read_tag_regions(file_path)
+        size = file_path.stat().st_size
+        self._append({
+            'path': str(file_path), 'status': 'pending', 'size': size,
+            'head': base64.b64encode(head).decode(), 'tail': base64.b64encode(tail).decode(),
+        })
+        with self._lock:
+            self.originals.setdefault(str(file_path), (head, tail, size))
+
+    def mark_done(self, file_path: pathlib.Path):
+        """Mark a file as saved.
+
+        :param file_path: The file path.
+        """
+        self._append({'path': str(file_path), 'status': 'done'})
+        with self._lock:
+            self.done.add(str(file_path))
+
+    def rollback(self) -> int:
+        """Restore the original tags of all recorded files.
+
+        :return: The number of files restored.
+        """
+        restored = 0
+        for path, (head, tail, size) in self.originals.items():
+            file_path = pathlib.Path(path)
+            if not file_path.exists():
+                logger.warning("Cannot roll back %s, the file does not exist", file_path)
+                continue
+            logger.info("Rolling back %s", file_path)
+            # A file of the same size was not rewritten, so its regions are still those recorded, even if an
+            # interrupted in place update left them unreadable
+            regions = (len(head), len(tail)) if file_path.stat().st_size == size else None
+            replace_tag_regions(file_path, head, tail, regions)
+            restored += 1
+
+        return restored
+
+
+class _RewriteNeeded(Exception):
+    """Raised by the padding policy in order to abort an in place save that would have to rewrite the file
+    """
+
+
+@dataclasses.dataclass
+class PaddingPolicy:
+    """Class holding the padding policy of a tag writer. The existing padding of a file is reused whenever the new
+    tags fit in it, since any change in the size of the tags means rewriting the whole file, audio data included. When
+    a rewrite is unavoidable, generous padding is reserved so that later changes, such as embedding album art, can be
+    made in place.
+    """
+    padding: int = DEFAULT_PADDING
+    max_padding: int | None = None
+
+    def in_place(self, info) -> int:
+        """Padding function for mutagen that keeps the size of the tags, and aborts the save if that is not possible.
+
+        :param info: The mutagen padding information.
+        :return: The padding to use.
+        """
+        if info.padding < 0 or (self.max_padding is not None and info.padding > self.max_padding):
+            raise _RewriteNeeded()
+        return info.padding
+
+    def rewrite(self, info) -> int:
+        """Padding function for mutagen that reuses the existing padding if possible, and otherwise reserves the
+        policy padding.
+
+        :param info: The mutagen padding information.
+        :return: The padding to use.
+        """
+        if info.padding >= 0 and (self.max_padding is None or info.padding <= self.max_padding):
+            return info.padding
+        return self.padding
+
+
+@dataclasses.dataclass
+class WriterStats:
+    """Class holding the statistics of a tag writer
+    """
+    saved: int = 0
+    failed: int = 0
+    skipped: int = 0
+    in_place: int = 0
+    rewritten: int = 0
+    seconds: float = 0.0
+
+    @property
+    def files_per_sec(self) -> float:
+        """The number of files saved per second.
+        """
+        return self.saved / self.seconds if self.seconds else 0.0
+
+
+class TagWriter:
+    """Saves mutagen file information in a bounded thread pool. Saving is I/O bound, so threads are enough to keep
+    several saves in flight. Use as a context manager, in order to wait for all saves to finish when done.
+
+    In place updates are not atomic, so only a writer with a journal can recover from a crash in the middle of one.
+    """
+    def __init__(self, jobs: int = DEFAULT_JOBS, journal: Journal = None, atomic: bool = True,
+                 padding: PaddingPolicy = None, on_saved: typing.Callable[[pathlib.Path], None] = None):
+        """Create the tag writer.
+
+        :param jobs: The number of files saved in parallel. If one, files are saved in the calling thread.
+        :param journal: The journal where the original tags are recorded.
+        :param atomic: Set to false in order to rewrite files in place when the tags do not fit, instead of through a
+            temporary file.
+        :param padding: The padding policy. By default, the default padding policy.
+        :param on_saved: The function called with the path of every saved file, such as to record it in the change log
+            of the database. It is called from the saving threads, one file at a time.
+        """
+        self.jobs = jobs
+        self.journal = journal
+        self.atomic = atomic
+        self.padding = padding if padding else PaddingPolicy()
+        self.on_saved = on_saved
+        self.stats = WriterStats()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='tagwriter') \
+            if jobs > 1 else None
+        # Bounds the number of pending saves, so that parsed files do not pile up in memory
+        self._slots = threading.BoundedSemaphore(jobs * 2)
+        self._lock = threading.Lock()
+        self._on_saved_lock = threading.Lock()
+        self._start = time.perf_counter()
+
+    def __enter__(self) -> 'TagWriter':
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def is_done(self, file_path: str | pathlib.Path) -> bool:
+        """Check if a file was already saved in a previous run of the batch, according to the journal.
+
+        :param file_path: The file path.
+        :return: True if the file was saved.
+        """
+        return self.journal is not None and str(file_path) in self.journal.done
+
+    def save(self, file_info) -> concurrent.futures.Future:
+        """Save a file. The save happens in the background, unless the writer has a single job.
+
+        :param file_info: The mutagen file information to save.
+        :return: A future resolved to True once the file is saved, or was already saved according to the journal, and
+            to False if it could not be saved.
+        """
+        file_path = pathlib.Path(file_info.filename)
+        if self.is_done(file_path):
+            with self._lock:
+                self.stats.skipped += 1
+            future = concurrent.futures.Future()
+            future.set_result(True)
+            return future
+        if self._executor is None:
+            future = concurrent.futures.Future()
+            future.set_result(self._save(file_path, file_info))
+            return future
+        self._slots.acquire()
+        future = self._executor.submit(self._save, file_path, file_info)
+        future.add_done_callback(lambda f: self._slots.release())
+
+        return future
+
+    def _save(self, file_path: pathlib.Path, file_info) -> bool:
+        """Save a file, recording it in the journal.
+
+        :param file_path: The file path.
+        :param file_info: The mutagen file information.
+        :return: True if the file was saved.
+        """
+        try:
+            if self.journal is not None:
+                self.journal.record(file_path)
+            with profiling.phase(profiling.TAG_WRITE):
+                try:
+                    # Only the tag region is overwritten when the tags fit in the existing padding
+                    file_info.save(padding=self.padding.in_place)
+                    rewritten = False
+                except _RewriteNeeded:
+                    if self.atomic:
+                        rewrite_tags(file_path, file_info, self.padding.rewrite)
+                    else:
+                        file_info.save(padding=self.padding.rewrite)
+                    rewritten = True
+            if self.journal is not None:
+                self.journal.mark_done(file_path)
+            if self.on_saved is not None:
+                try:
+                    with self._on_saved_lock:
+                        self.on_saved(file_path)
+                except Exception as e:
+                    logger.warning("Could not record the save of %s: %s", file_path, e)
+            with self._lock:
+                self.stats.saved += 1
+                if rewritten:
+                    self.stats.rewritten += 1
+                else:
+                    self.stats.in_place += 1
+            return True
+        except Exception as e:
+            logger.error("Could not save %s: %s", file_path, e)
+            with self._lock:
+                self.stats.failed += 1
+            return False
+
+    def close(self):
+        """Wait for all saves to finish, and log the statistics.
+        """
+        if self._executor is not None:
+            self._executor.shutdown()
+        self.stats.seconds = time.perf_counter() - self._start
+        logger.info("Saved %d files in %.2f seconds (%.2f files/sec), %d failed, %d skipped", self.stats.saved,
+                    self.stats.seconds, self.stats.files_per_sec, self.stats.failed, self.stats.skipped)
+        if self.stats.saved:
+            logger.info("%d files updated in place, %d files rewritten", self.stats.in_place, self.stats.rewritten)
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """Add the tag writer arguments to an argument parser.
+
+    :param parser: The argument parser.
+    """
+    parser.add_argument("--write-jobs", type=int, default=DEFAULT_JOBS, help="The number of files to save in parallel")
+    parser.add_argument("--journal", help="Record the original tags of the saved files in this journal file. If it "
+                                          "exists, the files already saved by a previous run are skipped")
+    parser.add_argument("--padding", type=int, default=DEFAULT_PADDING,
+                        help="The padding in bytes reserved when the tags do not fit in a file and it is rewritten")
+    parser.add_argument("--max-padding", type=int,
+                        help="Rewrite files with more padding than this, in bytes. By default, padding is never "
+                             "reduced")
+
+
+def from_arguments(args: argparse.Namespace, on_saved: typing.Callable[[pathlib.Path], None] = None) -> TagWriter:
+    """Create a tag writer from parsed arguments.
+
+    :param args: The parsed arguments.
+    :param on_saved: The function called with the path of every saved file.
+    :return: The tag writer.
+    """
+    return TagWriter(jobs=args.write_jobs, journal=Journal(args.journal) if args.journal else None,
+                     padding=PaddingPolicy(padding=args.padding, max_padding=args.max_padding), on_saved=on_saved)
+
+
+def main():
+    """Main entry point of the script.
+    """
+    # Configure logging
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    # Parse arguments
+    parser = argparse.ArgumentParser(description="Manage tag writer journals")
+    parser.add_argument("action", choices=["rollback", "status"], help="The action to perform")
+    parser.add_argument("journal", help="The journal file")
+    args = parser.parse_args()
+
+    journal = Journal(args.journal)
+    if args.action == 'rollback':
+        restored = journal.rollback()
+        logger.info("Restored the original tags of %d files", restored)
+    elif args.action == 'status':
+        logger.info("%d files recorded, %d saved", len(journal.originals), len(journal.done))
+
+
+if __name__ == '__main__':
+    main()
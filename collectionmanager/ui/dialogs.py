@@ -2,6 +2,7 @@ import datetime
 
 from PyQt5 import QtWidgets as QtWidgets
 
+from .. import db, stats
 from ..ui.ui import track_details
 from ..db import models
 
@@ -50,15 +51,15 @@ class TrackDetailDialog(QtWidgets.QDialog, track_details.Ui_Dialog):
         if timedelta_str.startswith("0:"):
             timedelta_str = timedelta_str[2:]
         self.label_value_label.setText(timedelta_str)
-        self.bit_rate_value_label.setText('{} Kbps'.format(round(self.track.encoder_info['bitrate'] / 1000)))
+        self.bit_rate_value_label.setText(
+            '{} Kbps'.format(round(self.track.bitrate / 1000)) if self.track.bitrate else 'Unknown')
         self.bit_rate_mode_value_label.setText({
-            'BitrateMode.UNKNOWN': 'Unknown',
-            'BitrateMode.CBR': 'Constant Bitrate',
-            'BitrateMode.VBR': 'Variable Bitrate',
-            'BitrateMode.ABR': 'Average Bitrate',
-        }[self.track.encoder_info['bitrate_mode']])
-        self.sample_rate_value_label.setText(str(self.track.encoder_info['sample_rate']))
-        self.encoder_value_label.setText(self.track.encoder_info['encoder_info'])
+            'CBR': 'Constant Bitrate',
+            'VBR': 'Variable Bitrate',
+            'ABR': 'Average Bitrate',
+        }.get(self.track.bitrate_mode, 'Unknown'))
+        self.sample_rate_value_label.setText(str(self.track.sample_rate) if self.track.sample_rate else 'Unknown')
+        self.encoder_value_label.setText(self.track.encoder or '')
 
     def set_information_tab(self):
         """Set the UI elements of the details tab
@@ -90,3 +91,71 @@ class TrackDetailDialog(QtWidgets.QDialog, track_details.Ui_Dialog):
                 summary += " on <b>{}</b>".format(self.track.album.name)
 
         return summary
+
+
+class StatisticsDialog(QtWidgets.QDialog):
+    """The dialog that shows the statistics of the library.
+    """
+    # The headers of the tables, in the order of the statistics tables
+    tables = [
+        ('Artists', ['Artist', 'Tracks', 'Length']),
+        ('Bitrates', ['Bitrate', 'Tracks']),
+        ('Years', ['Year', 'Albums', 'Tracks']),
+        ('Missing Art', ['Folder', 'Tracks', 'Without Art', 'Ratio']),
+    ]
+
+    def __init__(self, parent):
+        """Constructor for the statistics dialog.
+
+        :param parent: The parent widget.
+        """
+        super(StatisticsDialog, self).__init__(parent)
+
+        self.summary_label = QtWidgets.QLabel(self)
+        self.tab_widget = QtWidgets.QTabWidget(self)
+        self.table_widgets = []
+        self.button_box = QtWidgets.QDialogButtonBox(QtWidgets.QDialogButtonBox.Close, self)
+
+        self.setupUi()
+
+    def setupUi(self):
+        """Set up the user interface.
+        """
+        self.setWindowTitle("Library Statistics")
+        self.resize(640, 480)
+        for title, headers in self.tables:
+            table_widget = QtWidgets.QTableWidget(0, len(headers), self)
+            table_widget.setHorizontalHeaderLabels(headers)
+            table_widget.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+            table_widget.horizontalHeader().setStretchLastSection(True)
+            table_widget.verticalHeader().setVisible(False)
+            self.tab_widget.addTab(table_widget, title)
+            self.table_widgets.append(table_widget)
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.addWidget(self.summary_label)
+        layout.addWidget(self.tab_widget)
+        layout.addWidget(self.button_box)
+
+        self.button_box.rejected.connect(self.close)
+
+    def refresh(self):
+        """Compute the statistics from the database and show them.
+        """
+        statistics = stats.StatisticsQuery(db.Database()).compute()
+        summary = statistics.summary
+        self.summary_label.setText(
+            f"<b>{summary.tracks}</b> tracks by <b>{summary.artists}</b> artists on <b>{summary.albums}</b> albums, "
+            f"<b>{stats.format_length(summary.length)}</b> in total. "
+            f"<b>{summary.missing_art}</b> tracks without album art.")
+        rows = [
+            [(artist, tracks, stats.format_length(length)) for artist, tracks, length in statistics.artist_lengths],
+            [(f"{bucket_start // 1000} Kbps", tracks) for bucket_start, tracks in statistics.bitrate_histogram],
+            [(year if year else 'Unknown', albums, tracks) for year, albums, tracks in statistics.years],
+            [(folder, tracks, missing, f"{ratio:.0%}") for folder, tracks, missing, ratio in statistics.missing_art],
+        ]
+        for table_widget, table_rows in zip(self.table_widgets, rows):
+            table_widget.setRowCount(len(table_rows))
+            for row, values in enumerate(table_rows):
+                for column, value in enumerate(values):
+                    table_widget.setItem(row, column, QtWidgets.QTableWidgetItem(str(value)))
+            table_widget.resizeColumnsToContents()
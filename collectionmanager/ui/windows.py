@@ -6,6 +6,7 @@ import PyQt5.QtWidgets as QtWidgets
 
 from collectionmanager.threads import scandirectory
 import collectionmanager.ui.ui.main_window as main_window
+from collectionmanager.ui.dialogs import StatisticsDialog
 from collectionmanager.ui.widgets import MainWidget
 
 
@@ -20,6 +21,7 @@ class MainWindow(QtWidgets.QMainWindow, main_window.Ui_MainWindow):
         super(MainWindow, self).__init__(parent)
 
         self.mainWidget = MainWidget(self)
+        self.statisticsDialog = StatisticsDialog(self)
         self.scanDirectoryThread = scandirectory.ScanDirectoryThread(self)
 
         self.setupUi()
@@ -36,6 +38,7 @@ class MainWindow(QtWidgets.QMainWindow, main_window.Ui_MainWindow):
         # Set up the actions
         self.fileOpenAction.triggered.connect(self.open_directory)
         self.fileQuitAction.triggered.connect(QtWidgets.qApp.quit)
+        self.viewStatisticsAction.triggered.connect(self.show_statistics)
 
         self.scanDirectoryThread.directoryScanned.connect(self.directory_scanned)
 
@@ -46,6 +49,12 @@ class MainWindow(QtWidgets.QMainWindow, main_window.Ui_MainWindow):
         if directory:
             self.scanDirectoryThread.scan_directory(directory)
 
+    def show_statistics(self):
+        """Called when the user selects to view the library statistics.
+        """
+        self.statisticsDialog.refresh()
+        self.statisticsDialog.exec_()
+
     def directory_scanned(self):
         """Called when a directory has been scanned.
         """
@@ -0,0 +1,111 @@
+"""Concurrent walking of directory trees. Directories are listed in a thread pool with os.scandir, so that a library on
+a network mount, where every listing and stat waits on a round trip, is walked with several requests in flight. Files
+are yielded as soon as the directory they are in is listed.
+"""
+import argparse
+import concurrent.futures
+import dataclasses
+import logging
+import os
+import pathlib
+import queue
+import threading
+import typing
+
+from collectionmanager import profiling
+
+logger = logging.getLogger(__name__)
+
+# The extensions of the audio files in the library
+AUDIO_EXTENSIONS = ('.mp3', '.flac')
+
+# The default number of directories listed in parallel
+DEFAULT_JOBS = 8
+
+
+@dataclasses.dataclass
+class WalkedFile:
+    """Class holding a file found by a walk, and its stat result if requested
+    """
+    path: pathlib.Path
+    stat: os.stat_result | None = None
+
+
+def walk_files(root: str | pathlib.Path, extensions: tuple[str, ...] = AUDIO_EXTENSIONS, jobs: int = None,
+               stat: bool = False) -> typing.Iterator[WalkedFile]:
+    """Walk a directory tree, listing directories in parallel. Symbolic links to directories are not followed. The
+    files of a directory are yielded consecutively, but the order of the directories, and of the files in a directory,
+    is not defined. An error raised while listing a directory, other than an OSError, is raised to the caller.
+
+    :param root: The root directory.
+    :param extensions: The extensions of the files to return.
+    :param jobs: The number of directories listed in parallel. By default, DEFAULT_JOBS.
+    :param stat: Set to true in order to stat the files while walking, in the worker threads.
+    :return: An iterator over the files.
+    """
+    results = queue.Queue()
+    stopped = threading.Event()
+
+    def scan(directory: str):
+        files = []
+        subdirectories = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if stopped.is_set():
+                        break
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirectories.append(entry.path)
+                        elif entry.name.endswith(extensions) and entry.is_file():
+                            files.append(WalkedFile(pathlib.Path(entry.path), entry.stat() if stat else None))
+                    except OSError as e:
+                        logger.warning("Could not read %s: %s", entry.path, e)
+        except OSError as e:
+            logger.warning("Could not list %s: %s", directory, e)
+        except BaseException as e:
+            # The caller waits for a result for every directory, so it gets the error instead
+            results.put(e)
+            return
+        results.put((files, subdirectories))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or DEFAULT_JOBS, thread_name_prefix='walk') as executor:
+        try:
+            executor.submit(scan, str(root))
+            pending = 1
+            while pending:
+                result = results.get()
+                pending -= 1
+                if isinstance(result, BaseException):
+                    raise result
+                files, subdirectories = result
+                for subdirectory in subdirectories:
+                    executor.submit(scan, subdirectory)
+                    pending += 1
+                yield from files
+        finally:
+            # Stop listing if the caller stops iterating early
+            stopped.set()
+            executor.shutdown(cancel_futures=True)
+
+
+def audio_files(root: str | pathlib.Path, extensions: tuple[str, ...] = AUDIO_EXTENSIONS,
+                jobs: int = None) -> typing.Iterator[pathlib.Path]:
+    """Walk a directory tree for audio files, recording the time spent waiting for them in the walk profiling phase.
+
+    :param root: The root directory.
+    :param extensions: The extensions of the files to return.
+    :param jobs: The number of directories listed in parallel. By default, DEFAULT_JOBS.
+    :return: An iterator over the file paths, in no particular order.
+    """
+    for walked_file in profiling.iterate(profiling.WALK, walk_files(root, extensions, jobs)):
+        yield walked_file.path
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """Add the walk arguments to an argument parser.
+
+    :param parser: The argument parser.
+    """
+    parser.add_argument("--walk-jobs", type=int, default=DEFAULT_JOBS,
+                        help="The number of directories to list in parallel. Raise it for libraries on network mounts")